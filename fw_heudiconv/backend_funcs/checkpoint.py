@@ -0,0 +1,147 @@
+import os
+import json
+import time
+import hashlib
+import logging
+import threading
+from collections import OrderedDict
+
+log = logging.getLogger(__name__)
+
+JOURNAL_VERSION = 1
+
+
+class CheckpointError(RuntimeError):
+    """Raised when a checkpoint journal stops a run from starting"""
+
+
+def default_checkpoint_path(cache_dir, project_id, subject_labels=None, session_labels=None):
+    """The journal of a run; runs over different subjects or sessions of a
+    project get different journals, so they can run at the same time"""
+    name = project_id
+    if subject_labels or session_labels:
+        selection = json.dumps([sorted(subject_labels or []), sorted(session_labels or [])])
+        name += '-' + hashlib.sha1(selection.encode('utf-8')).hexdigest()[:12]
+    return os.path.join(cache_dir, 'checkpoint-{}.jsonl'.format(name))
+
+
+class CheckpointJournal(object):
+    """An append-only record of what a curation run got through
+
+    The first line identifies the run (project and heuristic); after it
+    come the file info writes made, one line per file, the IntendedFor
+    targets held back for other sessions, and a line for every session
+    finished. A session's lines are synced to disk together with the line
+    saying it finished, so a run that dies leaves a journal that
+    ``--resume`` continues from: sessions it finished are not queried or
+    curated again, and their held back IntendedFor targets are still
+    added at the end. The journal is removed once a run finishes with no
+    failed sessions.
+
+    A journal left behind by an unfinished run stops the next run unless it
+    resumes or explicitly restarts.
+
+    Args:
+        path (str): The journal file
+        project_id (str): The project being curated
+        heuristic_id (str): Hash of the heuristic
+        resume (bool): Continue the run recorded in the journal
+        restart (bool): Discard the journal and start over
+    """
+
+    def __init__(self, path, project_id, heuristic_id, resume=False, restart=False):
+        self.path = path
+        self.done = set()
+        self.writes = 0
+        self.held = []
+        self._lock = threading.Lock()
+
+        exists = os.path.exists(path)
+        if exists and not (resume or restart):
+            raise CheckpointError(
+                "An unfinished run left {}; pass --resume to continue it or --restart "
+                "to curate every session again".format(path))
+        if exists and resume:
+            self._load(project_id, heuristic_id)
+            log.info("Resuming: %d sessions and %d file writes were already done",
+                     len(self.done), self.writes)
+            self._file = open(path, 'a')
+            return
+        if resume:
+            log.warning("No checkpoint to resume at %s; starting a new run", path)
+
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self._file = open(path, 'w')
+        self._append([OrderedDict([('version', JOURNAL_VERSION), ('project', project_id),
+                                   ('heuristic', heuristic_id), ('started', time.time())])])
+
+    def _load(self, project_id, heuristic_id):
+        with open(self.path, 'r') as f:
+            lines = f.readlines()
+        try:
+            header = json.loads(lines[0])
+        except (IndexError, ValueError):
+            raise CheckpointError("{} isn't a checkpoint journal".format(self.path))
+        if (header.get('version') != JOURNAL_VERSION or
+                header.get('project') != project_id or
+                header.get('heuristic') != heuristic_id):
+            raise CheckpointError(
+                "{} was written for another project or heuristic; pass --restart "
+                "to discard it".format(self.path))
+        held = OrderedDict()
+        for line in lines[1:]:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                # the last line may be cut short by the crash
+                continue
+            if 'done' in record:
+                self.done.add(record['done'])
+            elif 'write' in record:
+                self.writes += 1
+                # a later IntendedFor write is the held back targets being added
+                if 'IntendedFor' in record['keys']:
+                    held.pop((record['write'], record['filename']), None)
+            elif 'held' in record:
+                held[(record['held'], record['filename'])] = record
+        # targets held back by finished sessions that weren't added yet
+        self.held = [r for r in held.values() if r['session'] in self.done]
+
+    def _append(self, records, sync=True):
+        lines = ''.join(json.dumps(record) + '\n' for record in records)
+        with self._lock:
+            self._file.write(lines)
+            self._file.flush()
+            if sync:
+                os.fsync(self._file.fileno())
+
+    def add(self, session, updates, held=()):
+        """Record the writes made for a session, and the IntendedFor targets
+        it held back (see IntentionIndex.held)
+
+        They reach the disk with the session's done line.
+        """
+        records = [OrderedDict([
+            ('write', u.acquisition_id), ('session', session.id),
+            ('filename', u.filename), ('keys', sorted(u.update))])
+            for u in updates if u.update]
+        records.extend(OrderedDict([('held', h['acquisition_id']), ('session', session.id)] +
+                                   [(k, v) for k, v in h.items() if k != 'acquisition_id'])
+                       for h in held)
+        if records:
+            self._append(records, sync=False)
+
+    def session_done(self, session):
+        self._append([OrderedDict([('done', session.id), ('label', session.label)])])
+        self.done.add(session.id)
+
+    def close(self, finished=False):
+        """Close the journal, removing it if the run finished"""
+        with self._lock:
+            self._file.flush()
+            os.fsync(self._file.fileno())
+        self._file.close()
+        if finished:
+            os.remove(self.path)
+        else:
+            log.info("Run checkpoint kept at %s; rerun with --resume to continue", self.path)
@@ -0,0 +1,131 @@
+import logging
+import threading
+import collections
+
+log = logging.getLogger(__name__)
+
+# Containers held per run besides those seeded in bulk by a prefetch
+DEFAULT_MAX_SIZE = 4096
+
+
+class CachedClient(object):
+    """A flywheel client whose container lookups are cached for one run
+
+    ``get`` and ``find_project`` are served from a least recently used cache;
+    every other attribute is passed through to the wrapped client. Anything
+    that writes to a container must call :func:`invalidate` with its id so the
+    next lookup goes back to the server.
+
+    Args:
+        client (Client): The flywheel sdk client
+        max_size (int): Number of containers to hold before evicting the
+            least recently used, on top of any seeded with ``grow``
+    """
+
+    def __init__(self, client, max_size=DEFAULT_MAX_SIZE):
+        self.client = client
+        self.base_size = max_size
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._containers = collections.OrderedDict()
+        self._projects = {}
+        self._lock = threading.Lock()
+
+    def __getattr__(self, name):
+        return getattr(self.client, name)
+
+    def _lookup(self, container_id):
+        with self._lock:
+            if container_id in self._containers:
+                self._containers.move_to_end(container_id)
+                self.hits += 1
+                return self._containers[container_id]
+            self.misses += 1
+        return None
+
+    def remember(self, *containers, grow=False):
+        """Add containers fetched some other way, e.g. in bulk
+
+        With ``grow``, the cache is enlarged to hold all of them besides its
+        usual size, so a prefetch larger than the cache isn't evicted,
+        earliest sessions first, before the run gets to it.
+        """
+        with self._lock:
+            if grow:
+                self.max_size = max(self.max_size, len(containers) + self.base_size)
+            for container in containers:
+                self._containers[container.id] = container
+                self._containers.move_to_end(container.id)
+            while len(self._containers) > self.max_size:
+                self._containers.popitem(last=False)
+                self.evictions += 1
+
+    def get(self, container_id, **kwargs):
+        if kwargs:
+            return self.client.get(container_id, **kwargs)
+        container = self._lookup(container_id)
+        if container is None:
+            container = self.client.get(container_id)
+            self.remember(container)
+        return container
+
+    def find_project(self, label):
+        with self._lock:
+            if label in self._projects:
+                self.hits += 1
+                return self._projects[label]
+            self.misses += 1
+        project = self.client.projects.find_first('label="{}"'.format(label))
+        with self._lock:
+            self._projects[label] = project
+        return project
+
+    def invalidate(self, *container_ids):
+        with self._lock:
+            for container_id in container_ids:
+                self._containers.pop(container_id, None)
+            for label, project in list(self._projects.items()):
+                if project is not None and project.id in container_ids:
+                    del self._projects[label]
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': self.hits / lookups if lookups else 0.0,
+                'evictions': self.evictions,
+                'size': len(self._containers),
+            }
+
+
+def find_project(client, label):
+    """Find a project by label, through the run's cache if there is one"""
+    if isinstance(client, CachedClient):
+        return client.find_project(label)
+    return client.projects.find_first('label="{}"'.format(label))
+
+
+def remember(client, *containers, grow=False):
+    """Seed the run's cache with containers, if there is one"""
+    if isinstance(client, CachedClient):
+        client.remember(*containers, grow=grow)
+
+
+def invalidate(client, *container_ids):
+    """Drop containers from the run's cache after writing to them"""
+    if isinstance(client, CachedClient):
+        client.invalidate(*container_ids)
+
+
+def log_cache_stats(client, logger=log):
+    """Report the hit rate of the run's cache, if there is one"""
+    if not isinstance(client, CachedClient):
+        return
+    stats = client.stats()
+    logger.info("Container cache: %d hits, %d misses (%.0f%% hit rate), %d evictions",
+                stats['hits'], stats['misses'], stats['hit_rate'] * 100,
+                stats['evictions'])
@@ -1,19 +1,24 @@
+import copy
 import logging
 import re
-import pdb
 import operator
+from collections import OrderedDict, namedtuple
 import pprint
 import mimetypes
-import flywheel
 import json
-import pandas as pd
 from os import path
 from pathvalidate import is_valid_filename
 from pathlib import Path
-from fw_heudiconv.cli.export import get_nested
+from fw_heudiconv.backend_funcs.utils import get_nested
+from fw_heudiconv.backend_funcs.container_cache import invalidate
 
 logger = logging.getLogger('fw-heudiconv-curator')
 
+# What apply_heuristic did to a file; ``update`` only holds the info keys
+# that differed, ``old`` their previous values, and ``status`` is one of
+# 'new', 'updated' or 'unchanged'
+FileUpdate = namedtuple('FileUpdate', ['acquisition_id', 'filename', 'update', 'status', 'old'])
+
 
 def build_intention_path(f):
     """Builds a string of the path to the file w.r.t. subject dir
@@ -54,44 +59,43 @@ def force_label_format(str_input):
     return(str_input)
 
 
-def apply_heuristic(client, heur, acquisition_id, dry_run=False, intended_for=[],
-                    metadata_extras={}, subj_replace=None, ses_replace=None, item_num=1):
-    """ Apply heuristic to rename files
+def _labels(client, acquisition_object, subj_replace=None, ses_replace=None):
+    """The subject and session labels to use in an acquisition's BIDS names"""
+    subj_replace = none_replace if subj_replace is None else subj_replace
+    ses_replace = none_replace if ses_replace is None else ses_replace
+    subj_label = subj_replace(force_label_format(client.get(acquisition_object.parents.subject).label))
+    sess_label = ses_replace(force_label_format(client.get(acquisition_object.parents.session).label))
+    return subj_label, sess_label
 
-    This function applies the specified heuristic to the files given in the
-    list of acquisitions.
 
-    Args:
-        client (Client): The flywheel sdk client
-        heur (tuple): 3-tuple, the "key" of a seq_info dictionary, where
-            the first item of the tuple is the naming convention as a string
-        acquisition_ids (list): The "value" of a seq_info dictionary, the list
-            of acquisitions to which the naming convention applies
+def _destinations(client, heur, acquisition_id, subj_replace=None, ses_replace=None,
+                  item_num=1):
+    """Work out the new BIDS info of an acquisition's files under a heuristic key
+
+    Returns:
+        tuple: (acquisition, its session, list of (file, new BIDS info))
     """
     suffixes = {'nifti': ".nii.gz", 'bval': ".bval", 'bvec': ".bvec"}
     ftypes = ['nifti', 'bval', 'bvec', 'tsv']
     template, outtype, annotation_classes = heur
     template = force_template_format(template)
 
-    subj_replace = none_replace if subj_replace is None else subj_replace
-    ses_replace = none_replace if ses_replace is None else ses_replace
-
     acquisition_object = client.get(acquisition_id)
-    subj_label = subj_replace(force_label_format(client.get(acquisition_object.parents.subject).label))
-    sess_label = ses_replace(force_label_format(client.get(acquisition_object.parents.session).label))
+    session_object = client.get(acquisition_object.parents.session)
+    subj_label, sess_label = _labels(client, acquisition_object, subj_replace, ses_replace)
 
     files = [f for f in acquisition_object.files if f.type in ftypes]
     bids_keys = ['sub', 'ses', 'folder', 'name']
 
     files.sort(key=operator.itemgetter("name"))
+    destinations = []
     for fnum, f in enumerate(files):
         bids_vals = template.format(subject=subj_label, session=sess_label, item=fnum+1, seqitem=item_num).split("/")
         bids_dict = dict(zip(bids_keys, bids_vals))
         suffix = suffixes[f.type]
 
-        if 'BIDS' not in f.info:
-            f.info['BIDS'] = ""
-        new_bids = f.info['BIDS']
+        # copy so the cached acquisition isn't changed until it's written
+        new_bids = copy.deepcopy(f.info.get('BIDS', ""))
         if new_bids in ("NA", ""):
             new_bids = add_empty_bids_fields(bids_dict['folder'], bids_dict['name'])
         new_bids['Filename'] = bids_dict['name']+suffix
@@ -103,14 +107,59 @@ def apply_heuristic(client, heur, acquisition_id, dry_run=False, intended_for=[]
         new_bids['valid'] = True
 
         infer_params_from_filename(new_bids)
+        destinations.append((f, new_bids))
+
+    return acquisition_object, session_object, destinations
 
-        destination = "\n" + f.name + "\n\t" + new_bids['Filename'] + " -> " \
-            + new_bids["Path"] + "/" + new_bids['Filename']
+
+def plan_bids_paths(client, heur, acquisition_id, subj_replace=None, ses_replace=None,
+                    item_num=1):
+    """The BIDS paths apply_heuristic will give an acquisition's NIfTI files
+
+    Returns:
+        list: (file name, BIDS path) of each NIfTI file
+    """
+    _, _, destinations = _destinations(client, heur, acquisition_id, subj_replace,
+                                       ses_replace, item_num)
+    return [(f.name, new_bids['Path'] + "/" + new_bids['Filename'])
+            for f, new_bids in destinations if '.nii' in f.name]
+
+
+def apply_heuristic(client, heur, acquisition_id, dry_run=False, intended_for=[],
+                    metadata_extras={}, subj_replace=None, ses_replace=None, item_num=1,
+                    intentions=None):
+    """ Apply heuristic to rename files
+
+    This function applies the specified heuristic to the files given in the
+    list of acquisitions.
+
+    Args:
+        client (Client): The flywheel sdk client
+        heur (tuple): 3-tuple, the "key" of a seq_info dictionary, where
+            the first item of the tuple is the naming convention as a string
+        acquisition_ids (list): The "value" of a seq_info dictionary, the list
+            of acquisitions to which the naming convention applies
+        intentions (IntentionIndex): Drops IntendedFor targets that don't
+            point to a BIDS file
+
+    Returns:
+        list: A FileUpdate for every file. Only info keys whose value differs
+            from the file's current info are written, and files with no
+            differences aren't written at all
+    """
+    acquisition_object, session_object, destinations = _destinations(
+        client, heur, acquisition_id, subj_replace, ses_replace, item_num)
+    subj_label, sess_label = _labels(client, acquisition_object, subj_replace, ses_replace)
+
+    updates = []
+    for f, new_bids in destinations:
+        old_bids = f.info.get('BIDS', "")
+        new_path = new_bids["Path"] + "/" + new_bids['Filename']
+        destination = "\n" + f.name + "\n\t" + new_bids['Filename'] + " -> " + new_path
         logger.debug(destination)
 
-        if not dry_run:
-            acquisition_object.update_file_info(f.name, {'BIDS': new_bids})
-            acquisition_object = client.get(acquisition_id) # Refresh the acquisition object
+        # BIDS, IntendedFor and metadata extras go in a single write
+        desired = {'BIDS': new_bids}
 
         if intended_for and (f.name.endswith(".nii.gz") or f.name.endswith(".nii")):
 
@@ -118,24 +167,66 @@ def apply_heuristic(client, heur, acquisition_id, dry_run=False, intended_for=[]
                          for intend in intended_for]
             intendeds = [intend.format(subject=subj_label, session=sess_label)
                          for intend in intendeds]
+            if intentions is not None:
+                intendeds = intentions.resolve(session_object, acquisition_id, f.name,
+                                               new_path, intendeds)
 
             logger.debug("%s IntendedFor: %s", pprint.pformat(new_bids['Filename']),
                          pprint.pformat(intendeds))
-            if not dry_run:
-                acquisition_object.update_file_info(f.name, {'IntendedFor': intendeds})
-                acquisition_object = client.get(acquisition_id)
-                # Check that it was applied
-                file_info = acquisition_object.get_file(f.name)
-                assert file_info['info']['IntendedFor'] == intendeds
-                logger.debug("Applied!")
+            desired['IntendedFor'] = intendeds
 
         if metadata_extras:
             logger.debug("%s metadata: %s", f.name, metadata_extras)
-            if not dry_run:
-                old_metadata = get_metadata_from_acq(client, acquisition_object, f.name)
-                new_metadata = old_metadata.copy()
-                new_metadata.update(metadata_extras)
-                acquisition_object.update_file_info(f.name, new_metadata)
+            desired.update(metadata_extras)
+
+        # only write what differs from the file's current info
+        update = {k: v for k, v in desired.items() if f.info.get(k) != v}
+        if not update:
+            status = 'unchanged'
+        elif not isinstance(old_bids, dict) or not old_bids.get('Filename'):
+            status = 'new'
+        else:
+            status = 'updated'
+        logger.debug("%s: %s %s", f.name, status, sorted(update))
+
+        if update and not dry_run:
+            acquisition_object.update_file_info(f.name, update)
+        old = {k: f.info.get(k) for k in update}
+        updates.append(FileUpdate(acquisition_id, f.name, update, status, old))
+
+    if any(u.update for u in updates) and not dry_run:
+        invalidate(client, acquisition_id)
+    return updates
+
+
+def verify_updates(client, updates):
+    """Check that info updates made by apply_heuristic were applied
+
+    Each acquisition is fetched once, however many of its files were updated.
+
+    Args:
+        client (Client): The flywheel sdk client
+        updates (list): FileUpdates returned by apply_heuristic
+
+    Returns:
+        list: (acquisition id, file name, key) of every update not found
+    """
+    expected = OrderedDict()
+    for u in updates:
+        if u.update:
+            expected.setdefault(u.acquisition_id, []).append((u.filename, u.update))
+
+    missing = []
+    for acquisition_id, file_updates in expected.items():
+        files = {f.name: f for f in client.get(acquisition_id).files}
+        for filename, update in file_updates:
+            info = files[filename].info if filename in files else {}
+            missing.extend((acquisition_id, filename, key)
+                           for key, value in update.items() if info.get(key) != value)
+    for acquisition_id, filename, key in missing:
+        logger.warning("%s of %s in acquisition %s wasn't applied", key, filename,
+                       acquisition_id)
+    return missing
 
 
 def add_empty_bids_fields(folder, fname=None):
@@ -262,57 +353,6 @@ def infer_params_from_filename(bdict):
     bdict.update(to_fill)
 
 
-def confirm_intentions(client, session, dry_run=False):
-    """Ensure that files in "IntededFor" will ultimately exist in the BIDS directory.
-    """
-    try:
-        acqs = [client.get(s.id) for s in session.acquisitions()]
-        acq_files = [f for a in acqs for f in a.files if '.nii' in f.name]
-        bids_filenames = [get_nested(f, 'info', 'BIDS', 'Filename') for f in acq_files]
-        bids_paths = [get_nested(f, 'info', 'BIDS', 'Path') for f in acq_files]
-        full_filenames = []
-        for folder, filename in zip(bids_paths, bids_filenames):
-            if None in (folder, filename) or '' in (filename, folder):
-                continue
-            full_filenames.append(folder + "/" + filename)
-
-        bids_files = [re.sub("sub-[a-zA-z0-9]+/", "", x) for x in full_filenames]
-
-        # Go through all the acquisitions in the session
-        for acq in acqs:
-            for acq_file in acq.files:
-                if not acq_file.type == 'nifti':
-                    continue
-                intendeds = get_nested(acq_file.to_dict(), 'info', 'IntendedFor')
-                if not intendeds:
-                    continue
-                # If there are "IntendedFor" values, check that they will exist
-                logger.debug(
-                    "Ensuring all intentions apply for acquisition %s: %s",
-                    acq.label, acq_file.name)
-
-                ok_intentions = []
-                bad_intentions = []
-                for intendedfor in intendeds:
-                    if intendedfor in bids_files:
-                        ok_intentions.append(intendedfor)
-                    else:
-                        bad_intentions.append(intendedfor)
-
-                if bad_intentions:
-                    logger.warning(
-                        "IntendedFor values do not point to a BIDS file: %s",
-                        bad_intentions)
-                    # pdb.set_trace()
-                if not dry_run:
-                    acq.update_file_info(acq_file.name,
-                                         {'IntendedFor': ok_intentions})
-
-    except Exception as e:
-        logger.warning("Trouble updating intentions for this session %s", session.label)
-        logger.warning(e)
-
-
 def confirm_bids_namespace(project_obj, dry_run):
 
     bids_info = get_nested(project_obj, 'info', 'BIDS')
@@ -442,16 +482,20 @@ def upload_attachment(
         )
 
     if not dry_run:
+        import flywheel
         file_spec = flywheel.FileSpec(
             attachment_dict['name'], attachment_dict['data'], attachment_dict['type']
             )
         target_object.upload_file(file_spec)
         target_object = target_object.reload()
         target_object.update_file_info(attachment_dict['name'], {'BIDS': bids})
+        invalidate(client, target_object.id)
         logger.info("Attachment uploaded!")
 
 def parse_validator(path):
 
+    import pandas as pd
+
     with open(path, 'r') as read_file:
         data = json.load(read_file)
 
@@ -0,0 +1,128 @@
+import os
+import json
+import logging
+import threading
+
+log = logging.getLogger(__name__)
+
+STATE_VERSION = 2
+
+STATE_FILENAME = '.fw-heudiconv-export.json'
+
+
+def default_state_path(bids_root):
+    # a dotfile, so the BIDS validator skips it
+    return os.path.join(bids_root, STATE_FILENAME)
+
+
+def is_within(path, root):
+    """Whether ``path`` is inside the directory ``root``, once links are resolved"""
+    root = os.path.realpath(root)
+    return os.path.realpath(path).startswith(root + os.sep)
+
+
+class ExportState(object):
+    """What a previous export of a project wrote, and from which files
+
+    Every file written is recorded by its path relative to the BIDS
+    directory, with the Flywheel container, name, ``hash`` and ``size`` it
+    came from, and the BIDS folder of acquisition files; sidecars are
+    recorded too. A sync only downloads files whose record doesn't match the
+    file on Flywheel or is missing from disk, and removes files recorded
+    before that are no longer curated. Files the export never wrote are
+    left alone.
+
+    Args:
+        path (str): The JSON state file
+        bids_root (str): The BIDS directory paths are relative to
+        project (str): The project being exported; a state saved for
+            another project is ignored
+    """
+
+    def __init__(self, path, bids_root, project):
+        self.path = path
+        self.bids_root = bids_root
+        self.project = project
+        self.files = {}
+        self._lock = threading.Lock()
+
+        try:
+            with open(path, 'r') as f:
+                state = json.load(f)
+        except (OSError, ValueError):
+            return
+        if state.get('version') != STATE_VERSION or state.get('project') != project:
+            log.info("Export state doesn't match this project; downloading everything")
+            return
+        self.files = state.get('files', {})
+
+    def key(self, path):
+        return os.path.relpath(os.path.abspath(path), os.path.abspath(self.bids_root))
+
+    def is_current(self, download):
+        """Whether the file on disk is the one on Flywheel"""
+        record = self.files.get(self.key(download.path))
+        if record is None or download.hash is None:
+            return False
+        if (record.get('container'), record.get('name'), record.get('hash'),
+                record.get('size')) != (download.container_id, download.name,
+                                        download.hash, download.size):
+            return False
+        try:
+            return os.path.getsize(download.path) == download.size
+        except OSError:
+            return False
+
+    def mark_done(self, download):
+        with self._lock:
+            self.files[self.key(download.path)] = {
+                'container': download.container_id,
+                'name': download.name,
+                'hash': download.hash,
+                'size': download.size,
+                'folder': download.folder,
+            }
+
+    def mark_sidecar(self, path, folder):
+        with self._lock:
+            self.files[self.key(path)] = {'sidecar': True, 'folder': folder}
+
+    def stale(self, paths, folders=None, attachments=True):
+        """Recorded files not among ``paths``, as absolute paths
+
+        Only files the export selected are given: those from ``folders``
+        when given, and attachments only with ``attachments``. Files outside
+        the BIDS directory never are.
+        """
+        root = os.path.abspath(self.bids_root)
+        keep = set(self.key(p) for p in paths)
+        stale = []
+        for key, record in self.files.items():
+            folder = record.get('folder')
+            if key in keep:
+                continue
+            if folder is None and not attachments:
+                continue
+            if folder is not None and folders is not None and folder not in folders:
+                continue
+            path = os.path.join(root, key)
+            if is_within(path, root):
+                stale.append(path)
+        return sorted(stale)
+
+    def forget(self, path):
+        with self._lock:
+            self.files.pop(self.key(path), None)
+
+    def save(self):
+        with self._lock:
+            state = {
+                'version': STATE_VERSION,
+                'project': self.project,
+                'files': dict(self.files),
+            }
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        tmp_path = '{}.{}.tmp'.format(self.path, os.getpid())
+        with open(tmp_path, 'w') as f:
+            json.dump(state, f, indent=2, sort_keys=True)
+        os.replace(tmp_path, self.path)
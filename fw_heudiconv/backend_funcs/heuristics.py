@@ -0,0 +1,446 @@
+import os
+import re
+import sys
+import json
+import time
+import types
+import marshal
+import hashlib
+import logging
+import importlib
+import threading
+from contextlib import contextmanager
+from collections import OrderedDict
+from fw_heudiconv.backend_funcs.seqinfo_cache import DEFAULT_CACHE_DIR
+
+log = logging.getLogger(__name__)
+
+# A full commit sha in a URL pins its content
+COMMIT_RE = re.compile(r'/[0-9a-f]{40}/')
+
+REFS_FILE = 'refs.json'
+
+
+class HeuristicNotCached(ModuleNotFoundError):
+    """Raised in offline mode for a heuristic URL that hasn't been cached"""
+
+
+def is_url(path):
+    """Check a heuristic path is a URL, importing validators only when needed"""
+    if not path.startswith(("http://", "https://")):
+        return False
+    import validators
+    return bool(validators.url(path))
+
+
+def _write_atomic(path, data):
+    # concurrent gear jobs may write the same entry; each writes its own
+    # temporary file and the last rename wins with identical content
+    tmp_path = '{}.{}.tmp'.format(path, os.getpid())
+    with open(tmp_path, 'wb') as f:
+        f.write(data)
+    os.replace(tmp_path, path)
+
+
+@contextmanager
+def _file_lock(path):
+    """Hold an exclusive lock on ``path`` across processes, where flock exists"""
+    try:
+        import fcntl
+    except ImportError:
+        yield
+        return
+    with open(path, 'a') as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+class HeuristicCache(object):
+    """Heuristic sources and their bytecode, stored by content hash
+
+    ``objects/<sha256>.py`` holds a heuristic's source and
+    ``objects/<sha256>.<cache tag>.pyc`` its compiled code. ``refs.json`` maps
+    each URL to the hash of its content, when it was fetched and the
+    validators (``ETag``, ``Last-Modified``) to check it is still current
+    with; URLs pinned to a commit never need fetching again.
+
+    Args:
+        cache_dir (str): The fw-heudiconv cache directory
+    """
+
+    def __init__(self, cache_dir=DEFAULT_CACHE_DIR):
+        self.root = os.path.join(cache_dir, 'heuristics')
+        self.objects = os.path.join(self.root, 'objects')
+        os.makedirs(self.objects, exist_ok=True)
+
+    def _refs(self):
+        try:
+            with open(os.path.join(self.root, REFS_FILE), 'r') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def lookup(self, url):
+        """The cached ref of a URL: dict with ``sha256``, ``fetched``, ``etag``
+        and ``last_modified``, or None"""
+        ref = self._refs().get(url)
+        if ref and os.path.exists(self._source_path(ref['sha256'])):
+            return ref
+        return None
+
+    def remember(self, url, digest, etag=None, last_modified=None):
+        # read and write under a lock so concurrent jobs don't drop each
+        # other's entries
+        with _file_lock(os.path.join(self.root, REFS_FILE + '.lock')):
+            refs = self._refs()
+            refs[url] = {'sha256': digest, 'fetched': time.time(), 'etag': etag,
+                         'last_modified': last_modified}
+            _write_atomic(os.path.join(self.root, REFS_FILE),
+                          json.dumps(refs, indent=2, sort_keys=True).encode('utf-8'))
+
+    def _source_path(self, digest):
+        return os.path.join(self.objects, digest + '.py')
+
+    def _code_path(self, digest):
+        return os.path.join(self.objects, '{}.{}.pyc'.format(digest, sys.implementation.cache_tag))
+
+    def store(self, source):
+        """Store a heuristic's source, returning its content hash"""
+        digest = hashlib.sha256(source).hexdigest()
+        if not os.path.exists(self._source_path(digest)):
+            _write_atomic(self._source_path(digest), source)
+        return digest
+
+    def source(self, digest):
+        with open(self._source_path(digest), 'rb') as f:
+            return f.read()
+
+    def code(self, digest, filename):
+        """The compiled code of a stored heuristic, compiling it on first use"""
+        code_path = self._code_path(digest)
+        try:
+            with open(code_path, 'rb') as f:
+                return marshal.load(f)
+        except (OSError, ValueError, EOFError, TypeError):
+            pass
+        code = compile(self.source(digest), filename, 'exec')
+        _write_atomic(code_path, marshal.dumps(code))
+        return code
+
+
+def _module_from_code(name, code, filename, directory=None):
+    """Run a heuristic's code as a module, as heudiconv imports heuristic files
+
+    The module is registered in ``sys.modules`` and, while it runs,
+    ``directory`` is first on ``sys.path`` so the heuristic can import helper
+    modules that sit next to it.
+    """
+    module = types.ModuleType(name)
+    module.__file__ = filename
+    module.filename = filename
+    existing = sys.modules.get(name)
+    if existing is None or getattr(existing, '__file__', None) == filename:
+        sys.modules[name] = module
+    old_syspath = sys.path[:]
+    if directory is not None:
+        sys.path.insert(0, directory)
+    try:
+        exec(code, module.__dict__)
+    except BaseException:
+        if sys.modules.get(name) is module:
+            del sys.modules[name]
+        raise
+    finally:
+        sys.path = old_syspath
+    return module
+
+
+def _age(fetched):
+    """How long ago a timestamp was, in words"""
+    seconds = max(time.time() - fetched, 0)
+    for unit, size in (('day', 86400), ('hour', 3600), ('minute', 60)):
+        if seconds >= size:
+            count = int(seconds // size)
+            return '{} {}{}'.format(count, unit, '' if count == 1 else 's')
+    return 'less than a minute'
+
+
+def _fetch(url, ref=None):
+    """Fetch a heuristic URL, only if it changed since ``ref`` was cached
+
+    Returns:
+        tuple: (the content, or None if the cached copy is to be used, and
+        the response's validators to remember with the content)
+    """
+    import requests
+    headers = {}
+    if ref is not None:
+        if ref.get('etag'):
+            headers['If-None-Match'] = ref['etag']
+        if ref.get('last_modified'):
+            headers['If-Modified-Since'] = ref['last_modified']
+    try:
+        response = requests.get(url, headers=headers)
+    except Exception as e:
+        if ref is not None:
+            log.warning("Couldn't check %s for changes (%s); using the cached copy "
+                        "fetched %s ago", url, e, _age(ref['fetched']))
+            return None, {}
+        log.error("Trouble retrieving the URL!")
+        raise ModuleNotFoundError("Is this a valid URL to a heuristic on Github? Please check spelling!")
+    if ref is not None and response.status_code == 304:
+        log.info("%s is unchanged; using the cached copy fetched %s ago", url,
+                 _age(ref['fetched']))
+        return None, {}
+    if not response.ok:
+        log.error("Couldn't find a valid URL for this heuristic at:\n\n" + url + "\n")
+        raise ModuleNotFoundError("Is this a valid URL to a heuristic on Github? Please check spelling!")
+    return response.content, {'etag': response.headers.get('ETag'),
+                              'last_modified': response.headers.get('Last-Modified')}
+
+
+def load_heuristic(heuristic_path, cache_dir=DEFAULT_CACHE_DIR, offline=False):
+    """Load a heuristic from a file, a GitHub URL or the bundled examples
+
+    Files and URLs go through the content-addressed HeuristicCache, so the
+    same heuristic is only compiled once. A URL pinned to a commit is only
+    fetched once; any other (e.g. a branch, which a fix may have just been
+    pushed to) is checked with a conditional request on every load and only
+    downloaded again if it changed.
+
+    Args:
+        heuristic_path (str): Path to a heuristic file, URL of one on GitHub,
+            or the name of an example heuristic
+        cache_dir (str): The fw-heudiconv cache directory
+        offline (bool): Never fetch; fail if a URL isn't cached
+
+    Returns:
+        tuple: (heuristic module, its source code)
+
+    Raises:
+        ModuleNotFoundError: If the heuristic can't be loaded
+    """
+
+    if os.path.isfile(heuristic_path):
+        with open(heuristic_path, 'rb') as f:
+            source = f.read()
+        cache = HeuristicCache(cache_dir)
+        digest = cache.store(source)
+        heuristic_file = os.path.realpath(heuristic_path)
+        directory, filename = os.path.split(heuristic_file)
+        heuristic = _module_from_code(filename.split('.')[0],
+                                      cache.code(digest, heuristic_file), heuristic_file,
+                                      directory)
+        return heuristic, source.decode('utf-8')
+
+    if "github" in heuristic_path and is_url(heuristic_path):
+        cache = HeuristicCache(cache_dir)
+        ref = cache.lookup(heuristic_path)
+        pinned = bool(COMMIT_RE.search(heuristic_path))
+        if ref is None and offline:
+            raise HeuristicNotCached(
+                "{} isn't in the heuristic cache; run once without --offline".format(heuristic_path))
+        if ref is not None and (pinned or offline):
+            log.info("Using the cached copy of %s fetched %s ago", heuristic_path,
+                     _age(ref['fetched']))
+            content = None
+        else:
+            content, validators = _fetch(heuristic_path, ref)
+        if content is None:
+            digest = ref['sha256']
+        else:
+            digest = cache.store(content)
+            cache.remember(heuristic_path, digest, **validators)
+        heuristic = _module_from_code('heuristic', cache.code(digest, heuristic_path),
+                                      heuristic_path)
+        return heuristic, cache.source(digest).decode('utf-8')
+
+    heuristic = importlib.import_module('fw_heudiconv.example_heuristics.{}'.format(heuristic_path))
+    import inspect
+    return heuristic, inspect.getsource(heuristic)
+
+
+def _contains(column, value):
+    """Element membership for list or tuple fields (like ``image_type``),
+    substring search for strings"""
+    def contains(cell):
+        if isinstance(cell, (list, tuple, set, frozenset)):
+            return value in cell
+        if isinstance(cell, str):
+            return value in cell
+        return False
+    return column.map(contains)
+
+
+RULE_OPS = {
+    '==': lambda column, value: column == value,
+    '!=': lambda column, value: column != value,
+    '<': lambda column, value: column < value,
+    '<=': lambda column, value: column <= value,
+    '>': lambda column, value: column > value,
+    '>=': lambda column, value: column >= value,
+    'in': lambda column, value: column.isin(value),
+    'contains': _contains,
+    'match': lambda column, value: column.astype(str).str.fullmatch(value),
+}
+
+
+def _rule_mask(column, predicate):
+    """Evaluate one field predicate of a rule over a whole column"""
+    import numpy as np
+
+    if callable(predicate):
+        mask = predicate(column)
+    elif isinstance(predicate, str):
+        # strings are regular expressions searched for in the field
+        mask = column.astype(str).str.contains(predicate, regex=True)
+    elif isinstance(predicate, tuple):
+        op, value = predicate
+        if op not in RULE_OPS:
+            raise ValueError("Unknown rule operator {!r}; expected one of {}".format(
+                op, sorted(RULE_OPS)))
+        mask = RULE_OPS[op](column, value)
+    elif predicate is None:
+        mask = column.isna()
+    else:
+        mask = column == predicate
+    return np.asarray(mask, dtype=bool)
+
+
+def evaluate_rules(rules, df):
+    """Find the first rule each row of a SeqInfo DataFrame matches
+
+    Args:
+        rules (list): (predicates, key) pairs, where predicates maps SeqInfo
+            field names to a regex, a value, an (operator, value) tuple, or a
+            function of the column returning a boolean mask
+        df (DataFrame): SeqInfos, one per row
+
+    Returns:
+        ndarray: The index of the rule matched by each row, -1 for none
+    """
+    import numpy as np
+
+    matched = np.full(len(df), -1)
+    for number, (predicates, _) in enumerate(rules):
+        mask = matched == -1
+        for field, predicate in predicates.items():
+            if not mask.any():
+                break
+            mask &= _rule_mask(df[field], predicate)
+        matched[mask] = number
+    return matched
+
+
+def apply_rules(rules, table, session_ids):
+    """Evaluate a heuristic's rule table over every session at once
+
+    Args:
+        rules (list): The heuristic's RULES
+        table (SeqInfoTable): The SeqInfos of all sessions
+        session_ids (list): The session id of each row of ``table``
+
+    Returns:
+        dict: session id -> ``{key: [series_id]}``, as infotodict would
+            return for that session
+    """
+    df = table.to_dataframe()
+    matched = evaluate_rules(rules, df)
+    series_ids = df['series_id'].tolist()
+
+    decisions = {}
+    for session_id, series_id, number in zip(session_ids, series_ids, matched.tolist()):
+        if number < 0:
+            continue
+        key = rules[number][1]
+        found = decisions.setdefault(session_id, {}).setdefault(key, [])
+        if series_id not in found:
+            found.append(series_id)
+    return decisions
+
+
+# The SeqInfo fields a heuristic's decision is assumed to depend on; the
+# identifiers of the series and subject are left out
+SIGNATURE_FIELDS = (
+    'series_description', 'protocol_name', 'sequence_name', 'series_files',
+    'unspecified', 'TR', 'TE', 'image_type', 'is_motion_corrected', 'is_derived',
+    'dim1', 'dim2', 'dim3', 'dim4', 'study_description', 'referring_physician_name')
+
+
+class MemoizedHeuristic(object):
+    """Calls a heuristic once per distinct SeqInfo signature
+
+    ``infotodict`` is evaluated on a single representative SeqInfo of each
+    signature and the keys it was given are reused for every later SeqInfo
+    with the same signature, in any session. This only holds for heuristics
+    that decide each series on its own fields; ones that look at the rest of
+    the session should set ``CACHEABLE = False``. A heuristic can also narrow
+    or widen the signature with ``SIGNATURE_FIELDS``.
+
+    Every other attribute is taken from the heuristic.
+
+    Args:
+        heuristic (module): The loaded heuristic
+    """
+
+    def __init__(self, heuristic):
+        self.heuristic = heuristic
+        self.fields = tuple(getattr(heuristic, 'SIGNATURE_FIELDS', SIGNATURE_FIELDS))
+        self.hits = 0
+        self.misses = 0
+        self._decisions = {}
+        self._lock = threading.Lock()
+
+    def __getattr__(self, name):
+        return getattr(self.heuristic, name)
+
+    def _keys(self, seqinfo):
+        signature = tuple(getattr(seqinfo, field) for field in self.fields)
+        with self._lock:
+            keys = self._decisions.get(signature)
+            if keys is not None:
+                self.hits += 1
+                return keys
+            self.misses += 1
+        decision = self.heuristic.infotodict(OrderedDict([(seqinfo, {})])) or {}
+        keys = tuple(key for key, series_ids in decision.items()
+                     if seqinfo.series_id in series_ids)
+        with self._lock:
+            self._decisions[signature] = keys
+        return keys
+
+    def infotodict(self, seqinfo):
+        info = OrderedDict()
+        for s in seqinfo:
+            for key in self._keys(s):
+                info.setdefault(key, []).append(s.series_id)
+        return info
+
+    def hit_rate(self):
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups else 0.0
+
+
+def memoize_heuristic(heuristic, lazy=False):
+    """Wrap a heuristic in a MemoizedHeuristic where that gives the same result
+
+    Returns:
+        The MemoizedHeuristic, or the heuristic itself if it has a rule table
+        (already evaluated once), sets ``CACHEABLE = False`` or is given lazy
+        SeqInfos
+    """
+    if getattr(heuristic, 'RULES', None) is not None:
+        return heuristic
+    if lazy:
+        # the signature reads fields the heuristic may never use, which
+        # lazy SeqInfos would fetch and record as used
+        log.warning("--memoize doesn't work with --lazy; calling the heuristic "
+                    "for every session")
+        return heuristic
+    if not getattr(heuristic, 'CACHEABLE', True):
+        log.warning("The heuristic isn't cacheable; calling it for every session")
+        return heuristic
+    return MemoizedHeuristic(heuristic)
@@ -0,0 +1,120 @@
+import os
+import json
+import hashlib
+import logging
+from fw_heudiconv.backend_funcs.query import seqinfo_info
+
+log = logging.getLogger(__name__)
+
+STATE_VERSION = 1
+
+
+def default_state_path(cache_dir, project_id):
+    return os.path.join(cache_dir, 'curate-{}.json'.format(project_id))
+
+
+def session_fingerprint(acquisitions):
+    """Hash the files of a session's acquisitions
+
+    Names, content and the header fields SeqInfos are read from are used, so
+    headers filled in or edited after a session was curated make it look
+    changed. The rest of the info and the ``modified`` timestamp aren't:
+    curating a session changes them, which must not make it look changed on
+    the next run.
+    """
+    parts = sorted(
+        (acq.id, f.name, f.get('hash'), f.get('size'),
+         json.dumps(seqinfo_info(f), sort_keys=True, default=str))
+        for acq in acquisitions for f in acq.files)
+    return hashlib.sha1(json.dumps(parts).encode('utf-8')).hexdigest()
+
+
+def _timestamp(value):
+    if value is None:
+        return None
+    return value.isoformat() if hasattr(value, 'isoformat') else str(value)
+
+
+class CurationState(object):
+    """What a previous curation of a project got through
+
+    Holds a high-water mark (the latest acquisition ``modified`` time seen)
+    and the fingerprint of every session curated, for one heuristic. A run
+    only needs to look at sessions with acquisitions modified after the mark
+    and, of those, only curate the ones whose fingerprint changed.
+
+    Args:
+        path (str): The JSON state file
+        project_id (str): The project being curated
+        heuristic_id (str): Hash of the heuristic; a different heuristic
+            invalidates the whole state
+        full (bool): Ignore the saved state, recording a fresh one
+    """
+
+    def __init__(self, path, project_id, heuristic_id, full=False):
+        self.path = path
+        self.project_id = project_id
+        self.heuristic_id = heuristic_id
+        self.mark = None
+        self.sessions = {}
+        self.new_mark = None
+
+        if full:
+            return
+        try:
+            with open(path, 'r') as f:
+                state = json.load(f)
+        except (OSError, ValueError):
+            return
+        if (state.get('version') != STATE_VERSION or
+                state.get('project') != project_id or
+                state.get('heuristic') != heuristic_id):
+            log.info("Curation state doesn't match this project and heuristic; curating everything")
+            return
+        self.mark = state.get('high_water_mark')
+        self.sessions = state.get('sessions', {})
+        self.new_mark = self.mark
+
+    @property
+    def is_incremental(self):
+        return self.mark is not None
+
+    def candidate_sessions(self, client, sessions):
+        """Keep the sessions that are new or have acquisitions modified since the mark"""
+        if not self.is_incremental:
+            return list(sessions)
+        query = 'parents.project={},modified>{}'.format(self.project_id, self.mark)
+        changed = set(acq.parents.session for acq in client.acquisitions.iter_find(query))
+        return [s for s in sessions if s.id in changed or s.id not in self.sessions]
+
+    def observe(self, acquisitions):
+        """Move the new mark up to the latest ``modified`` in ``acquisitions``"""
+        for acq in acquisitions:
+            modified = _timestamp(acq.get('modified'))
+            if modified is not None and (self.new_mark is None or modified > self.new_mark):
+                self.new_mark = modified
+
+    def is_current(self, session, acquisitions):
+        """Whether the session was curated and hasn't changed since"""
+        return self.sessions.get(session.id) == session_fingerprint(acquisitions)
+
+    def mark_done(self, session, acquisitions):
+        self.sessions[session.id] = session_fingerprint(acquisitions)
+
+    def mark_failed(self, session):
+        # forgetting the session keeps it a candidate whatever the mark
+        self.sessions.pop(session.id, None)
+
+    def save(self):
+        state = {
+            'version': STATE_VERSION,
+            'project': self.project_id,
+            'heuristic': self.heuristic_id,
+            'high_water_mark': self.new_mark,
+            'sessions': self.sessions,
+        }
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        tmp_path = '{}.{}.tmp'.format(self.path, os.getpid())
+        with open(tmp_path, 'w') as f:
+            json.dump(state, f, indent=2, sort_keys=True)
+        os.replace(tmp_path, self.path)
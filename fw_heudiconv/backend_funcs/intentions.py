@@ -0,0 +1,205 @@
+import logging
+import threading
+from collections import Counter, OrderedDict
+from fw_heudiconv.backend_funcs.utils import get_nested
+from fw_heudiconv.backend_funcs.container_cache import invalidate
+from fw_heudiconv.backend_funcs.convert import FileUpdate
+
+log = logging.getLogger(__name__)
+
+# IntendedFor values may also be BIDS URIs relative to the dataset root
+BIDS_URI = 'bids::'
+
+
+def bids_path(info):
+    """The path of a file in the BIDS dataset, from its info, or None"""
+    folder = get_nested(info, 'BIDS', 'Path')
+    filename = get_nested(info, 'BIDS', 'Filename')
+    if not folder or not filename:
+        return None
+    return folder + "/" + filename
+
+
+def session_dir(parts):
+    """The ``ses-`` folder of a split dataset path, or None in a session-less layout"""
+    return parts[1] if len(parts) > 2 and parts[1].startswith('ses-') else None
+
+
+def target_path(subject_dir, intended):
+    """The dataset path of an IntendedFor value given for a file of ``subject_dir``"""
+    if intended.startswith(BIDS_URI):
+        return intended[len(BIDS_URI):]
+    return subject_dir + "/" + intended
+
+
+class IntentionIndex(object):
+    """The BIDS paths of a project's NIfTI files, for checking IntendedFor
+
+    Starts from the files' current BIDS info and follows the paths curation
+    plans for them, so each IntendedFor target is checked with a set lookup
+    instead of rescanning the session. A target that may be in another
+    session (of any session of the subject, in a session-less layout) and
+    isn't indexed yet is held back, and added by :meth:`finish` if it
+    resolves once every session has been planned.
+
+    Args:
+        project_id (str): The project being curated
+        acquisitions (iterable): Acquisitions to index, with their file info
+        complete (bool): ``acquisitions`` hold every session of the project,
+            so a missing target will never be found elsewhere
+    """
+
+    def __init__(self, project_id, acquisitions=(), complete=False):
+        self.project_id = project_id
+        self.complete = complete
+        self._files = {}
+        self._paths = Counter()
+        self._pending = OrderedDict()
+        self._lock = threading.Lock()
+        self.add_acquisitions(acquisitions)
+
+    def add_acquisitions(self, acquisitions):
+        """Index the current BIDS paths of files that haven't been planned"""
+        for acq in acquisitions:
+            for f in acq.files:
+                path = bids_path(f.info) if '.nii' in f.name else None
+                if path is not None and (acq.id, f.name) not in self._files:
+                    self.plan(acq.id, f.name, path)
+
+    def plan(self, acquisition_id, filename, path):
+        """Record the BIDS path a file is going to have"""
+        key = (acquisition_id, filename)
+        with self._lock:
+            old = self._files.get(key)
+            if old == path:
+                return
+            if old is not None:
+                self._paths[old] -= 1
+                if not self._paths[old]:
+                    del self._paths[old]
+            self._files[key] = path
+            self._paths[path] += 1
+
+    def __contains__(self, path):
+        return self._paths.get(path, 0) > 0
+
+    def resolve(self, session, acquisition_id, filename, path, intendeds):
+        """Drop the IntendedFor targets of a file that don't point to a BIDS file
+
+        Args:
+            session (Session): The session of the file
+            acquisition_id (str): The acquisition of the file
+            filename (str): The file's name
+            path (str): The file's own BIDS path
+            intendeds (list): Its IntendedFor values
+
+        Returns:
+            list: The values to write now
+        """
+        parts = path.split("/")
+        subject_dir, own_session = parts[0], session_dir(parts)
+        kept, bad, held = [], [], False
+        for intended in intendeds:
+            target = target_path(subject_dir, intended)
+            target_parts = target.split("/")
+            if target in self:
+                kept.append(intended)
+            elif own_session is not None and target_parts[0] == subject_dir and \
+                    session_dir(target_parts) == own_session:
+                # the session's own files are all planned before it is written
+                bad.append(intended)
+            else:
+                # another session's files may not be planned yet
+                held = True
+        if bad:
+            log.warning("IntendedFor values do not point to a BIDS file: %s", bad)
+        if held:
+            with self._lock:
+                self._pending[(acquisition_id, filename)] = (
+                    session, subject_dir, intendeds, kept, bad)
+        return kept
+
+    def held(self, session_id):
+        """The targets a session's files held back, for a checkpoint journal
+
+        Returns:
+            list: A dict per file, which :meth:`restore` takes back
+        """
+        with self._lock:
+            return [OrderedDict([('acquisition_id', acquisition_id), ('filename', filename),
+                                 ('subject_dir', subject_dir), ('intendeds', intendeds),
+                                 ('kept', kept), ('reported', reported)])
+                    for (acquisition_id, filename), (session, subject_dir, intendeds, kept,
+                                                     reported) in self._pending.items()
+                    if session.id == session_id]
+
+    def restore(self, session, held):
+        """Hold back the targets an interrupted run recorded for a session"""
+        with self._lock:
+            self._pending[(held['held'], held['filename'])] = (
+                session, held['subject_dir'], held['intendeds'], held['kept'],
+                held['reported'])
+
+    def finish(self, client, dry_run=False, plan=None, journal=None):
+        """Add the held back targets in other sessions that now resolve
+
+        If the index isn't complete and some held back target is still
+        missing, the rest of its subject is indexed, or the rest of the
+        project if the target is another subject's. Only files whose
+        IntendedFor changes are written.
+
+        Args:
+            client (Client): The flywheel sdk client
+            dry_run (bool): Don't write the IntendedFor values
+            plan (PlanWriter): Receives the IntendedFor changes
+            journal (CheckpointJournal): Records the IntendedFor writes
+
+        Returns:
+            list: The FileUpdates of the files whose IntendedFor changed
+        """
+        def resolved(subject_dir, intendeds):
+            return [i for i in intendeds if target_path(subject_dir, i) in self]
+
+        if not self.complete:
+            # targets resolve() already reported are in the file's own session
+            subjects, elsewhere = OrderedDict(), False
+            for session, subject_dir, intendeds, _, reported in self._pending.values():
+                for intended in intendeds:
+                    target = target_path(subject_dir, intended)
+                    if intended in reported or target in self:
+                        continue
+                    if target.split("/")[0] == subject_dir:
+                        subjects[session.subject.id] = True
+                    else:
+                        elsewhere = True
+            if elsewhere:
+                queries = ['parents.project={}'.format(self.project_id)]
+            else:
+                queries = ['parents.subject={}'.format(subject_id) for subject_id in subjects]
+            for query in queries:
+                self.add_acquisitions(client.acquisitions.iter_find(query, include_all_info=True))
+            self.complete = elsewhere
+
+        updates = []
+        for (acquisition_id, filename), (session, subject_dir, intendeds, kept, reported) \
+                in self._pending.items():
+            ok = resolved(subject_dir, intendeds)
+            # same-session targets were already reported by resolve()
+            bad = [i for i in intendeds if i not in ok and i not in reported]
+            if bad:
+                log.warning("IntendedFor values of %s do not point to a BIDS file: %s",
+                            filename, bad)
+            if ok == kept:
+                continue
+            update = FileUpdate(acquisition_id, filename, {'IntendedFor': ok}, 'updated',
+                                {'IntendedFor': kept})
+            updates.append(update)
+            if plan is not None:
+                plan.add(session, [update])
+            if not dry_run:
+                client.get(acquisition_id).update_file_info(filename, update.update)
+                invalidate(client, acquisition_id)
+                if journal is not None:
+                    journal.add(session, [update])
+        self._pending.clear()
+        return updates
@@ -0,0 +1,298 @@
+import os
+import json
+import hashlib
+import logging
+import threading
+import collections
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
+from fw_heudiconv.backend_funcs.query import (
+    SeqInfo, SEQINFO_FIELDS, CONVERTABLE_TYPES, DicomZip, acquisition_order,
+    dicom_member_count, get_dicom_zip_info, dicom_image_shape, file_seqinfo_fields)
+
+log = logging.getLogger(__name__)
+
+# Fields that need the dicom zip info; everything else comes from file metadata
+ZIP_FIELDS = ('total_files_till_now', 'example_dcm_file', 'dim1', 'dim2', 'dim3', 'dim4')
+
+FIELD_USAGE_FILE = 'field_usage.json'
+
+
+def heuristic_hash(source):
+    """Content hash identifying a heuristic by its source code"""
+    if isinstance(source, str):
+        source = source.encode('utf-8')
+    return hashlib.sha1(source).hexdigest()
+
+
+def load_field_usage(cache_dir, heuristic_id):
+    """The SeqInfo fields a heuristic was seen reading on previous runs
+
+    Returns:
+        set: The field names, empty if the heuristic hasn't been seen before
+    """
+    path = os.path.join(cache_dir, FIELD_USAGE_FILE)
+    try:
+        with open(path, 'r') as f:
+            return set(json.load(f).get(heuristic_id, []))
+    except (OSError, ValueError):
+        return set()
+
+
+def save_field_usage(cache_dir, heuristic_id, fields):
+    """Record the SeqInfo fields a heuristic read"""
+    os.makedirs(cache_dir, exist_ok=True)
+    path = os.path.join(cache_dir, FIELD_USAGE_FILE)
+    try:
+        with open(path, 'r') as f:
+            usage = json.load(f)
+    except (OSError, ValueError):
+        usage = {}
+    usage[heuristic_id] = sorted(set(usage.get(heuristic_id, [])) | set(fields))
+    tmp_path = '{}.{}.tmp'.format(path, os.getpid())
+    with open(tmp_path, 'w') as f:
+        json.dump(usage, f, indent=2, sort_keys=True)
+    os.replace(tmp_path, path)
+
+
+class FieldUsage(object):
+    """Records which SeqInfo fields are read while recording is on
+
+    Recording is per thread, so reads made by logging or by other sessions'
+    threads aren't attributed to the heuristic.
+
+    Args:
+        known (set): Fields a previous run of the heuristic read. Their
+            values are fetched up front instead of on first access
+    """
+
+    def __init__(self, known=None):
+        self.known = set(known or ())
+        self.fields = set()
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    def add(self, name):
+        if getattr(self._local, 'active', False):
+            with self._lock:
+                self.fields.add(name)
+
+    @contextmanager
+    def recording(self):
+        self._local.active = True
+        try:
+            yield self
+        finally:
+            self._local.active = False
+
+
+@contextmanager
+def record_field_usage(usage):
+    """Record field reads into ``usage``, doing nothing if it is None"""
+    if usage is None:
+        yield None
+    else:
+        with usage.recording():
+            yield usage
+
+
+class LazyAcquisition(object):
+    """Fetches the dicom zip info of an acquisition the first time it's needed
+
+    Args:
+        client (Client): The flywheel client
+        acq (Acquisition): The acquisition, with its file info
+        session_acquisitions (list): All LazyAcquisitions of the session, in
+            order; this one is appended to it
+        zip_info (DicomZip): Already known zip info, e.g. from the cache
+        listed (bool): Whether ``zip_info`` includes ``example_dcm_file``
+    """
+
+    _UNFETCHED = object()
+
+    def __init__(self, client, acq, session_acquisitions, zip_info=_UNFETCHED, listed=False):
+        self.client = client
+        self.acq = acq
+        self.session_acquisitions = session_acquisitions
+        self.position = len(session_acquisitions)
+        session_acquisitions.append(self)
+        self._zip_info = zip_info
+        self._listed = listed
+        self._shape = None
+        self._lock = threading.Lock()
+
+    def zip_info(self, example=False):
+        with self._lock:
+            if self._zip_info is self._UNFETCHED or (example and not self._listed):
+                # if the count isn't in the metadata the zip has to be listed
+                # anyway, so keep the example from the same listing
+                if not example:
+                    dicoms = [f for f in self.acq.files if f.type == 'dicom']
+                    example = bool(dicoms) and dicom_member_count(dicoms[0]) is None
+                self._zip_info = get_dicom_zip_info(self.client, self.acq,
+                                                    skip_example_dcm=not example)
+                self._listed = example
+            return self._zip_info
+
+    def num_dicoms(self):
+        zip_info = self.zip_info()
+        return zip_info.num_members if zip_info is not None else 0
+
+    def total(self):
+        return sum(a.num_dicoms()
+                   for a in self.session_acquisitions[:self.position + 1])
+
+    def image_shape(self):
+        if self._shape is None:
+            zip_info = self.zip_info()
+            if zip_info is not None:
+                dcm_info = [f for f in self.acq.files if f.type == 'dicom'][0].info
+                self._shape = dicom_image_shape(dcm_info, zip_info.num_members)
+            else:
+                self._shape = dicom_image_shape({}, -1)
+        return self._shape
+
+    def field(self, name):
+        if name == 'total_files_till_now':
+            return self.total()
+        if name == 'example_dcm_file':
+            zip_info = self.zip_info(example=True)
+            return zip_info.example_dcm_file if zip_info is not None else None
+        return self.image_shape()[int(name[-1]) - 1]
+
+
+class LazySeqInfo(object):
+    """A SeqInfo whose zip-derived fields are computed on first access
+
+    Behaves like the SeqInfo namedtuple for attribute and index access,
+    iteration and ``_asdict``. Every field read is reported to ``usage``.
+    """
+
+    __slots__ = ('_values', '_acquisition', '_usage')
+    _fields = tuple(SEQINFO_FIELDS)
+
+    def __init__(self, values, acquisition, usage):
+        self._values = values
+        self._acquisition = acquisition
+        self._usage = usage
+
+    def __getattr__(self, name):
+        if name not in SEQINFO_FIELDS:
+            raise AttributeError(name)
+        self._usage.add(name)
+        values = self._values
+        if name not in values:
+            values[name] = self._acquisition.field(name)
+        return values[name]
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return tuple(self)[index]
+        return getattr(self, SEQINFO_FIELDS[index])
+
+    def __iter__(self):
+        return (getattr(self, name) for name in SEQINFO_FIELDS)
+
+    def __len__(self):
+        return len(SEQINFO_FIELDS)
+
+    def _asdict(self):
+        return collections.OrderedDict((name, getattr(self, name)) for name in SEQINFO_FIELDS)
+
+    def _replace(self, **kwargs):
+        return self.resolve()._replace(**kwargs)
+
+    def resolve(self):
+        """Compute every field and return a plain SeqInfo"""
+        return SeqInfo(*self)
+
+    def is_resolved(self, name):
+        return name in self._values
+
+    def _key(self):
+        return (self._values['series_id'], self._values['dcm_dir_name'])
+
+    def __eq__(self, other):
+        if isinstance(other, LazySeqInfo):
+            return self._key() == other._key()
+        return NotImplemented
+
+    def __hash__(self):
+        return hash(self._key())
+
+    def __repr__(self):
+        return 'LazySeqInfo(series_id={!r}, dcm_dir_name={!r})'.format(*self._key())
+
+
+def peek_field(seqinfo, name, default='?'):
+    """Read a SeqInfo field without triggering a fetch or recording the read"""
+    if isinstance(seqinfo, LazySeqInfo):
+        return seqinfo._values.get(name, default)
+    return getattr(seqinfo, name)
+
+
+def lazy_session_to_seq_info(client, session, context, acquisitions, jobs, usage,
+                             cache=None):
+    """Returns an OrderedDict of LazySeqInfos for a session
+
+    Args:
+        client (Client): The flywheel client
+        session (Session): A flywheel session object
+        context (dict): The flywheel heirarchy context to pass down
+        acquisitions (list): Prefetched acquisitions, or None
+        jobs (int): Number of acquisitions to fetch concurrently
+        usage (FieldUsage): Receives the fields the heuristic reads. Fields
+            it read on previous runs are fetched up front
+        cache (SeqInfoCache): SeqInfos of unchanged acquisitions are taken
+            from here; new ones aren't stored since they're incomplete
+
+    Returns:
+        OrderedDict: The seq info object
+    """
+    refresh = acquisitions is None
+    if refresh:
+        acquisitions = session.acquisitions()
+    acquisitions = sorted(acquisitions, key=acquisition_order)
+
+    def fetch(acq):
+        if refresh:
+            acq = client.get(acq.id)
+        cached = cache.get(acq, complete=False) if cache is not None else None
+        return acq, cached
+
+    with ThreadPoolExecutor(max_workers=max(jobs, 1)) as pool:
+        fetched = list(pool.map(fetch, acquisitions) if jobs > 1 else map(fetch, acquisitions))
+
+        seq_info = collections.OrderedDict()
+        lazy_acquisitions = []
+        for acq, cached in fetched:
+            if cached is not None:
+                num_dicoms, cached_infos = cached
+                example = cached_infos[0].example_dcm_file if cached_infos else None
+                lazy_acq = LazyAcquisition(client, acq, lazy_acquisitions,
+                                           DicomZip(num_dicoms, example),
+                                           listed=example is not None)
+                for info in cached_infos:
+                    values = info._asdict()
+                    del values['total_files_till_now']
+                    values['patient_id'] = context['subject'].label
+                    seq_info[LazySeqInfo(values, lazy_acq, usage)] = {}
+                continue
+
+            lazy_acq = LazyAcquisition(client, acq, lazy_acquisitions)
+            for fileobj in acq.files:
+                if fileobj.type not in CONVERTABLE_TYPES:
+                    continue
+                values = file_seqinfo_fields(acq, fileobj, context)
+                seq_info[LazySeqInfo(values, lazy_acq, usage)] = {}
+
+        # fetch what the heuristic is known to need in parallel, rather than
+        # one request at a time as it reads them
+        needed = usage.known.intersection(ZIP_FIELDS)
+        if needed:
+            example = 'example_dcm_file' in needed
+            list(pool.map(lambda a: a.zip_info(example), lazy_acquisitions))
+
+    log.debug('session=%s', session.label)
+    log.debug('Got %s lazy seqinfos', len(seq_info))
+    return seq_info
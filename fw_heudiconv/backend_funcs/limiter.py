@@ -0,0 +1,233 @@
+"""Adapts how many Flywheel writes and transfers are in flight at once
+
+Several curate or export jobs against one site share its rate limits, so a
+fixed ``--jobs`` is either too timid or gets throttled. The
+:class:`AdaptiveLimiter` uses additive increase, multiplicative decrease
+(AIMD): every request that comes back quickly raises the limit a little,
+while a throttled (429/503) or failed request, or one much slower than
+usual, cuts it. Transfers only count when throttled or failed, since how
+long they take depends on the file. A ``Retry-After`` header holds back
+every request until the time it gives.
+"""
+
+import time
+import logging
+import threading
+from contextlib import contextmanager
+from email.utils import parsedate_to_datetime
+from fw_heudiconv.backend_funcs.metrics import METRICS, call_type, get_api_client
+from fw_heudiconv.backend_funcs.utils import is_transient, RETRIES
+
+log = logging.getLogger(__name__)
+
+# Statuses that mean the server wants fewer requests
+THROTTLE_STATUS = (429, 503)
+
+# Requests the limiter applies to: everything but reads of container info
+LIMITED_CALLS = ('update_file_info', 'download_file', 'upload_file', 'other')
+
+DEFAULT_MAX_IN_FLIGHT = 16
+
+
+def retry_after(error):
+    """Seconds a throttled response asked to wait, or None"""
+    headers = getattr(error, 'headers', None) or {}
+    value = None
+    for name in ('Retry-After', 'retry-after'):
+        try:
+            value = headers.get(name)
+        except AttributeError:
+            return None
+        if value is not None:
+            break
+    if value is None:
+        return None
+    try:
+        return max(float(value), 0.0)
+    except ValueError:
+        pass
+    try:
+        when = parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    return max(when.timestamp() - time.time(), 0.0)
+
+
+class AdaptiveLimiter(object):
+    """An AIMD limit on concurrent requests, shared by all threads
+
+    Args:
+        initial (int): The limit to start from
+        max_limit (int): The most requests to ever have in flight
+        min_limit (int): The fewest requests to allow in flight
+        latency_factor (float): A request slower than this many times the
+            usual latency counts as congestion
+        decrease (float): What the limit is multiplied by on congestion
+        metrics (Metrics): Receives the limit, in-flight and backoff gauges
+    """
+
+    def __init__(self, initial=4, max_limit=DEFAULT_MAX_IN_FLIGHT, min_limit=1,
+                 latency_factor=3.0, decrease=0.5, metrics=METRICS):
+        self.limit = float(min(initial, max_limit))
+        self.max_limit = max_limit
+        self.min_limit = min_limit
+        self.latency_factor = latency_factor
+        self.decrease = decrease
+        self.metrics = metrics
+        self.in_flight = 0
+        self.throttled = 0
+        self.backoff_until = 0.0
+        self.backoff_seconds = 0.0
+        self.latency = None
+        self._last_decrease = 0.0
+        self._cond = threading.Condition()
+        self._local = threading.local()
+
+    def _publish(self):
+        self.metrics.set_gauge('concurrency_limit', self.limit)
+        self.metrics.set_gauge('requests_in_flight', self.in_flight)
+        self.metrics.set_gauge('throttled_requests', self.throttled)
+        self.metrics.set_gauge('backoff_seconds', self.backoff_seconds)
+
+    def acquire(self):
+        with self._cond:
+            while True:
+                wait = self.backoff_until - time.time()
+                if wait > 0:
+                    self._cond.wait(wait)
+                elif self.in_flight < int(self.limit):
+                    break
+                else:
+                    self._cond.wait()
+            self.in_flight += 1
+            self._publish()
+
+    def _cut(self, now):
+        # one cut per round trip, however many requests saw the congestion
+        if now - self._last_decrease > (self.latency or 0.0):
+            self.limit = max(self.min_limit, self.limit * self.decrease)
+            self._last_decrease = now
+            log.debug("Concurrency limit cut to %.1f", self.limit)
+
+    def release(self, seconds, throttled=False, failed=False, delay=None):
+        """Give back a slot, adjusting the limit by how the request went
+
+        Args:
+            seconds (float): How long the request took, or None for a
+                transfer, whose time says more about its size than the load
+            throttled (bool): The server asked for fewer requests
+            failed (bool): The request failed in a way that may be load related
+            delay (float): Seconds the server asked to wait before retrying
+        """
+        now = time.time()
+        with self._cond:
+            self.in_flight -= 1
+            if throttled or failed:
+                self.throttled += throttled
+                self._cut(now)
+                if delay:
+                    until = now + delay
+                    if until > self.backoff_until:
+                        self.backoff_seconds += until - max(self.backoff_until, now)
+                        self.backoff_until = until
+            elif seconds is None:
+                pass
+            elif self.latency is not None and seconds > self.latency_factor * self.latency:
+                self._cut(now)
+            else:
+                self.limit = min(self.max_limit, self.limit + 1.0 / self.limit)
+            if not throttled and not failed and seconds is not None:
+                self.latency = seconds if self.latency is None else \
+                    0.9 * self.latency + 0.1 * seconds
+            self._publish()
+            self._cond.notify_all()
+
+    @contextmanager
+    def slot(self, track_latency=True):
+        """Hold a slot for the duration of a request
+
+        Nested slots in the same thread share the outer one, so a transfer
+        can be limited as a whole while its SDK requests go through the
+        limited client too.
+
+        Args:
+            track_latency (bool): Whether the request's time counts towards
+                the usual latency; pass False for transfers, so a large
+                download doesn't look like congestion. Throttled and failed
+                transfers still cut the limit.
+        """
+        depth = getattr(self._local, 'depth', 0)
+        if depth:
+            self._local.depth += 1
+            try:
+                yield
+            finally:
+                self._local.depth -= 1
+            return
+
+        self.acquire()
+        self._local.depth = 1
+        start = time.time()
+        try:
+            yield
+        except Exception as e:
+            status = getattr(e, 'status', None)
+            self.release(time.time() - start, throttled=status in THROTTLE_STATUS,
+                         failed=is_transient(e), delay=retry_after(e))
+            raise
+        else:
+            self.release(time.time() - start if track_latency else None)
+        finally:
+            self._local.depth = 0
+
+    def call(self, func, *args, attempts=1, track_latency=True, **kwargs):
+        """Make a request in a slot, retrying it if it is throttled
+
+        Only repeat requests that are safe to make twice.
+        """
+        for attempt in range(1, attempts + 1):
+            try:
+                with self.slot(track_latency):
+                    return func(*args, **kwargs)
+            except Exception as e:
+                if attempt == attempts or getattr(e, 'status', None) not in THROTTLE_STATUS:
+                    raise
+                # the slot already set the wait from Retry-After, if there was one
+                if retry_after(e) is None:
+                    time.sleep(2 ** attempt)
+                log.debug("Throttled (%s); retrying (%d/%d)", e.status, attempt, attempts - 1)
+
+
+LIMITER = AdaptiveLimiter()
+
+
+def limit_requests(client, max_in_flight=DEFAULT_MAX_IN_FLIGHT, limiter=LIMITER):
+    """Send the client's writes and transfers through the limiter
+
+    File info updates are retried when throttled; uploads and downloads
+    aren't, since their request bodies and responses are streams, and their
+    duration isn't taken as a sign of congestion.
+
+    Returns:
+        bool: Whether the client could be limited
+    """
+    api_client = get_api_client(client)
+    if api_client is None:
+        return False
+    limiter.max_limit = max_in_flight
+    limiter.limit = min(limiter.limit, max_in_flight)
+    call_api = api_client.call_api
+
+    def limited_call_api(resource_path, method, path_params=None, query_params=None,
+                         *args, **kwargs):
+        name = call_type(method, resource_path, query_params)
+        if name not in LIMITED_CALLS:
+            return call_api(resource_path, method, path_params, query_params, *args, **kwargs)
+        attempts = RETRIES if name == 'update_file_info' else 1
+        return limiter.call(call_api, resource_path, method, path_params, query_params,
+                            *args, attempts=attempts,
+                            track_latency=name not in ('download_file', 'upload_file'),
+                            **kwargs)
+
+    api_client.call_api = limited_call_api
+    return True
@@ -0,0 +1,198 @@
+"""Counts and timings of a command's stages and Flywheel API calls
+
+Stages are timed with :func:`stage`; every request the Flywheel SDK makes
+goes through its ``ApiClient.call_api``, which :func:`instrument` wraps to
+count and time each call by type. Both are recorded in the module's
+:data:`METRICS` and, with ``--metrics-out``, written when the command exits
+as JSON and in the Prometheus textfile format.
+"""
+
+import os
+import re
+import json
+import time
+import atexit
+import logging
+import threading
+from contextlib import contextmanager
+from collections import OrderedDict
+
+log = logging.getLogger(__name__)
+
+# (method, path) of SDK requests -> call type; first match wins
+CALL_TYPES = [
+    (re.compile(r'^(PATCH|POST|PUT) .*/files/\{\w+\}/info$'), 'update_file_info'),
+    (re.compile(r'^GET .*/files/\{\w+\}$'), 'download_file'),
+    (re.compile(r'^POST .*/(files|upload)\b'), 'upload_file'),
+    (re.compile(r'^GET .*\}$'), 'get'),
+    (re.compile(r'^GET '), 'find'),
+]
+
+
+def call_type(method, resource_path, query_params=None):
+    """Name the kind of SDK call a request is"""
+    request = '{} {}'.format(method.upper(), resource_path)
+    for pattern, name in CALL_TYPES:
+        if pattern.match(request):
+            if name == 'download_file' and any(k == 'info' for k, _ in query_params or ()):
+                return 'file_zip_info'
+            return name
+    return 'other'
+
+
+class Metrics(object):
+    """Thread-safe counts and total seconds of named stages and API calls,
+    plus gauges such as the request concurrency"""
+
+    def __init__(self):
+        self.started = time.time()
+        self.stages = OrderedDict()
+        self.api_calls = OrderedDict()
+        self.api_errors = OrderedDict()
+        self.gauges = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _add(self, table, name, seconds):
+        with self._lock:
+            count, total = table.get(name, (0, 0.0))
+            table[name] = (count + 1, total + seconds)
+
+    def observe(self, name, seconds):
+        self._add(self.stages, name, seconds)
+
+    def observe_call(self, name, seconds, failed=False):
+        self._add(self.api_calls, name, seconds)
+        if failed:
+            with self._lock:
+                self.api_errors[name] = self.api_errors.get(name, 0) + 1
+
+    def set_gauge(self, name, value):
+        with self._lock:
+            self.gauges[name] = value
+
+    @contextmanager
+    def stage(self, name):
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.observe(name, time.time() - start)
+
+    def as_dict(self, command=None):
+        with self._lock:
+            return OrderedDict([
+                ('command', command),
+                ('started', self.started),
+                ('seconds', time.time() - self.started),
+                ('stages', OrderedDict(
+                    (name, {'count': count, 'seconds': seconds})
+                    for name, (count, seconds) in self.stages.items())),
+                ('api_calls', OrderedDict(
+                    (name, {'count': count, 'seconds': seconds,
+                            'errors': self.api_errors.get(name, 0)})
+                    for name, (count, seconds) in self.api_calls.items())),
+                ('gauges', OrderedDict(self.gauges)),
+            ])
+
+    def to_prometheus(self, command=None):
+        """The metrics in the Prometheus textfile exposition format"""
+        data = self.as_dict(command)
+        command_label = 'command="{}"'.format(command or '')
+        families = [
+            ('run_seconds', 'gauge', 'Wall time of the command',
+             [(command_label, data['seconds'])]),
+        ]
+        families += [(name, 'gauge', name.replace('_', ' ').capitalize(),
+                      [(command_label, value)])
+                     for name, value in data['gauges'].items()]
+        for metric, table, label in (('stage', data['stages'], 'stage'),
+                                     ('api_call', data['api_calls'], 'call')):
+            series = [('{},{}="{}"'.format(command_label, label, name), values)
+                      for name, values in table.items()]
+            families += [
+                (metric + '_seconds_total', 'counter', 'Seconds spent per ' + label,
+                 [(labels, values['seconds']) for labels, values in series]),
+                (metric + '_total', 'counter', 'Number of times per ' + label,
+                 [(labels, values['count']) for labels, values in series]),
+            ]
+            if metric == 'api_call':
+                families.append(
+                    ('api_call_errors_total', 'counter', 'Failed API calls per call',
+                     [(labels, values['errors']) for labels, values in series]))
+
+        lines = []
+        for name, kind, description, samples in families:
+            name = 'fw_heudiconv_' + name
+            lines.append('# HELP {} {}'.format(name, description))
+            lines.append('# TYPE {} {}'.format(name, kind))
+            lines.extend('{}{{{}}} {}'.format(name, labels, value) for labels, value in samples)
+        return '\n'.join(lines) + '\n'
+
+    def write(self, path, command=None):
+        """Write the metrics as JSON to ``path``, and for Prometheus next to it
+        with a ``.prom`` extension"""
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        for target, text in ((path, json.dumps(self.as_dict(command), indent=2)),
+                             (os.path.splitext(path)[0] + '.prom', self.to_prometheus(command))):
+            # node_exporter may read the file at any time, so swap it in whole
+            tmp_path = '{}.{}.tmp'.format(target, os.getpid())
+            with open(tmp_path, 'w') as f:
+                f.write(text)
+            os.replace(tmp_path, target)
+
+
+METRICS = Metrics()
+
+
+def stage(name):
+    """Time a stage of the command in :data:`METRICS`"""
+    return METRICS.stage(name)
+
+
+def get_api_client(client):
+    """The SDK ApiClient behind a client, or None"""
+    # CachedClient -> flywheel.Client -> Flywheel -> ApiClient
+    client = getattr(client, 'client', client)
+    client = getattr(client, '_fw', client)
+    return getattr(client, 'api_client', None)
+
+
+def instrument(client, metrics=METRICS):
+    """Count and time every request the client's SDK makes
+
+    Returns:
+        bool: Whether the client could be instrumented
+    """
+    api_client = get_api_client(client)
+    if api_client is None or getattr(api_client, '_metered', False):
+        return api_client is not None
+    call_api = api_client.call_api
+
+    def metered_call_api(resource_path, method, path_params=None, query_params=None,
+                         *args, **kwargs):
+        name = call_type(method, resource_path, query_params)
+        start = time.time()
+        failed = True
+        try:
+            result = call_api(resource_path, method, path_params, query_params,
+                              *args, **kwargs)
+            failed = False
+            return result
+        finally:
+            metrics.observe_call(name, time.time() - start, failed)
+
+    api_client.call_api = metered_call_api
+    api_client._metered = True
+    return True
+
+
+def write_at_exit(path, command, metrics=METRICS):
+    """Write the metrics to ``path`` however the command exits"""
+    def write():
+        try:
+            metrics.write(path, command)
+        except OSError as e:
+            log.warning("Couldn't write metrics to %s: %s", path, e)
+        else:
+            log.info("Wrote metrics to %s", path)
+    atexit.register(write)
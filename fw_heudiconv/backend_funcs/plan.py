@@ -0,0 +1,107 @@
+import os
+import json
+import logging
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+log = logging.getLogger(__name__)
+
+
+class PlanWriter(object):
+    """Writes the file info changes of a curation run to a JSON lines file
+
+    One line per file to change, holding the acquisition id, file name and
+    the old and new values of every info key that would be written. The
+    file is written to a temporary name and only moved into place by
+    :meth:`close`, so a failed run doesn't leave a partial plan behind.
+
+    Args:
+        path (str): Where to write the plan
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.entries = 0
+        self._lock = threading.Lock()
+        self._tmp_path = '{}.{}.tmp'.format(path, os.getpid())
+        self._file = open(self._tmp_path, 'w')
+
+    def add(self, session, updates):
+        """Record the FileUpdates apply_heuristic returned for a session"""
+        lines = []
+        for u in updates:
+            if not u.update:
+                continue
+            lines.append(json.dumps(OrderedDict([
+                ('session', session.label),
+                ('acquisition_id', u.acquisition_id),
+                ('filename', u.filename),
+                ('status', u.status),
+                ('old', u.old),
+                ('new', u.update),
+            ])))
+        with self._lock:
+            for line in lines:
+                self._file.write(line + '\n')
+            self.entries += len(lines)
+
+    def close(self):
+        """Move the plan into place; does nothing once closed or discarded"""
+        if self._file.closed:
+            return
+        self._file.close()
+        os.replace(self._tmp_path, self.path)
+        log.info("Wrote %d planned file changes to %s", self.entries, self.path)
+
+    def discard(self):
+        """Drop the plan of a run that failed"""
+        if self._file.closed:
+            return
+        self._file.close()
+        os.remove(self._tmp_path)
+
+
+def read_plan(path):
+    """Read a plan written by PlanWriter
+
+    Returns:
+        list: The plan's entries, as dicts
+    """
+    with open(path, 'r') as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def apply_plan(client, entries, jobs=1):
+    """Make the file info writes of a plan, without querying Flywheel
+
+    Entries for the same file are merged into one write; later entries win.
+
+    Args:
+        client (Client): The flywheel sdk client
+        entries (list): The entries of a plan, from read_plan
+        jobs (int): Number of writes to make concurrently
+
+    Returns:
+        list: (acquisition id, file name, error) of every write that failed
+    """
+    writes = OrderedDict()
+    for entry in entries:
+        key = (entry['acquisition_id'], entry['filename'])
+        writes.setdefault(key, {}).update(entry['new'])
+
+    def write(item):
+        (acquisition_id, filename), info = item
+        try:
+            client.set_acquisition_file_info(acquisition_id, filename, info)
+        except Exception as e:
+            log.error("Couldn't update %s in acquisition %s: %s", filename, acquisition_id, e)
+            return acquisition_id, filename, str(e)
+        log.debug("Updated %s in acquisition %s: %s", filename, acquisition_id, sorted(info))
+        return None
+
+    with ThreadPoolExecutor(max_workers=max(jobs, 1)) as pool:
+        results = list(pool.map(write, writes.items()))
+    failures = [r for r in results if r is not None]
+    log.info("Applied %d of %d planned file changes", len(writes) - len(failures), len(writes))
+    return failures
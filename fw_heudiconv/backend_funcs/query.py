@@ -1,14 +1,29 @@
 import logging
 import collections
+import functools
+import json
 import os
+import queue
+import threading
 import warnings
-with warnings.catch_warnings():
-    warnings.filterwarnings("ignore", category=UserWarning)
-    from nibabel.nicom.dicomwrappers import wrapper_from_data
+from concurrent.futures import ThreadPoolExecutor
+from fw_heudiconv.backend_funcs.container_cache import find_project, remember
+from fw_heudiconv.backend_funcs.metrics import stage
+from fw_heudiconv.backend_funcs.utils import retry, RETRIES
 
 
 CONVERTABLE_TYPES = ("bvec", "bval", "nifti")
 
+# Above this many sessions it is cheaper to page through the acquisitions of
+# many sessions per query than to issue one query per session
+PREFETCH_SESSION_LIMIT = 10
+
+# Sessions per query when prefetching a large selection of them
+PREFETCH_CHUNK_SIZE = 100
+
+# How many queried sessions iter_seq_info holds ahead of its consumer
+SESSION_BUFFER = 2
+
 log = logging.getLogger(__name__)
 
 SEQINFO_FIELDS = [
@@ -38,80 +53,237 @@ SEQINFO_FIELDS = [
 ]
 SeqInfo = collections.namedtuple('SeqInfo', SEQINFO_FIELDS)
 
+# What a SeqInfo needs from the dicom zip: how many files are in it and the
+# path of one of them
+DicomZip = collections.namedtuple('DicomZip', ['num_members', 'example_dcm_file'])
 
-def acquisition_to_heudiconv(client, acq, context):
-    """Create a list of sequence objects for all convertable files in the acquistion."""
-    to_convert = []
-    # Get the nifti file
+ENHANCED_MR_SOP_CLASS = '1.2.840.10008.5.1.4.1.1.4.1'
+
+
+def acquisition_order(acq):
+    """Sort key putting a session's acquisitions in the order they were acquired
+
+    Heuristics may number runs by position and ``total_files_till_now``
+    depends on it, so acquisitions are sorted the same way however they were
+    queried: by timestamp (or creation time, if there is none), then id.
+    """
+    when = getattr(acq, 'timestamp', None) or getattr(acq, 'created', None)
+    try:
+        seconds = when.timestamp()
+    except AttributeError:
+        seconds = None
+    return (seconds is None, seconds or 0.0, acq.id)
+
+
+def dicom_member_count(dicom):
+    """Number of files in a dicom zip, from metadata alone
+
+    Uses the zip member count Flywheel records for the file or, for
+    single-frame dicoms with one slice per file, the ImagesInAcquisition
+    header field.
+
+    Returns:
+        int: The member count, or None if the metadata doesn't say and the
+        zip has to be listed
+    """
+    count = dicom.get('zip_member_count')
+    if count:
+        return count
+    info = dicom.info or {}
+    if info.get('SOPClassUID') == ENHANCED_MR_SOP_CLASS or info.get('NumberOfFrames', 1) != 1:
+        # multi-frame files hold several slices each
+        return None
+    if 'MOSAIC' in (info.get('ImageType') or []):
+        # Siemens mosaics tile the slices of a volume into each file, so
+        # ImagesInAcquisition counts slices rather than files
+        return None
+    count = info.get('ImagesInAcquisition')
+    return int(count) if count else None
+
+
+def get_dicom_zip_info(client, acq, skip_example_dcm=False):
+    """Find the number of files in the first dicom of the acquisition
+
+    The zip listing is only requested if the member count isn't in the file's
+    metadata, or if the path of an example dicom is wanted.
+
+    Args:
+        client (Client): The flywheel client
+        acq (Acquisition): The acquisition
+        skip_example_dcm (bool): Don't look up ``example_dcm_file``
+
+    Returns:
+        DicomZip: or None if there is no dicom or it can't be read (see
+        zip_info_missing)
+    """
     dicoms = [f for f in acq.files if f.type == 'dicom']
-    if dicoms:
-        dicom = dicoms[0]
-        try:
-            zip_info = acq.get_file_zip_info(dicom.name)
-            context['total'] += len(zip_info.members)
-            dcm_info = dicom.info
+    if not dicoms:
+        return None
+    dicom = dicoms[0]
+    if skip_example_dcm:
+        count = dicom_member_count(dicom)
+        if count is not None:
+            return DicomZip(count, None)
+    try:
+        zip_info = retry(acq.get_file_zip_info, dicom.name)
+    except Exception as e:
+        except_subj = client.get(acq.parents.subject)
+        except_sess = client.get(acq.parents.session)
 
-        except:
-            except_subj = client.get(acq.parents.subject)
-            except_sess = client.get(acq.parents.session)
+        log.debug('Dicom could not be processed (%s):\n\t%s\n\tSubject Label: %s\n\tSession Label: %s',
+                  e, dicom.name, except_subj.label, except_sess.label)
+        return None
+    members = zip_info.members
+    return DicomZip(len(members),
+                    members[0].path if members and not skip_example_dcm else None)
 
-            log.debug('Dicom could not be processed:\n\t%s\n\tSubject Label: %s\n\tSession Label: %s'.format(dicom.name, except_subj.label, except_sess.label))
-            zip_info = None
-            dcm_info = {}
 
-    else:
-        zip_info = None
-        dcm_info = {}
-    # Make it a nicom wrapper to handle all sorts of different dicom styles
-    mw = wrapper_from_data(dcm_info)
-    num_dicoms = len(zip_info.members) if zip_info else -1
-    image_shape = mw.image_shape
+def zip_info_missing(acq, zip_info):
+    """Whether the acquisition has a dicom whose zip info couldn't be read"""
+    return zip_info is None and any(f.type == 'dicom' for f in acq.files)
+
+
+def fetch_acquisition(client, acq, refresh=False, skip_example_dcm=False):
+    """Do the network-bound work for an acquisition
+
+    Args:
+        client (Client): The flywheel client
+        acq (Acquisition): The acquisition
+        refresh (bool): Re-get the acquisition first (to load its file info)
+        skip_example_dcm (bool): Don't look up ``example_dcm_file``
+
+    Returns:
+        tuple: (acquisition, DicomZip of its first dicom)
+    """
+    if refresh:
+        acq = client.get(acq.id)
+    return acq, get_dicom_zip_info(client, acq, skip_example_dcm)
+
+
+@functools.lru_cache(maxsize=256)
+def _multiframe_image_shape(header_json):
+    """Image shape of an enhanced (multi-frame) dicom, via nibabel"""
+    try:
+        with warnings.catch_warnings():
+            warnings.filterwarnings("ignore", category=UserWarning)
+            from nibabel.nicom.dicomwrappers import wrapper_from_data
+        return wrapper_from_data(json.loads(header_json)).image_shape
+    except Exception as e:
+        log.debug('Could not read multi-frame image shape: %s', e)
+        return None
+
+
+def header_image_shape(dcm_info):
+    """The image shape described by a dicom header in Flywheel's JSON form
+
+    For ordinary single-frame dicoms this is (Rows, Columns), which is what
+    nibabel's wrapper reports for a JSON header. nibabel is only used for
+    the multi-frame layouts of Enhanced MR files, memoized on the header.
+
+    Returns:
+        tuple: The shape, or None if the header doesn't have one
+    """
+    if dcm_info.get('SOPClassUID') == ENHANCED_MR_SOP_CLASS:
+        return _multiframe_image_shape(json.dumps(dcm_info, sort_keys=True, default=str))
+    rows, columns = dcm_info.get('Rows'), dcm_info.get('Columns')
+    if rows is None or columns is None:
+        return None
+    return (rows, columns)
+
+
+def dicom_image_shape(dcm_info, num_dicoms):
+    """The (dim1, dim2, dim3, dim4) of a dicom series, padded with -1"""
+    image_shape = header_image_shape(dcm_info)
     if image_shape is None:
         image_shape = (-1, -1, -1, -1)
     else:
-        image_shape = mw.image_shape + (num_dicoms,)
+        image_shape = tuple(image_shape) + (num_dicoms,)
         while len(image_shape) < 4:
             image_shape = image_shape + (-1,)
+    return image_shape
+
+
+# The file info a SeqInfo is built from, by file_seqinfo_fields and
+# dicom_image_shape; curation writes other keys (BIDS, IntendedFor, ...)
+SEQINFO_INFO_KEYS = (
+    'RepetitionTime', 'EchoTime', 'ProtocolName', 'ImageType', 'StudyDescription',
+    'ReferringPhysicianName', 'SeriesDescription', 'SequenceName', 'AccessionNumber',
+    'PatientAge', 'PatientSex', 'AcquisitionDateTime', 'SeriesInstanceUID',
+    'Rows', 'Columns', 'SOPClassUID', 'NumberOfFrames', 'ImagesInAcquisition',
+    'SharedFunctionalGroupsSequence', 'PerFrameFunctionalGroupsSequence')
+
+
+def seqinfo_info(fileobj):
+    """The part of a file's info that its SeqInfo is built from"""
+    info = fileobj.get('info') or {}
+    return {key: info[key] for key in SEQINFO_INFO_KEYS if key in info}
+
+
+def file_seqinfo_fields(acq, fileobj, context):
+    """The SeqInfo fields of a file that come straight from its metadata
+
+    Everything except ``total_files_till_now``, ``example_dcm_file`` and the
+    dims, which need the dicom zip info.
+    """
+    info = fileobj.info
+    return dict(
+        series_id=acq.id,
+        dcm_dir_name=fileobj.name,
+        series_files='-',
+        unspecified='-',
+        # We can use the number of files in the
+        # Or a corresponding dicom header field
+        TR=info.get("RepetitionTime"),
+        TE=info.get("EchoTime"),
+        protocol_name=info.get("ProtocolName", ""),
+        is_motion_corrected="MOCO" in info.get("ImageType", []),
+        is_derived="DERIVED" in info.get("ImageType", []),
+        patient_id=context['subject'].label,
+        study_description=info.get("StudyDescription"),
+        referring_physician_name=info.get("ReferringPhysicianName", ""),
+        series_description=info.get("SeriesDescription", ""),
+        sequence_name=info.get("SequenceName"),
+        image_type=tuple(info.get("ImageType", [])),
+        accession_number=info.get("AccessionNumber"),
+        patient_age=info.get("PatientAge"),
+        patient_sex=info.get("PatientSex"),
+        date=info.get("AcquisitionDateTime"),
+        series_uid=info.get("SeriesInstanceUID")
+    )
+
+
+def acquisition_to_heudiconv(client, acq, context, zip_info=None, fetch_zip=True,
+                             skip_example_dcm=False):
+    """Create a list of sequence objects for all convertable files in the acquistion.
+
+    The dicom zip info is fetched here unless ``fetch_zip`` is False, in
+    which case ``zip_info`` is the (possibly None) result of
+    get_dicom_zip_info.
+    """
+    to_convert = []
+    if fetch_zip:
+        zip_info = get_dicom_zip_info(client, acq, skip_example_dcm)
+    if zip_info is not None:
+        context['total'] += zip_info.num_members
+        dcm_info = [f for f in acq.files if f.type == 'dicom'][0].info
+    else:
+        dcm_info = {}
+    num_dicoms = zip_info.num_members if zip_info else -1
+    image_shape = dicom_image_shape(dcm_info, num_dicoms)
 
     for fileobj in acq.files:
         log.debug('filename: %s', fileobj.name)
         if fileobj.type not in CONVERTABLE_TYPES:
             continue
-        info = fileobj.info
-
-        # Make it a nicom wrapper to handle all sorts of different dicom styles
-        mw = wrapper_from_data(info)
-
-        log.debug('uid: %s', info.get("SeriesInstanceUID"))
+        log.debug('uid: %s', fileobj.info.get("SeriesInstanceUID"))
         to_convert.append(SeqInfo(
-            context['total'],
-            zip_info.members[0].path if zip_info else None,
-            acq.id,
-            fileobj.name,
-            '-',
-            '-',
-            image_shape[0],
-            image_shape[1],
-            image_shape[2],
-            image_shape[3],
-            # We can use the number of files in the
-            # Or a corresponding dicom header field
-            info.get("RepetitionTime"),
-            info.get("EchoTime"),
-            info.get("ProtocolName", ""),
-            "MOCO" in info.get("ImageType", []),
-            "DERIVED" in info.get("ImageType", []),
-            context['subject'].label,
-            info.get("StudyDescription"),
-            info.get("ReferringPhysicianName", ""),
-            info.get("SeriesDescription", ""),
-            info.get("SequenceName"),
-            tuple(info.get("ImageType", [])),
-            info.get("AccessionNumber"),
-            info.get("PatientAge"),
-            info.get("PatientSex"),
-            info.get("AcquisitionDateTime"),
-            info.get("SeriesInstanceUID")
+            total_files_till_now=context['total'],
+            example_dcm_file=zip_info.example_dcm_file if zip_info else None,
+            dim1=image_shape[0],
+            dim2=image_shape[1],
+            dim3=image_shape[2],
+            dim4=image_shape[3],
+            **file_seqinfo_fields(acq, fileobj, context)
         ))
         # We could possible add a context field which would contain flywheel
         # hierarchy information like the subject code and session label
@@ -119,33 +291,129 @@ def acquisition_to_heudiconv(client, acq, context):
     return to_convert
 
 
-def session_to_seq_info(client, session, context):
+def session_to_seq_info(client, session, context, acquisitions=None, jobs=1,
+                        cache=None, skip_example_dcm=False, field_usage=None):
     """Returns a SeqInfo OrderedDict for a session
 
     Args:
         client (Client): The flywheel client
         session (Session): A flywheel session object
         context (dict): The flywheel heirarchy context to pass down
+        acquisitions (list): Prefetched acquisitions (with file info) for
+            this session. If None, they are fetched one by one
+        jobs (int): Number of acquisitions to fetch concurrently. SeqInfos are
+            still built in acquisition order, so the result is the same as
+            with a single job
+        cache (SeqInfoCache): If given, acquisitions whose files haven't
+            changed are read from the cache instead of the server
+        skip_example_dcm (bool): Leave ``example_dcm_file`` empty, which
+            usually saves listing the dicom zip of every acquisition
+        field_usage (FieldUsage): If given, build LazySeqInfos that only
+            fetch the dicom zip info when a field needing it is read
 
     Returns:
         OrderedDict: The seq info object
     """
+    if field_usage is not None:
+        # imported here to avoid a circular import
+        from fw_heudiconv.backend_funcs.lazy_seqinfo import lazy_session_to_seq_info
+        return lazy_session_to_seq_info(client, session, context, acquisitions,
+                                        jobs, field_usage, cache)
+
     seq_info = collections.OrderedDict()
     context['total'] = 0
-    acquisitions = session.acquisitions()
-    #sorted_acquisitions = sorted(acquisitions, key=lambda x: x.timestamp or '')
-    for acquisition in acquisitions:
-        acquisition = client.get(acquisition.id)
-        context['acquisition'] = acquisition
-
-        for info in acquisition_to_heudiconv(client, acquisition, context):
-            log.debug('info: %s', info)
-            seq_info[info] = {}  # This would be set to a list of filepaths in heudiconv
+    refresh = acquisitions is None
+    if refresh:
+        acquisitions = session.acquisitions()
+    acquisitions = sorted(acquisitions, key=acquisition_order)
+
+    def fetch(acq):
+        if refresh:
+            acq = client.get(acq.id)
+        cached = None
+        if cache is not None:
+            cached = cache.get(acq, complete=not skip_example_dcm)
+        if cached is not None:
+            return acq, None, cached
+        return fetch_acquisition(client, acq, skip_example_dcm=skip_example_dcm) + (None,)
+
+    with ThreadPoolExecutor(max_workers=max(jobs, 1)) as pool:
+        # map() yields results in submission order
+        fetched = pool.map(fetch, acquisitions) if jobs > 1 else map(fetch, acquisitions)
+        for acquisition, zip_info, cached in fetched:
+            context['acquisition'] = acquisition
+
+            if cached is not None:
+                num_dicoms, cached_infos = cached
+                context['total'] += num_dicoms
+                infos = [info._replace(total_files_till_now=context['total'],
+                                       patient_id=context['subject'].label)
+                         for info in cached_infos]
+            else:
+                total_before = context['total']
+                infos = acquisition_to_heudiconv(client, acquisition, context,
+                                                 zip_info, fetch_zip=False)
+                # SeqInfos without the zip info are only right until it can
+                # be read again, so they aren't cached
+                if cache is not None and not zip_info_missing(acquisition, zip_info):
+                    cache.put(acquisition, context['total'] - total_before, infos,
+                              complete=not skip_example_dcm)
+
+            for info in infos:
+                log.debug('info: %s', info)
+                seq_info[info] = {}  # This would be set to a list of filepaths in heudiconv
     log.debug('session=%s', session.label)
     log.debug('Got %s seqinfos', len(seq_info.keys()))
     return seq_info
 
 
+def prefetch_acquisitions(client, project_object, sessions, whole_project=False):
+    """Pull the acquisitions of a selection of sessions in bulk
+
+    Instead of one request per session and one per acquisition, the
+    acquisitions (including their file info) are paged through in a few large
+    requests: per session for small selections, by chunks of sessions for
+    larger ones, and project-wide only when every session is selected.
+
+    Args:
+        client (Client): The flywheel client
+        project_object (Project): The project the sessions belong to
+        sessions (list): The sessions to prefetch
+        whole_project (bool): Whether ``sessions`` are all of the project's
+
+    Returns:
+        OrderedDict: session id -> list of acquisitions, in session order,
+            each sorted by :func:`acquisition_order`
+    """
+    index = collections.OrderedDict((s.id, []) for s in sessions)
+    if not index:
+        return index
+
+    session_ids = list(index)
+    if len(index) <= PREFETCH_SESSION_LIMIT:
+        filters = ['parents.session={}'.format(s_id) for s_id in session_ids]
+    elif whole_project:
+        filters = ['parents.project={}'.format(project_object.id)]
+    else:
+        chunks = [session_ids[i:i + PREFETCH_CHUNK_SIZE]
+                  for i in range(0, len(session_ids), PREFETCH_CHUNK_SIZE)]
+        filters = ['parents.session=|[{}]'.format(','.join(chunk)) for chunk in chunks]
+
+    for query in filters:
+        for acq in client.acquisitions.iter_find(query, include_all_info=True):
+            if acq.parents.session in index:
+                index[acq.parents.session].append(acq)
+    for acquisitions in index.values():
+        acquisitions.sort(key=acquisition_order)
+    # the index holds them for the run anyway, so the cache may as well
+    remember(client, *(acq for acquisitions in index.values() for acq in acquisitions),
+             grow=True)
+
+    log.debug('Prefetched %d acquisitions for %d sessions',
+              sum(len(v) for v in index.values()), len(index))
+    return index
+
+
 def get_sessions(client, project, subject=None, session=None):
     """Query the flywheel client for a project name
     This function uses the flywheel API to find the first match of a project
@@ -167,7 +435,7 @@ def get_sessions(client, project, subject=None, session=None):
     seq_infos
         A list of SeqInfo objects
     """
-    project_object = client.projects.find_first('label={0}'.format(project))
+    project_object = find_project(client, project)
     context = {'project': project_object}   # what is this?
 
     if project_object is None:
@@ -187,23 +455,154 @@ def get_sessions(client, project, subject=None, session=None):
     return sessions
 
 
-def get_seq_info(client, project, sessions, grouping=None):
+def iter_seq_info(client, project, sessions, index=None, jobs=1, cache=None,
+                  skip_example_dcm=False, field_usage=None, buffer=SESSION_BUFFER,
+                  return_errors=False, retries=RETRIES, log_buffer=None):
+    """Yield the SeqInfos of each session as soon as it has been queried
+
+    Sessions are queried in a background thread that runs up to ``buffer``
+    sessions ahead of the consumer, so querying the next session overlaps
+    with whatever is done with the current one, while memory stays bounded.
+
+    Args:
+        client (Client): The flywheel client
+        project (str): The project label
+        sessions (list): The sessions to query
+        index (dict): The output of prefetch_acquisitions. If None, the
+            acquisitions of all sessions are prefetched here
+        jobs (int): Number of acquisitions per session to fetch concurrently
+        cache (SeqInfoCache): On-disk cache of previously built SeqInfos
+        skip_example_dcm (bool): Leave ``example_dcm_file`` empty
+        field_usage (FieldUsage): Build LazySeqInfos recording their reads
+        buffer (int): Number of sessions to query ahead; 0 queries each
+            session only when it is asked for
+        return_errors (bool): Yield the exception of a session that couldn't
+            be queried in place of its seq info, and go on with the next
+            one, instead of stopping
+        retries (int): Times to try the prefetch and each session's query
+            when they hit transient API errors
+        log_buffer (BufferedLog): If given, what is logged while querying a
+            session is stashed under its id, to be emitted with the rest of
+            the session's log
+
+    Yields:
+        tuple: (session, OrderedDict of seq info objects), in session order
+    """
+
+    project_object = find_project(client, project)
+    if index is None:
+        with stage('prefetch'):
+            index = retry(prefetch_acquisitions, client, project_object, sessions,
+                          attempts=retries)
+
+    def query(session):
+        if log_buffer is None:
+            return query_session(session)
+        with log_buffer.stash(session.id):
+            return query_session(session)
+
+    def query_session(session):
+        context = {'project': project_object,
+                   'subject': session.subject,
+                   'session': session}
+        with stage('get_seq_info'):
+            try:
+                # the query only reads, so it is safe to repeat
+                return retry(session_to_seq_info, client, session, context,
+                             index.get(session.id, []), jobs, cache,
+                             skip_example_dcm, field_usage, attempts=retries)
+            except Exception as e:
+                if not return_errors:
+                    raise
+                log.error("Failed to query session %s: %s", session.label, e)
+                return e
+
+    if buffer < 1:
+        for session in sessions:
+            yield session, query(session)
+        return
+
+    done = object()
+    results = queue.Queue(maxsize=buffer)
+    stop = threading.Event()
 
-    project_object = client.projects.find_first('label={0}'.format(project))
-    context = {'project': project_object}
+    def put(item):
+        # give up if the consumer went away rather than blocking forever
+        while not stop.is_set():
+            try:
+                results.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
 
-    seq_infos = collections.OrderedDict()
-    for session in sessions:
-        session = client.get(session.id)
-        context['subject'] = session.subject
-        context['session'] = session
+    def produce():
+        try:
+            for session in sessions:
+                if stop.is_set() or not put((session, query(session), None)):
+                    return
+        except Exception as e:
+            put((None, None, e))
+            return
+        put((done, None, None))
+
+    producer = threading.Thread(target=produce, name='fw-heudiconv-query', daemon=True)
+    producer.start()
+    try:
+        while True:
+            session, seq_info, error = results.get()
+            if error is not None:
+                raise error
+            if session is done:
+                return
+            yield session, seq_info
+    finally:
+        stop.set()
+        producer.join()
+
+
+def get_seq_info(client, project, sessions, grouping=None, index=None, jobs=1,
+                 cache=None, skip_example_dcm=False, field_usage=None):
+    """Build the SeqInfo objects for a list of sessions
+
+    Args:
+        client (Client): The flywheel client
+        project (str): The project label
+        sessions (list): The sessions to query
+        grouping (str): If None, return every SeqInfo in one flat
+            SeqInfoTable (an OrderedDict of LazySeqInfos if ``field_usage``
+            is given), otherwise an OrderedDict of each session's SeqInfos
+            keyed by session id
+        index (dict): The output of prefetch_acquisitions. If None, the
+            acquisitions of all sessions are prefetched here
+        jobs (int): Number of acquisitions per session to fetch concurrently
+        cache (SeqInfoCache): On-disk cache of previously built SeqInfos
+        skip_example_dcm (bool): Leave ``example_dcm_file`` empty
+        field_usage (FieldUsage): Build LazySeqInfos recording their reads
+
+    Returns:
+        SeqInfoTable or OrderedDict: The seq info objects
+    """
+    # imported here to avoid a circular import with seqinfo_table
+    from fw_heudiconv.backend_funcs.seqinfo_table import SeqInfoTable
+
+    if grouping is None and field_usage is None:
+        seq_infos = SeqInfoTable()
+    else:
+        seq_infos = collections.OrderedDict()
+    for session, session_infos in iter_seq_info(client, project, sessions, index=index,
+                                                jobs=jobs, cache=cache,
+                                                skip_example_dcm=skip_example_dcm,
+                                                field_usage=field_usage, buffer=0):
         if grouping is None:
             # All seq infos should be top level if there is no grouping
-            for key, val in session_to_seq_info(client, session, context).items():
-                seq_infos[key] = val
+            if isinstance(seq_infos, SeqInfoTable):
+                seq_infos.extend(session_infos)
+            else:
+                seq_infos.update(session_infos)
         else:
             # For now only supports grouping with session
-            seq_infos[session.id] = session_to_seq_info(client, session, context)
+            seq_infos[session.id] = session_infos
 
     return seq_infos
 
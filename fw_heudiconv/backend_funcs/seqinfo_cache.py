@@ -0,0 +1,181 @@
+import os
+import json
+import time
+import sqlite3
+import hashlib
+import logging
+import threading
+from fw_heudiconv.backend_funcs.query import seqinfo_info
+
+log = logging.getLogger(__name__)
+
+DEFAULT_CACHE_DIR = os.environ.get(
+    'FW_HEUDICONV_CACHE_DIR',
+    os.path.join(os.path.expanduser('~'), '.cache', 'fw-heudiconv'))
+
+# Files whose content or metadata feed into a SeqInfo
+FINGERPRINT_TYPES = ("dicom", "bvec", "bval", "nifti")
+
+# Suffix on the fingerprint of entries built without example_dcm_file
+INCOMPLETE = '-incomplete'
+
+
+def acquisition_fingerprint(acq):
+    """Hash the parts of an acquisition that a SeqInfo is built from
+
+    Any upload, deletion or replacement of a dicom or convertable file changes
+    its name, content hash or size, and the header fields a SeqInfo is read
+    from are hashed too, since they may be filled in or edited after upload.
+    So a matching fingerprint means the cached SeqInfos are still valid.
+    ``modified`` and the rest of the info aren't used: curation writes file
+    info, which changes them without changing anything a SeqInfo is built
+    from.
+    """
+    parts = sorted(
+        (f.name, f.type, f.get('hash'), f.get('size'),
+         json.dumps(seqinfo_info(f), sort_keys=True, default=str))
+        for f in acq.files if f.type in FINGERPRINT_TYPES)
+    return hashlib.sha1(json.dumps(parts).encode('utf-8')).hexdigest()
+
+
+class SeqInfoCache(object):
+    """An on-disk cache of the SeqInfos of each acquisition
+
+    Entries are keyed by acquisition id and only returned while the
+    acquisition's fingerprint is unchanged. The SeqInfos are stored without
+    their run context; ``total_files_till_now`` and ``patient_id`` are filled
+    in again when they're read back. Entries built without an
+    ``example_dcm_file`` are marked incomplete and only served to runs that
+    don't need it.
+
+    Args:
+        cache_dir (str): Directory holding the ``seqinfo.sqlite`` database
+    """
+
+    def __init__(self, cache_dir=DEFAULT_CACHE_DIR):
+        os.makedirs(cache_dir, exist_ok=True)
+        self.path = os.path.join(cache_dir, 'seqinfo.sqlite')
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(self.path, check_same_thread=False)
+        self._conn.execute(
+            'CREATE TABLE IF NOT EXISTS seqinfo ('
+            'acq_id TEXT PRIMARY KEY, fingerprint TEXT, num_dicoms INTEGER, '
+            'payload TEXT, size INTEGER, created REAL, accessed REAL)')
+        self._conn.commit()
+
+    def get(self, acq, complete=True):
+        """Look up an acquisition
+
+        Args:
+            acq (Acquisition): The acquisition, with its file info
+            complete (bool): Only accept entries that have ``example_dcm_file``
+
+        Returns:
+            tuple: (number of dicoms, list of SeqInfo), or None on a miss
+        """
+        # imported here to avoid a circular import with query
+        from fw_heudiconv.backend_funcs.query import SeqInfo
+
+        fingerprint = acquisition_fingerprint(acq)
+        accepted = (fingerprint, fingerprint if complete else fingerprint + INCOMPLETE)
+        with self._lock:
+            row = self._conn.execute(
+                'SELECT num_dicoms, payload FROM seqinfo '
+                'WHERE acq_id = ? AND fingerprint IN (?, ?)',
+                (acq.id, ) + accepted).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._conn.execute('UPDATE seqinfo SET accessed = ? WHERE acq_id = ?',
+                               (time.time(), acq.id))
+            self._conn.commit()
+
+        num_dicoms, payload = row
+        seqinfos = []
+        for values in json.loads(payload):
+            seqinfo = SeqInfo(*values)
+            seqinfos.append(seqinfo._replace(image_type=tuple(seqinfo.image_type)))
+        return num_dicoms, seqinfos
+
+    def put(self, acq, num_dicoms, seqinfos, complete=True):
+        """Store the SeqInfos built for an acquisition"""
+        payload = json.dumps([list(s) for s in seqinfos])
+        fingerprint = acquisition_fingerprint(acq)
+        if not complete:
+            fingerprint += INCOMPLETE
+        now = time.time()
+        with self._lock:
+            self._conn.execute(
+                'INSERT OR REPLACE INTO seqinfo VALUES (?, ?, ?, ?, ?, ?, ?)',
+                (acq.id, fingerprint, num_dicoms, payload,
+                 len(payload), now, now))
+            self._conn.commit()
+
+    def stats(self):
+        """Summarise the cache contents"""
+        with self._lock:
+            entries, size, oldest, newest = self._conn.execute(
+                'SELECT COUNT(*), COALESCE(SUM(size), 0), MIN(accessed), MAX(accessed) '
+                'FROM seqinfo').fetchone()
+        return {
+            'path': self.path,
+            'entries': entries,
+            'payload_bytes': size,
+            'file_bytes': os.path.getsize(self.path),
+            'oldest_access': oldest,
+            'newest_access': newest,
+        }
+
+    def prune(self, max_age_days):
+        """Drop entries that haven't been read for ``max_age_days`` days
+
+        Returns:
+            int: The number of entries removed
+        """
+        cutoff = time.time() - max_age_days * 86400
+        with self._lock:
+            removed = self._conn.execute(
+                'DELETE FROM seqinfo WHERE accessed < ?', (cutoff,)).rowcount
+            self._conn.commit()
+        self._vacuum()
+        return removed
+
+    def limit_size(self, max_bytes):
+        """Drop the least recently used entries until the payload fits in ``max_bytes``
+
+        Returns:
+            int: The number of entries removed
+        """
+        removed = 0
+        with self._lock:
+            total = self._conn.execute(
+                'SELECT COALESCE(SUM(size), 0) FROM seqinfo').fetchone()[0]
+            rows = self._conn.execute(
+                'SELECT acq_id, size FROM seqinfo ORDER BY accessed').fetchall()
+            for acq_id, size in rows:
+                if total <= max_bytes:
+                    break
+                self._conn.execute('DELETE FROM seqinfo WHERE acq_id = ?', (acq_id,))
+                total -= size
+                removed += 1
+            self._conn.commit()
+        self._vacuum()
+        return removed
+
+    def clear(self):
+        """Remove every entry"""
+        with self._lock:
+            self._conn.execute('DELETE FROM seqinfo')
+            self._conn.commit()
+        self._vacuum()
+
+    def _vacuum(self):
+        with self._lock:
+            self._conn.execute('VACUUM')
+
+    def close(self):
+        log.debug('SeqInfo cache: %d hits, %d misses', self.hits, self.misses)
+        self._conn.close()
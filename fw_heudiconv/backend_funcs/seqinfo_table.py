@@ -0,0 +1,163 @@
+import math
+import array
+import collections
+from fw_heudiconv.backend_funcs.query import SeqInfo, SEQINFO_FIELDS
+
+# Fields held in typed arrays; every other field is a list of interned values
+INT_FIELDS = ('total_files_till_now', 'dim1', 'dim2', 'dim3', 'dim4')
+FLOAT_FIELDS = ('TR', 'TE')
+BOOL_FIELDS = ('is_motion_corrected', 'is_derived')
+TYPECODES = dict([(f, 'q') for f in INT_FIELDS] +
+                 [(f, 'd') for f in FLOAT_FIELDS] +
+                 [(f, 'b') for f in BOOL_FIELDS])
+
+
+def _fits(typecode, value):
+    if typecode == 'q':
+        return isinstance(value, int) and not isinstance(value, bool)
+    if typecode == 'd':
+        return value is None or isinstance(value, (int, float)) and not isinstance(value, bool)
+    return isinstance(value, bool)
+
+
+class SeqInfoTable(object):
+    """SeqInfos stored column by column
+
+    Each file's SeqInfo costs a few array slots instead of a namedtuple and
+    its dict entry: numeric fields are kept in typed arrays and repeated
+    strings (protocol names, image types, patient ids...) are stored once.
+    A column that gets a value its array can't hold falls back to a list.
+
+    Rows are read through :class:`SeqInfoRow` views, which behave like
+    SeqInfo namedtuples, and iterating the table yields them in insertion
+    order. ``keys()`` and ``items()`` are there so heuristics written for the
+    OrderedDict returned by get_seq_info keep working.
+    """
+
+    def __init__(self, seqinfos=()):
+        self._columns = collections.OrderedDict(
+            (name, array.array(TYPECODES[name]) if name in TYPECODES else [])
+            for name in SEQINFO_FIELDS)
+        self._pool = {}
+        self.extend(seqinfos)
+
+    def _intern(self, value):
+        try:
+            return self._pool.setdefault(value, value)
+        except TypeError:
+            return value
+
+    def append(self, seqinfo):
+        for name, value in zip(SEQINFO_FIELDS, seqinfo):
+            column = self._columns[name]
+            if isinstance(column, array.array):
+                if _fits(column.typecode, value):
+                    column.append(float('nan') if value is None else value)
+                    continue
+                column = self._columns[name] = [self._column_value(name, v) for v in column]
+            column.append(self._intern(value))
+
+    def extend(self, seqinfos):
+        for seqinfo in seqinfos:
+            self.append(seqinfo)
+
+    def _column_value(self, name, value):
+        typecode = getattr(self._columns[name], 'typecode', None)
+        if typecode == 'd' and math.isnan(value):
+            return None
+        if typecode == 'b':
+            return bool(value)
+        return value
+
+    def value(self, index, name):
+        return self._columns[name][index] if name not in TYPECODES \
+            else self._column_value(name, self._columns[name][index])
+
+    def column(self, name):
+        """A column as a numpy array, without copying typed columns"""
+        import numpy as np
+        column = self._columns[name]
+        if isinstance(column, array.array):
+            dtype = {'q': np.int64, 'd': np.float64, 'b': np.bool_}[column.typecode]
+            return np.frombuffer(column, dtype=dtype) if len(column) else np.array([], dtype=dtype)
+        values = np.empty(len(column), dtype=object)
+        values[:] = column
+        return values
+
+    def to_dataframe(self):
+        """Build a DataFrame straight from the columns"""
+        import pandas as pd
+        return pd.DataFrame(collections.OrderedDict(
+            (name, self.column(name)) for name in SEQINFO_FIELDS))
+
+    def __len__(self):
+        return len(self._columns[SEQINFO_FIELDS[0]])
+
+    def __getitem__(self, index):
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError(index)
+        return SeqInfoRow(self, index)
+
+    def __iter__(self):
+        return (SeqInfoRow(self, i) for i in range(len(self)))
+
+    def keys(self):
+        return iter(self)
+
+    def values(self):
+        return ({} for _ in range(len(self)))
+
+    def items(self):
+        return ((row, {}) for row in self)
+
+    def __contains__(self, seqinfo):
+        return any(tuple(row) == tuple(seqinfo) for row in self)
+
+    def __repr__(self):
+        return 'SeqInfoTable({} rows)'.format(len(self))
+
+
+class SeqInfoRow(object):
+    """A read-only view of one row of a SeqInfoTable, used like a SeqInfo"""
+
+    __slots__ = ('_table', '_index')
+    _fields = tuple(SEQINFO_FIELDS)
+
+    def __init__(self, table, index):
+        self._table = table
+        self._index = index
+
+    def __getattr__(self, name):
+        if name not in SEQINFO_FIELDS:
+            raise AttributeError(name)
+        return self._table.value(self._index, name)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return tuple(self)[index]
+        return getattr(self, SEQINFO_FIELDS[index])
+
+    def __iter__(self):
+        return (self._table.value(self._index, name) for name in SEQINFO_FIELDS)
+
+    def __len__(self):
+        return len(SEQINFO_FIELDS)
+
+    def _asdict(self):
+        return collections.OrderedDict(zip(SEQINFO_FIELDS, self))
+
+    def _replace(self, **kwargs):
+        return SeqInfo(*self)._replace(**kwargs)
+
+    def __eq__(self, other):
+        if isinstance(other, (SeqInfoRow, tuple)):
+            return tuple(self) == tuple(other)
+        return NotImplemented
+
+    def __hash__(self):
+        return hash(tuple(self))
+
+    def __repr__(self):
+        return repr(SeqInfo(*self))
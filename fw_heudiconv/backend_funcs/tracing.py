@@ -0,0 +1,171 @@
+"""Finds where a command makes more Flywheel requests than it needs to
+
+:func:`trace` wraps the SDK's ``ApiClient.call_api`` to record every
+request with the line of fw-heudiconv (or heuristic) code that led to it
+and how long it took. :meth:`RequestTrace.report` then points out the same
+container being fetched over and over, and call sites making requests in
+a loop (the "N+1" pattern), where batching or caching would pay off.
+"""
+
+import os
+import sys
+import time
+import atexit
+import logging
+import threading
+from collections import Counter, defaultdict, namedtuple
+from fw_heudiconv.backend_funcs.metrics import call_type, get_api_client
+
+log = logging.getLogger(__name__)
+
+# Requests to the same container beyond this are reported as repeated
+REPEAT_THRESHOLD = 1
+
+# Frames in these files are not call sites worth reporting
+_PACKAGE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+_SKIP_FILES = tuple(os.path.join(_PACKAGE_DIR, 'backend_funcs', name) for name in
+                    ('tracing.py', 'metrics.py', 'limiter.py', 'container_cache.py',
+                     'utils.py'))
+
+Request = namedtuple('Request', ['call', 'resource', 'site', 'seconds'])
+
+
+def call_site(frame):
+    """The innermost frame of fw-heudiconv code, as ``file:line (function)``
+
+    Frames of the SDK and of wrappers like the container cache are skipped;
+    if no fw-heudiconv frame is found (e.g. in a heuristic loaded from a
+    URL), the innermost frame outside the SDK is used.
+    """
+    fallback = None
+    while frame is not None:
+        filename = frame.f_code.co_filename
+        if filename.startswith(_PACKAGE_DIR) and not filename.startswith(_SKIP_FILES):
+            break
+        if fallback is None and 'flywheel' not in filename and \
+                not filename.startswith(_SKIP_FILES) and 'threading' not in filename:
+            fallback = frame
+        frame = frame.f_back
+    frame = frame or fallback
+    if frame is None:
+        return '?'
+    filename = os.path.relpath(frame.f_code.co_filename, os.path.dirname(_PACKAGE_DIR)) \
+        if frame.f_code.co_filename.startswith(_PACKAGE_DIR) else frame.f_code.co_filename
+    return '{}:{} ({})'.format(filename, frame.f_lineno, frame.f_code.co_name)
+
+
+class RequestTrace(object):
+    """Every request a command made, with where it was made from
+
+    Args:
+        threshold (int): Report call sites making more requests than this
+    """
+
+    def __init__(self, threshold):
+        self.threshold = threshold
+        self.requests = []
+        self._lock = threading.Lock()
+
+    def record(self, call, resource, site, seconds):
+        with self._lock:
+            self.requests.append(Request(call, resource, site, seconds))
+
+    def repeated(self):
+        """Containers and files read more than once
+
+        Returns:
+            list: (call, resource, count, call sites), most repeated first
+        """
+        reads = defaultdict(Counter)
+        for r in self.requests:
+            if r.call in ('get', 'download_file', 'file_zip_info'):
+                reads[(r.call, r.resource)][r.site] += 1
+        repeats = [(call, resource, sum(sites.values()), sites)
+                   for (call, resource), sites in reads.items()
+                   if sum(sites.values()) > REPEAT_THRESHOLD]
+        return sorted(repeats, key=lambda repeat: -repeat[2])
+
+    def hot_sites(self):
+        """Call sites that made more than ``threshold`` requests
+
+        Returns:
+            list: (call site, count, seconds, calls by type), busiest first
+        """
+        sites = defaultdict(list)
+        for r in self.requests:
+            sites[r.site].append(r)
+        hot = [(site, len(requests), sum(r.seconds for r in requests),
+                Counter(r.call for r in requests))
+               for site, requests in sites.items() if len(requests) > self.threshold]
+        return sorted(hot, key=lambda site: -site[1])
+
+    def report(self, logger=log, limit=20):
+        with self._lock:
+            total = len(self.requests)
+            seconds = sum(r.seconds for r in self.requests)
+        logger.info("{:=^70}".format(": Request trace :"))
+        logger.info("%d requests in %.1fs", total, seconds)
+
+        repeated = self.repeated()
+        if repeated:
+            wasted = sum(count - 1 for _, _, count, _ in repeated)
+            logger.info("%d containers or files were requested more than once "
+                        "(%d extra requests):", len(repeated), wasted)
+            for call, resource, count, sites in repeated[:limit]:
+                logger.info("  %5d x %s %s from %s", count, call, resource,
+                            ", ".join(site for site, _ in sites.most_common(3)))
+
+        hot = self.hot_sites()
+        if hot:
+            logger.info("%d call sites made more than %d requests:", len(hot), self.threshold)
+            for site, count, seconds, calls in hot[:limit]:
+                logger.info("  %5d requests, %6.1fs  %s  [%s]", count, seconds, site,
+                            ", ".join('{} {}'.format(n, c) for c, n in calls.most_common()))
+        if not repeated and not hot:
+            logger.info("No repeated fetches or call sites above %d requests", self.threshold)
+
+
+def _resource(resource_path, path_params):
+    """The request path with its parameters filled in, e.g. /containers/<id>"""
+    try:
+        return resource_path.format(**dict(path_params or {}))
+    except (KeyError, IndexError, ValueError):
+        return resource_path
+
+
+def trace(client, threshold):
+    """Record every request the client's SDK makes from now on
+
+    Args:
+        client (Client): The flywheel sdk client, possibly wrapped
+        threshold (int): Report call sites making more requests than this
+
+    Returns:
+        RequestTrace: The trace, or None if the client can't be traced
+    """
+    api_client = get_api_client(client)
+    if api_client is None:
+        log.warning("This client can't be traced")
+        return None
+    request_trace = RequestTrace(threshold)
+    call_api = api_client.call_api
+
+    def traced_call_api(resource_path, method, path_params=None, query_params=None,
+                        *args, **kwargs):
+        site = call_site(sys._getframe(1))
+        start = time.time()
+        try:
+            return call_api(resource_path, method, path_params, query_params,
+                            *args, **kwargs)
+        finally:
+            request_trace.record(call_type(method, resource_path, query_params),
+                                 _resource(resource_path, path_params), site,
+                                 time.time() - start)
+
+    api_client.call_api = traced_call_api
+    return request_trace
+
+
+def report_at_exit(request_trace, logger=log):
+    """Log the trace's report however the command exits"""
+    atexit.register(request_trace.report, logger)
@@ -0,0 +1,149 @@
+"""Small helpers shared by the backend and the CLIs
+
+Kept free of third-party imports so every command can use them without
+paying for flywheel or pandas at startup.
+"""
+
+import time
+import random
+import functools
+import logging
+import threading
+from contextlib import contextmanager
+
+log = logging.getLogger(__name__)
+
+# HTTP statuses worth retrying: rate limiting and gateway/server hiccups
+TRANSIENT_STATUS = (429, 500, 502, 503, 504)
+
+# How many times a call that hits transient errors is tried
+RETRIES = 3
+
+
+def get_nested(dct, *keys):
+    for key in keys:
+        try:
+            dct = dct[key]
+        except (KeyError, TypeError):
+            return None
+    return dct
+
+
+def is_transient(error):
+    """Whether an error from the Flywheel API is likely to go away on retry"""
+    if isinstance(error, (ConnectionError, TimeoutError)):
+        return True
+    if getattr(error, 'status', None) in TRANSIENT_STATUS:
+        return True
+    try:
+        import requests
+    except ImportError:
+        return False
+    return isinstance(error, (requests.ConnectionError, requests.Timeout))
+
+
+def retry(func, *args, attempts=RETRIES, backoff=2.0, **kwargs):
+    """Call ``func``, retrying with exponential backoff on transient errors
+
+    Only use it for calls that can safely be repeated.
+
+    Args:
+        func (callable): The call to make
+        attempts (int): How many times to try before giving up
+        backoff (float): Seconds to wait after the first failure; doubled
+            after each further one, with some jitter
+
+    Returns:
+        Whatever ``func`` returns
+    """
+    for attempt in range(1, attempts + 1):
+        try:
+            return func(*args, **kwargs)
+        except Exception as e:
+            if attempt == attempts or not is_transient(e):
+                raise
+            delay = backoff * 2 ** (attempt - 1) * random.uniform(0.5, 1.5)
+            log.warning("Transient error (%s); retrying in %.1fs (%d/%d)", e, delay,
+                        attempt, attempts - 1)
+            time.sleep(delay)
+
+
+class BufferedLog(object):
+    """Holds back log records per thread so they can be emitted together
+
+    While a thread is inside :meth:`buffer`, every record it logs, from any
+    module, is kept instead of emitted and then emitted as one uninterrupted
+    block when it leaves. Other threads log as usual. Records are held at the
+    handlers of ``logger`` (by default the root logger, which every logger
+    propagates to), so those of the backend modules are buffered too.
+
+    What another thread logs for the same work, like a session queried ahead
+    in the background, can be held with :meth:`stash` and is then emitted at
+    the start of the block of a :meth:`buffer` with the same key.
+
+    Args:
+        logger (Logger): The logger whose handlers' records are buffered
+    """
+
+    def __init__(self, logger=None):
+        self.logger = logger or logging.getLogger()
+        self._local = threading.local()
+        self._flush_lock = threading.Lock()
+        self._filters = []
+        self._stashed = {}
+
+    def _hold(self, handler, record):
+        records = getattr(self._local, 'records', None)
+        if records is None:
+            return True
+        records.append((handler, record))
+        return False
+
+    @contextmanager
+    def buffer(self, key=None):
+        with self._flush_lock:
+            self._local.records = self._stashed.pop(key, []) if key is not None else []
+        try:
+            yield
+        finally:
+            records, self._local.records = self._local.records, None
+            with self._flush_lock:
+                for handler, record in records:
+                    handler.handle(record)
+
+    @contextmanager
+    def stash(self, key):
+        """Hold back what this thread logs until a buffer of ``key`` is emitted"""
+        self._local.records = []
+        try:
+            yield
+        finally:
+            records, self._local.records = self._local.records, None
+            with self._flush_lock:
+                self._stashed.setdefault(key, []).extend(records)
+
+    def install(self):
+        """Start holding back the records of threads inside :meth:`buffer`"""
+        for handler in self.logger.handlers:
+            hold = logging.Filter()
+            hold.filter = functools.partial(self._hold, handler)
+            handler.addFilter(hold)
+            self._filters.append((handler, hold))
+
+    def uninstall(self):
+        """Stop holding records back, emitting any stash no buffer took up"""
+        for handler, hold in self._filters:
+            handler.removeFilter(hold)
+        self._filters = []
+        with self._flush_lock:
+            stashed, self._stashed = self._stashed, {}
+            for records in stashed.values():
+                for handler, record in records:
+                    handler.handle(record)
+
+    def __enter__(self):
+        self.install()
+        return self
+
+    def __exit__(self, *exc):
+        self.uninstall()
@@ -0,0 +1,102 @@
+import sys
+import time
+import argparse
+import logging
+from fw_heudiconv.backend_funcs.seqinfo_cache import SeqInfoCache, DEFAULT_CACHE_DIR
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger('fw-heudiconv-cache')
+
+
+def format_time(timestamp):
+
+    if timestamp is None:
+        return "never"
+    return time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(timestamp))
+
+
+def manage_cache(cache_dir, prune_days=None, max_size=None, clear=False):
+    """Inspect, prune and size-limit the local SeqInfo cache
+
+    Args:
+        cache_dir (str): Directory of the cache
+        prune_days (float): Drop entries not read for this many days
+        max_size (float): Drop least recently used entries until the cache
+            holds at most this many megabytes
+        clear (bool): Remove every entry
+    """
+
+    cache = SeqInfoCache(cache_dir)
+
+    if clear:
+        logger.info("Clearing the cache...")
+        cache.clear()
+    if prune_days is not None:
+        removed = cache.prune(prune_days)
+        logger.info("Pruned %d entries not used in %s days", removed, prune_days)
+    if max_size is not None:
+        removed = cache.limit_size(int(max_size * 1024 * 1024))
+        logger.info("Removed %d entries to fit in %s MB", removed, max_size)
+
+    stats = cache.stats()
+    cache.close()
+
+    logger.info("Cache: %s", stats['path'])
+    logger.info("\tEntries: %d", stats['entries'])
+    logger.info("\tSize on disk: %.1f MB", stats['file_bytes'] / 1024 / 1024)
+    logger.info("\tOldest access: %s", format_time(stats['oldest_access']))
+    logger.info("\tNewest access: %s", format_time(stats['newest_access']))
+
+    return 0
+
+
+def get_parser():
+
+    parser = argparse.ArgumentParser(
+        description="Inspect and maintain the local SeqInfo cache used by curate and tabulate")
+    parser.add_argument(
+        "--cache-dir",
+        help="Directory of the local SeqInfo cache",
+        default=DEFAULT_CACHE_DIR
+    )
+    parser.add_argument(
+        "--prune-days",
+        help="Remove entries that haven't been used in this many days",
+        type=float,
+        default=None
+    )
+    parser.add_argument(
+        "--max-size",
+        help="Remove least recently used entries until the cache is at most this many MB",
+        type=float,
+        default=None
+    )
+    parser.add_argument(
+        "--clear",
+        help="Remove every entry from the cache",
+        action='store_true',
+        default=False
+    )
+
+    return parser
+
+
+def main():
+
+    logger.info("{:=^70}\n".format(": fw-heudiconv cache manager starting up :"))
+
+    parser = get_parser()
+    args = parser.parse_args()
+
+    status = manage_cache(cache_dir=args.cache_dir,
+                          prune_days=args.prune_days,
+                          max_size=args.max_size,
+                          clear=args.clear)
+
+    logger.info("Done!")
+    logger.info("{:=^70}".format(": Exiting fw-heudiconv cache manager :"))
+    sys.exit(status)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,12 +1,12 @@
 import argparse
-import flywheel
 import logging
 import warnings
 import sys
-
-with warnings.catch_warnings():
-    warnings.simplefilter('ignore')
-    from fw_heudiconv.cli.export import get_nested
+from fw_heudiconv.backend_funcs.utils import get_nested
+from fw_heudiconv.backend_funcs.metrics import stage, instrument, write_at_exit
+from fw_heudiconv.backend_funcs.tracing import trace, report_at_exit
+from fw_heudiconv.backend_funcs.limiter import limit_requests, DEFAULT_MAX_IN_FLIGHT
+from fw_heudiconv.backend_funcs.container_cache import CachedClient, find_project, invalidate, log_cache_stats
 
 
 logging.basicConfig(level=logging.INFO)
@@ -20,7 +20,7 @@ def clear_bids(client, project_label, session_labels=None, subject_labels=None,
 
     with warnings.catch_warnings():
         warnings.simplefilter("ignore")
-        project_obj = client.projects.find_first('label="{}"'.format(project_label))
+        project_obj = find_project(client, project_label)
 
     if project_obj is None:
         logger.error("Project not found! Maybe check spelling...?")
@@ -84,6 +84,7 @@ def clear_bids(client, project_label, session_labels=None, subject_labels=None,
                         BIDS = get_nested(fi, 'info', 'BIDS')
                         new_bids = {k:'' for k,v in BIDS.items()}
                         acq.update_file_info(fi['name'], {'BIDS': new_bids})
+                    invalidate(client, k)
 
         else:
             logger.info("Disable `dry_run` mode to apply these changes and remove the BIDS information.")
@@ -128,6 +129,27 @@ def get_parser():
         action='store_true',
         default=False
     )
+    parser.add_argument(
+        "--metrics-out",
+        help="On exit, write stage and Flywheel API call counts and timings to this "
+             "JSON file, and in Prometheus format to a .prom file next to it",
+        default=None
+    )
+    parser.add_argument(
+        "--trace-requests",
+        help="Trace every Flywheel request and report containers fetched repeatedly "
+             "and call sites making more than this many requests",
+        type=int,
+        metavar='N',
+        default=None
+    )
+    parser.add_argument(
+        "--max-in-flight",
+        help="Most Flywheel writes and transfers to have in flight; the actual number "
+             "adapts to how the server responds",
+        type=int,
+        default=DEFAULT_MAX_IN_FLIGHT
+    )
     parser.add_argument(
         "--api-key",
         help="API Key",
@@ -146,23 +168,35 @@ def main():
 
     with warnings.catch_warnings():
         warnings.simplefilter("ignore")
+        import flywheel
         if args.api_key:
             fw = flywheel.Client(args.api_key)
         else:
             fw = flywheel.Client()
     assert fw, "Your Flywheel CLI credentials aren't set!"
+    fw = CachedClient(fw)
+    if args.metrics_out:
+        instrument(fw)
+        write_at_exit(args.metrics_out, 'clear')
+    if args.trace_requests is not None:
+        request_trace = trace(fw, args.trace_requests)
+        if request_trace is not None:
+            report_at_exit(request_trace, logger)
+    limit_requests(fw, args.max_in_flight)
 
     # Print a lot if requested
     if args.verbose:
         logger.setLevel(logging.DEBUG)
 
     project_label = ' '.join(args.project)
-    status = clear_bids(client=fw,
-                    project_label=project_label,
-                    session_labels=args.session,
-                    subject_labels=args.subject,
-                    dry_run=args.dry_run)
-
+    with stage('clear_bids'):
+        status = clear_bids(client=fw,
+                        project_label=project_label,
+                        session_labels=args.session,
+                        subject_labels=args.subject,
+                        dry_run=args.dry_run)
+
+    log_cache_stats(fw, logger)
     logger.info("Done!")
     logger.info("{:=^70}".format(": Exiting fw-heudiconv clearer :"))
     sys.exit(status)
@@ -1,17 +1,30 @@
-import os
 import sys
-import importlib
 import argparse
 import warnings
-import flywheel
+import time
 import pprint
-import validators
-import requests
-from collections import defaultdict
-from fw_heudiconv.backend_funcs.convert import apply_heuristic, confirm_intentions, confirm_bids_namespace, verify_attachment, upload_attachment
-from fw_heudiconv.backend_funcs.query import get_seq_info
-from heudiconv import utils
+import threading
+from collections import defaultdict, OrderedDict, Counter
+from concurrent.futures import ThreadPoolExecutor
+from fw_heudiconv.backend_funcs.convert import apply_heuristic, plan_bids_paths, verify_updates, confirm_bids_namespace, verify_attachment, upload_attachment
+from fw_heudiconv.backend_funcs.seqinfo_cache import SeqInfoCache, DEFAULT_CACHE_DIR
+from fw_heudiconv.backend_funcs.incremental import CurationState, default_state_path
+from fw_heudiconv.backend_funcs.plan import PlanWriter, read_plan, apply_plan
+from fw_heudiconv.backend_funcs.intentions import IntentionIndex
+from fw_heudiconv.backend_funcs.checkpoint import CheckpointJournal, CheckpointError, default_checkpoint_path
+from fw_heudiconv.backend_funcs.heuristics import (
+    load_heuristic, apply_rules, memoize_heuristic, MemoizedHeuristic)
+from fw_heudiconv.backend_funcs.seqinfo_table import SeqInfoTable
+from fw_heudiconv.backend_funcs.query import iter_seq_info, prefetch_acquisitions
+from fw_heudiconv.backend_funcs.lazy_seqinfo import (
+    FieldUsage, heuristic_hash, load_field_usage, save_field_usage, record_field_usage,
+    peek_field)
 import logging
+from fw_heudiconv.backend_funcs.container_cache import CachedClient, find_project, invalidate, log_cache_stats
+from fw_heudiconv.backend_funcs.utils import BufferedLog, retry, RETRIES
+from fw_heudiconv.backend_funcs.metrics import stage, instrument, write_at_exit
+from fw_heudiconv.backend_funcs.tracing import trace, report_at_exit
+from fw_heudiconv.backend_funcs.limiter import limit_requests, DEFAULT_MAX_IN_FLIGHT
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger('fw-heudiconv-curator')
@@ -24,9 +37,11 @@ def pretty_string_seqinfo(seqinfo):
           'shape=({dim1}, {dim2}, {dim3}, {dim4}) ' \
           'image_type={image_type}] ({idnum})\n'
     try:
+        # lazy dims that haven't been fetched are shown as "?"
+        dims = [peek_field(seqinfo, d) for d in ('dim1', 'dim2', 'dim3', 'dim4')]
         rep_fmt = rep.format(protocol_name=seqinfo.protocol_name, tr=tr,
-                             te=te, dim1=seqinfo.dim1, dim2=seqinfo.dim2,
-                             dim3=seqinfo.dim3, dim4=seqinfo.dim4,
+                             te=te, dim1=dims[0], dim2=dims[1],
+                             dim3=dims[2], dim4=dims[3],
                              image_type=seqinfo.image_type,
                              idnum=seqinfo.series_id)
     except Exception as e:
@@ -36,7 +51,12 @@ def pretty_string_seqinfo(seqinfo):
 
 
 def convert_to_bids(client, project_label, heuristic_path, subject_labels=None,
-                    session_labels=None, dry_run=False):
+                    session_labels=None, dry_run=False, jobs=1,
+                    cache=None, skip_example_dcm=False, lazy=False,
+                    cache_dir=DEFAULT_CACHE_DIR, incremental=False, full=False,
+                    state_file=None, session_jobs=1, plan_out=None, offline=False,
+                    memoize=False, resume=False, restart=False, checkpoint=None,
+                    retries=RETRIES):
     """Converts a project to bids by reading the file entries from flywheel
     and using the heuristics to write back to the BIDS namespace of the flywheel
     containers
@@ -49,70 +69,395 @@ def convert_to_bids(client, project_label, heuristic_path, subject_labels=None,
         subject_code (str): The subject code
         session_label (str): The session label
         dry_run (bool): Print the changes, don't apply them on flywheel
+        jobs (int): Number of acquisitions to query concurrently
+        cache (SeqInfoCache): On-disk cache of previously built SeqInfos
+        skip_example_dcm (bool): Don't look up example_dcm_file
+        lazy (bool): Only fetch the SeqInfo fields the heuristic reads, and
+            remember them for the next run of the same heuristic
+        cache_dir (str): Where the heuristic's field usage, compiled
+            heuristics and fetched heuristic URLs are kept
+        incremental (bool): Only curate sessions that are new or changed
+            since the last incremental run
+        full (bool): With ``incremental``, curate every session and record
+            a fresh state
+        state_file (str): The incremental state file; defaults to one per
+            project in ``cache_dir``
+        session_jobs (int): Number of sessions to curate concurrently
+        plan_out (str): Write the file info changes to this JSON lines file
+            for a later ``--apply``, instead of making them
+        offline (bool): Only load heuristic URLs from the local cache
+        memoize (bool): Call the heuristic once per distinct SeqInfo
+            signature, unless it sets ``CACHEABLE = False`` or ``lazy`` is set
+        resume (bool): Continue an interrupted run from its checkpoint,
+            skipping the sessions it finished
+        restart (bool): Discard an interrupted run's checkpoint
+        checkpoint (str): The checkpoint journal; defaults to one per
+            project and subject/session selection in ``cache_dir``
+        retries (int): Times to try the prefetch, and the query and
+            curation of a session, when they hit transient API errors
+
+    Returns:
+        list: A summary of each session curated
     """
 
     # Make sure we can find the heuristic
     logger.info("Loading heuristic file...")
     try:
+        with stage('load_heuristic'):
+            heuristic, heuristic_source = load_heuristic(heuristic_path, cache_dir=cache_dir,
+                                                         offline=offline)
+    except ModuleNotFoundError as e:
+        logger.error("Couldn't load the specified heuristic file!")
+        logger.error(e)
+        sys.exit(1)
+
+    logger.info("Heuristic loaded successfully!")
 
-        if os.path.isfile(heuristic_path):
-            heuristic = utils.load_heuristic(heuristic_path)
+    heuristic_id = heuristic_hash(heuristic_source)
+    field_usage = None
+    if lazy:
+        field_usage = FieldUsage(load_field_usage(cache_dir, heuristic_id))
+        logger.debug("Fields this heuristic read on previous runs: %s",
+                     sorted(field_usage.known))
 
-        elif "github" in heuristic_path and validators.url(heuristic_path):
+    if memoize:
+        heuristic = memoize_heuristic(heuristic, lazy)
 
-            # read from github
+    plan = None
+    if plan_out:
+        dry_run = True
+        plan = PlanWriter(plan_out)
+
+    # with several sessions curated at once, each session's log, including
+    # what was logged while it was queried, is held back and written as one
+    # block when the session finishes, so concurrent sessions don't interleave
+    session_log = BufferedLog() if session_jobs > 1 else None
+
+    # the plan is written in full when the run ends, however early, and
+    # not at all if it fails
+    try:
+        if session_log is not None:
+            session_log.install()
+        if dry_run:
+            logger.setLevel(logging.DEBUG)
+
+        logger.info("Querying Flywheel server...")
+        project_obj = find_project(client, project_label)
+        assert project_obj, "Project not found! Maybe check spelling...?"
+        logger.debug('Found project: %s (%s)', project_obj['label'], project_obj.id)
+        project_obj = confirm_bids_namespace(project_obj, dry_run)
+        invalidate(client, project_obj.id)
+
+        sessions = client.get_project_sessions(project_obj.id)
+        project_sessions = {s.id: s for s in sessions}
+        project_session_ids = set(project_sessions)
+        # filters
+        if subject_labels:
+            sessions = [s for s in sessions if s.subject['label'] in subject_labels]
+        if session_labels:
+            sessions = [s for s in sessions if s.label in session_labels]
+
+        assert sessions, "No sessions found!"
+
+        state = None
+        if incremental:
+            state = CurationState(state_file or default_state_path(cache_dir, project_obj.id),
+                                  project_obj.id, heuristic_id, full=full)
+            if state.is_incremental:
+                num_found = len(sessions)
+                sessions = state.candidate_sessions(client, sessions)
+                logger.info("%d of %d sessions are new or modified since %s",
+                            len(sessions), num_found, state.mark)
+            if not sessions:
+                logger.info("Nothing to curate!")
+                return []
+
+        # a checkpoint lets an interrupted run pick up where it stopped
+        journal = None
+        resumed = []
+        if not dry_run:
             try:
-                response = requests.get(heuristic_path)
+                journal = CheckpointJournal(
+                    checkpoint or default_checkpoint_path(cache_dir, project_obj.id,
+                                                          subject_labels, session_labels),
+                    project_obj.id, heuristic_id, resume=resume, restart=restart)
+            except CheckpointError as e:
+                logger.error(e)
+                sys.exit(1)
+            if journal.done:
+                # they still go in the incremental state, once prefetched
+                if state is not None:
+                    resumed = [s for s in sessions if s.id in journal.done]
+                sessions = [s for s in sessions if s.id not in journal.done]
+                logger.info("Skipping %d sessions the interrupted run finished",
+                            len(journal.done))
+            if not sessions and not journal.held and not resumed:
+                journal.close(finished=True)
+                logger.info("Nothing to curate!")
+                return []
+
+        logger.debug('Found sessions:\n\t%s',
+                     "\n\t".join(['%s (%s)' % (ses['label'], ses.id) for ses in sessions]))
 
-                if response.ok:
+        # try subject/session label functions
+        if hasattr(heuristic, "ReplaceSubject"):
+            subject_rename = heuristic.ReplaceSubject
+        else:
+            subject_rename = None
+        if hasattr(heuristic, "ReplaceSession"):
+            session_rename = heuristic.ReplaceSession
+        else:
+            session_rename = None
 
-                    name = 'heuristic'
-                    spec = importlib.util.spec_from_loader(name, loader=None)
+        # try attachments
+        if hasattr(heuristic, "AttachToProject"):
+            logger.info("Processing project attachments based on heuristic file")
 
-                    heuristic = importlib.util.module_from_spec(spec)
+            attachments = heuristic.AttachToProject()
 
-                    code = response.text
+            if not isinstance(attachments, list):
+                attachments = [attachments]
 
-                    exec(code, heuristic.__dict__)
+            for at in attachments:
 
-                else:
+                upload_attachment(
+                    client, project_obj, level='project', attachment_dict=at,
+                    subject_rename=subject_rename, session_rename=session_rename,
+                    folders=['anat', 'dwi', 'func', 'fmap', 'perf'],
+                    dry_run=dry_run
+                        )
 
-                    logger.error("Couldn't find a valid URL for this heuristic at:\n\n" + heuristic_path + "\n")
-                    raise ModuleNotFoundError
+        '''if hasattr(heuristic, "AttachToSubject"):
 
-            except:
-                logger.error("Trouble retrieving the URL!")
-                raise ModuleNotFoundError("Is this a valid URL to a heuristic on Github? Please check spelling!")
+            logger.info("Processing subject attachments based on heuristic file")
 
-        else:
-            heuristic = importlib.import_module('fw_heudiconv.example_heuristics.{}'.format(heuristic_path))
+            attachments = heuristic.AttachToSubject()
 
-    except ModuleNotFoundError as e:
-        logger.error("Couldn't load the specified heuristic file!")
-        logger.error(e)
-        sys.exit(1)
+            if not isinstance(attachments, list):
+                attachments = [attachments]
 
-    logger.info("Heuristic loaded successfully!")
+            for at in attachments:
 
-    if dry_run:
-        logger.setLevel(logging.DEBUG)
+                logger.debug(
+                "\tFilename: {}\n\tData: {}\n\tMIMEType: {}".format(
+                    at['name'], at['data'], at['type']
+                    )
+                )
 
-    logger.info("Querying Flywheel server...")
-    project_obj = client.projects.find_first('label="{}"'.format(project_label))
-    assert project_obj, "Project not found! Maybe check spelling...?"
-    logger.debug('Found project: %s (%s)', project_obj['label'], project_obj.id)
-    project_obj = confirm_bids_namespace(project_obj, dry_run)
+                verify_name, verify_data, verify_type = verify_attachment(at['name'], at['data'], at['type'])
 
-    sessions = client.get_project_sessions(project_obj.id)
-    # filters
-    if subject_labels:
-        sessions = [s for s in sessions if s.subject['label'] in subject_labels]
-    if session_labels:
-        sessions = [s for s in sessions if s.label in session_labels]
+                if not all([verify_name, verify_data, verify_type]):
 
-    assert sessions, "No sessions found!"
-    logger.debug('Found sessions:\n\t%s',
-                 "\n\t".join(['%s (%s)' % (ses['label'], ses.id) for ses in sessions]))
+                    logger.warning("Attachments may not be valid for upload!")
+                    logger.debug(
+                    "\tFilename valid: {}\n\tData valid: {}\n\tMIMEType valid: {}".format(
+                        verify_name, verify_data, verify_type
+                        )
+                    )
+
+                if not dry_run:
+                    subjects = [x.subject for x in sessions]
+                    file_spec = flywheel.FileSpec(at['name'], at['data'], at['type'])
+                    [sub.upload_file(file_spec) for sub in subjects]'''
+
+        # pull every acquisition of the selection up front
+        with stage('prefetch'):
+            index = retry(prefetch_acquisitions, client, project_obj, sessions + resumed,
+                          len(sessions) + len(resumed) == len(project_sessions),
+                          attempts=retries)
+
+        if state is not None:
+            for session in resumed:
+                state.mark_done(session, index[session.id])
+            # a filtered run can't vouch for the sessions it didn't look at, so
+            # only an unfiltered one moves the mark
+            if not (subject_labels or session_labels):
+                for acquisitions in index.values():
+                    state.observe(acquisitions)
+            unchanged = set(s.id for s in sessions if state.is_current(s, index[s.id]))
+            if unchanged:
+                logger.info("Skipping %d sessions that haven't changed since they were curated",
+                            len(unchanged))
+                sessions = [s for s in sessions if s.id not in unchanged]
+
+        # the next sessions are queried while the heuristic is applied to this one
+        session_seq_infos = iter_seq_info(client, project_label, sessions, index=index,
+                                          jobs=jobs, cache=cache,
+                                          skip_example_dcm=skip_example_dcm,
+                                          field_usage=field_usage, return_errors=True,
+                                          retries=retries, log_buffer=session_log)
+
+        # a heuristic with a rule table is evaluated over every session at once
+        decisions = {}
+        rules = getattr(heuristic, 'RULES', None)
+        if rules is not None:
+            logger.info("Evaluating the heuristic's %d rules over all sessions...", len(rules))
+            table = SeqInfoTable()
+            session_ids = []
+            queried = []
+            for session, seq_infos in session_seq_infos:
+                if isinstance(seq_infos, Exception):
+                    # reported as failed when the session is curated
+                    queried.append((session, seq_infos))
+                    continue
+                table.extend(seq_infos)
+                session_ids.extend([session.id] * len(seq_infos))
+                queried.append((session, None))
+            with stage('apply_rules'):
+                decisions = apply_rules(rules, table, session_ids)
+            session_seq_infos = queried
+            del table
+
+        # IntendedFor targets are checked against every indexed BIDS path
+        intentions = None
+        if hasattr(heuristic, "IntendedFor"):
+            intentions = IntentionIndex(project_obj.id,
+                                        (acq for acqs in index.values() for acq in acqs),
+                                        complete=project_session_ids <= set(index))
+            # targets held back by sessions the interrupted run finished
+            for held in journal.held if journal is not None else ():
+                if held['session'] in project_sessions:
+                    intentions.restore(project_sessions[held['session']], held)
+
+        num_sessions = len(sessions)
+        results = []
+
+        def curate(sesnum, session, seq_infos):
+            logger.info("Applying heuristic to %s (%d/%d)...", session.label, sesnum+1,
+                        num_sessions)
+            start = time.time()
+            try:
+                if isinstance(seq_infos, Exception):
+                    # the session couldn't be queried
+                    raise seq_infos
+                # only the writes that still differ are made, so a session that
+                # failed partway through is safe to curate again
+                counts = retry(curate_session, client, heuristic, session, seq_infos,
+                               dry_run, field_usage, plan,
+                               decisions.get(session.id, {}) if rules is not None else None,
+                               intentions, journal, attempts=retries)
+                status, error = 'ok', ''
+                if state is not None:
+                    state.mark_done(session, index[session.id])
+                if journal is not None:
+                    journal.session_done(session)
+            except Exception as e:
+                logger.exception("Failed to curate session %s", session.label)
+                counts, status, error = Counter(), 'failed', str(e)
+                if state is not None:
+                    state.mark_failed(session)
+            return OrderedDict([('session', session.label),
+                                ('subject', session.subject.label),
+                                ('status', status),
+                                ('new', counts['new']),
+                                ('updated', counts['updated']),
+                                ('unchanged', counts['unchanged']),
+                                ('seconds', time.time() - start),
+                                ('error', error)])
+
+        if session_log is not None:
+            with ThreadPoolExecutor(max_workers=session_jobs) as pool:
+
+                def curate_buffered(sesnum, session, seq_infos):
+                    with session_log.buffer(session.id):
+                        return curate(sesnum, session, seq_infos)
+
+                # only hand out a few sessions beyond what's being curated, so
+                # queried sessions don't pile up in memory
+                slots = threading.BoundedSemaphore(session_jobs * 2)
+                futures = []
+                for sesnum, (session, seq_infos) in enumerate(session_seq_infos):
+                    slots.acquire()
+                    future = pool.submit(curate_buffered, sesnum, session, seq_infos)
+                    future.add_done_callback(lambda f: slots.release())
+                    futures.append(future)
+                results = [f.result() for f in futures]
+        else:
+            for sesnum, (session, seq_infos) in enumerate(session_seq_infos):
+                results.append(curate(sesnum, session, seq_infos))
+                print("\n")
+
+        if intentions is not None:
+            with stage('intentions'):
+                intentions.finish(client, dry_run, plan, journal)
+
+        log_summary(results)
+        if isinstance(heuristic, MemoizedHeuristic):
+            logger.info("Heuristic decisions: %d computed, %d reused (%.0f%% hit rate)",
+                        heuristic.misses, heuristic.hits, 100 * heuristic.hit_rate())
+        if journal is not None:
+            journal.close(finished=all(r['status'] == 'ok' for r in results))
+
+        if state is not None and not dry_run:
+            state.save()
+            logger.info("Saved curation state to %s", state.path)
+
+        if field_usage is not None:
+            logger.debug("Fields read by the heuristic: %s", sorted(field_usage.fields))
+            save_field_usage(cache_dir, heuristic_id, field_usage.fields)
+
+        return results
+    except BaseException:
+        if plan is not None:
+            plan.discard()
+        raise
+    finally:
+        if session_log is not None:
+            session_log.uninstall()
+        if plan is not None:
+            plan.close()
+
+
+def curate_session(client, heuristic, session, seq_infos, dry_run=False, field_usage=None,
+                   plan=None, to_rename=None, intentions=None, journal=None):
+    """Apply a heuristic to one session's SeqInfos and write the results
+
+    Args:
+        client (Client): The flywheel sdk client
+        heuristic (module): The loaded heuristic
+        session (Session): The session being curated
+        seq_infos (OrderedDict): The session's SeqInfos
+        dry_run (bool): Print the changes, don't apply them on flywheel
+        field_usage (FieldUsage): Records the SeqInfo fields the heuristic reads
+        plan (PlanWriter): Receives the file info changes
+        to_rename (dict): The heuristic's decisions for the session, if
+            already made from its rule table; ``seq_infos`` is then unused
+        intentions (IntentionIndex): The project's BIDS paths, to check the
+            heuristic's IntendedFor targets against
+        journal (CheckpointJournal): Records the writes made
+
+    Returns:
+        Counter: The number of files that were new, updated and unchanged
+    """
+
+    if to_rename is None:
+        logger.debug(
+            "Found SeqInfos:\n%s",
+            "\n\t".join([pretty_string_seqinfo(seq) for seq in seq_infos]))
+
+        # apply heuristic to seqinfos
+        with record_field_usage(field_usage), stage('infotodict'):
+            to_rename = heuristic.infotodict(seq_infos)
+
+    if not to_rename:
+        logger.debug("No changes to apply!")
+        return Counter()
+
+    # try intendedfors
+    intention_map = defaultdict(list)
+    if hasattr(heuristic, "IntendedFor"):
+        logger.info("Processing IntendedFor fields based on heuristic file")
+        intention_map.update(heuristic.IntendedFor)
+        logger.debug("Intention map: %s",
+                     pprint.pformat(
+                         [(k[0], v) for k, v in dict(intention_map).items()]))
+
+    # try metadataextras
+    metadata_extras = defaultdict(list)
+    if hasattr(heuristic, "MetadataExtras"):
+        logger.info("Processing Medatata fields based on heuristic file")
+        metadata_extras.update(heuristic.MetadataExtras)
+        logger.debug("Metadata extras: %s", metadata_extras)
 
     # try subject/session label functions
     if hasattr(heuristic, "ReplaceSubject"):
@@ -125,10 +470,10 @@ def convert_to_bids(client, project_label, heuristic_path, subject_labels=None,
         session_rename = None
 
     # try attachments
-    if hasattr(heuristic, "AttachToProject"):
-        logger.info("Processing project attachments based on heuristic file")
+    if hasattr(heuristic, "AttachToSession"):
+        logger.info("Processing session attachments based on heuristic file")
 
-        attachments = heuristic.AttachToProject()
+        attachments = heuristic.AttachToSession()
 
         if not isinstance(attachments, list):
             attachments = [attachments]
@@ -136,124 +481,77 @@ def convert_to_bids(client, project_label, heuristic_path, subject_labels=None,
         for at in attachments:
 
             upload_attachment(
-                client, project_obj, level='project', attachment_dict=at,
+                client, session, level='session', attachment_dict=at,
                 subject_rename=subject_rename, session_rename=session_rename,
                 folders=['anat', 'dwi', 'func', 'fmap', 'perf'],
                 dry_run=dry_run
                     )
 
-    '''if hasattr(heuristic, "AttachToSubject"):
-
-        logger.info("Processing subject attachments based on heuristic file")
-
-        attachments = heuristic.AttachToSubject()
-
-        if not isinstance(attachments, list):
-            attachments = [attachments]
-
-        for at in attachments:
-
-            logger.debug(
-            "\tFilename: {}\n\tData: {}\n\tMIMEType: {}".format(
-                at['name'], at['data'], at['type']
-                )
-            )
-
-            verify_name, verify_data, verify_type = verify_attachment(at['name'], at['data'], at['type'])
-
-            if not all([verify_name, verify_data, verify_type]):
-
-                logger.warning("Attachments may not be valid for upload!")
-                logger.debug(
-                "\tFilename valid: {}\n\tData valid: {}\n\tMIMEType valid: {}".format(
-                    verify_name, verify_data, verify_type
-                    )
-                )
-
-            if not dry_run:
-                subjects = [x.subject for x in sessions]
-                file_spec = flywheel.FileSpec(at['name'], at['data'], at['type'])
-                [sub.upload_file(file_spec) for sub in subjects]'''
-
-    num_sessions = len(sessions)
-    for sesnum, session in enumerate(sessions):
-
-        # Find SeqInfos to apply the heuristic to
-        logger.info("Applying heuristic to %s (%d/%d)...", session.label, sesnum+1,
-                    num_sessions)
-
-        seq_infos = get_seq_info(client, project_label, [session])
-        logger.debug(
-            "Found SeqInfos:\n%s",
-            "\n\t".join([pretty_string_seqinfo(seq) for seq in seq_infos]))
-
-        # apply heuristic to seqinfos
-        to_rename = heuristic.infotodict(seq_infos)
-
-        if not to_rename:
-            logger.debug("No changes to apply!")
-            continue
+    # final prep
+    if not dry_run:
+        logger.info("Applying changes to files...")
 
-        # try intendedfors
-        intention_map = defaultdict(list)
-        if hasattr(heuristic, "IntendedFor"):
-            logger.info("Processing IntendedFor fields based on heuristic file")
-            intention_map.update(heuristic.IntendedFor)
-            logger.debug("Intention map: %s",
-                         pprint.pformat(
-                             [(k[0], v) for k, v in dict(intention_map).items()]))
-
-        # try metadataextras
-        metadata_extras = defaultdict(list)
-        if hasattr(heuristic, "MetadataExtras"):
-            logger.info("Processing Medatata fields based on heuristic file")
-            metadata_extras.update(heuristic.MetadataExtras)
-            logger.debug("Metadata extras: %s", metadata_extras)
+    to_apply = []
+    for key, val in to_rename.items():
 
-        # try subject/session label functions
-        if hasattr(heuristic, "ReplaceSubject"):
-            subject_rename = heuristic.ReplaceSubject
-        else:
-            subject_rename = None
-        if hasattr(heuristic, "ReplaceSession"):
-            session_rename = heuristic.ReplaceSession
+        # number the acquisitions the same way on every run: in the order the
+        # heuristic listed them, or sorted if it gave an unordered set
+        if isinstance(val, (set, frozenset)):
+            val = sorted(val)
         else:
-            session_rename = None
-
-        # try attachments
-        if hasattr(heuristic, "AttachToSession"):
-            logger.info("Processing session attachments based on heuristic file")
-
-            attachments = heuristic.AttachToSession()
-
-            if not isinstance(attachments, list):
-                attachments = [attachments]
-
-            for at in attachments:
-
-                upload_attachment(
-                    client, session, level='session', attachment_dict=at,
-                    subject_rename=subject_rename, session_rename=session_rename,
-                    folders=['anat', 'dwi', 'func', 'fmap', 'perf'],
-                    dry_run=dry_run
-                        )
-
-        # final prep
-        if not dry_run:
-            logger.info("Applying changes to files...")
-
-        for key, val in to_rename.items():
-
-            # assert val is list
-            if not isinstance(val, set):
-                val = set(val)
-            for seqitem, value in enumerate(val):
+            val = list(OrderedDict.fromkeys(val))
+        to_apply.extend((key, seqitem+1, value) for seqitem, value in enumerate(val))
+
+    # every file of the session is given its path before any IntendedFor is
+    # checked, so targets anywhere in the session resolve
+    if intentions is not None and intention_map:
+        with stage('intentions'):
+            for key, seqitem, value in to_apply:
+                for filename, path in plan_bids_paths(client, key, value, subject_rename,
+                                                      session_rename, seqitem):
+                    intentions.plan(value, filename, path)
+
+    updates = []
+    with stage('apply_heuristic'):
+        for key, seqitem, value in to_apply:
+            updates.extend(
                 apply_heuristic(client, key, value, dry_run, intention_map[key],
                                 metadata_extras[key], subject_rename, session_rename,
-                                seqitem+1)
-
-        confirm_intentions(client, session, dry_run)
-        print("\n")
+                                seqitem, intentions))
+
+    if plan is not None:
+        plan.add(session, updates)
+    if journal is not None:
+        journal.add(session, updates,
+                    intentions.held(session.id) if intentions is not None else ())
+    if not dry_run and any(u.update for u in updates):
+        with stage('verify_updates'):
+            verify_updates(client, updates)
+
+    counts = Counter(u.status for u in updates)
+    logger.info("%d new, %d updated, %d unchanged files", counts['new'],
+                counts['updated'], counts['unchanged'])
+    return counts
+
+
+def log_summary(results):
+    """Log a table of how each session's curation went"""
+
+    if not results:
+        return
+    logger.info("{:=^70}".format(": Summary :"))
+    logger.info("%-24s %-16s %-7s %6s %8s %10s %8s", "session", "subject", "status",
+                "new", "updated", "unchanged", "seconds")
+    for r in results:
+        logger.info("%-24s %-16s %-7s %6d %8d %10d %8.1f", r['session'][:24], r['subject'][:16],
+                    r['status'], r['new'], r['updated'], r['unchanged'], r['seconds'])
+    failed = [r for r in results if r['status'] != 'ok']
+    logger.info("%d sessions curated, %d failed", len(results) - len(failed), len(failed))
+    logger.info("%d new, %d updated, %d unchanged files",
+                sum(r['new'] for r in results), sum(r['updated'] for r in results),
+                sum(r['unchanged'] for r in results))
+    for r in failed:
+        logger.error("%s: %s", r['session'], r['error'])
 
 
 def get_parser():
@@ -262,13 +560,13 @@ def get_parser():
         description="Use a heudiconv heuristic to curate data into BIDS on flywheel")
     parser.add_argument(
         "--project",
-        help="The project in flywheel",
-        required=True
+        help="The project in flywheel (required unless --apply is given)",
+        default=None
     )
     parser.add_argument(
         "--heuristic",
-        help="Path to a heudiconv-style heuristic file",
-        required=True
+        help="Path to a heudiconv-style heuristic file (required unless --apply is given)",
+        default=None
     )
     parser.add_argument(
         "--subject",
@@ -294,6 +592,128 @@ def get_parser():
         action='store_true',
         default=False
     )
+    parser.add_argument(
+        "--jobs",
+        help="Number of acquisitions per session to query from Flywheel in parallel",
+        type=int,
+        default=1
+    )
+    parser.add_argument(
+        "--session-jobs",
+        help="Number of sessions to curate in parallel",
+        type=int,
+        default=1
+    )
+    parser.add_argument(
+        "--cache",
+        help="Reuse SeqInfos of unchanged acquisitions from a local cache",
+        action='store_true',
+        default=False
+    )
+    parser.add_argument(
+        "--cache-dir",
+        help="Directory of the local SeqInfo cache",
+        default=DEFAULT_CACHE_DIR
+    )
+    parser.add_argument(
+        "--lazy",
+        help="Only fetch the SeqInfo fields the heuristic reads, remembering them for later runs",
+        action='store_true',
+        default=False
+    )
+    parser.add_argument(
+        "--skip-example-dcm",
+        help="Leave example_dcm_file empty to avoid listing every dicom zip",
+        action='store_true',
+        default=False
+    )
+    parser.add_argument(
+        "--incremental",
+        help="Only curate sessions that are new or changed since the last incremental run",
+        action='store_true',
+        default=False
+    )
+    parser.add_argument(
+        "--full",
+        help="With --incremental, curate every session and record a fresh state",
+        action='store_true',
+        default=False
+    )
+    parser.add_argument(
+        "--state-file",
+        help="Incremental curation state file (default: one per project in --cache-dir)",
+        default=None
+    )
+    parser.add_argument(
+        "--plan-out",
+        help="Write the file info changes to this JSON lines file instead of making them",
+        default=None
+    )
+    parser.add_argument(
+        "--apply",
+        help="Make the file info changes of a plan written by --plan-out, "
+             "--jobs at a time, without querying Flywheel",
+        default=None
+    )
+    parser.add_argument(
+        "--offline",
+        help="Don't fetch heuristic URLs; fail unless the heuristic is in the local cache",
+        action='store_true',
+        default=False
+    )
+    parser.add_argument(
+        "--memoize",
+        help="Call the heuristic once per distinct series signature and reuse its decision "
+             "(for heuristics that don't set CACHEABLE = False; not with --lazy)",
+        action='store_true',
+        default=False
+    )
+    parser.add_argument(
+        "--resume",
+        help="Continue an interrupted run, skipping the sessions it finished",
+        action='store_true',
+        default=False
+    )
+    parser.add_argument(
+        "--restart",
+        help="Discard an interrupted run's checkpoint and curate every session again",
+        action='store_true',
+        default=False
+    )
+    parser.add_argument(
+        "--checkpoint",
+        help="Checkpoint journal of the run (default: one per project and "
+             "--subject/--session selection in --cache-dir)",
+        default=None
+    )
+    parser.add_argument(
+        "--retries",
+        help="Times to try the prefetch, or a session's query or curation, when it hits "
+             "a transient Flywheel error",
+        type=int,
+        default=RETRIES
+    )
+    parser.add_argument(
+        "--metrics-out",
+        help="On exit, write stage and Flywheel API call counts and timings to this "
+             "JSON file, and in Prometheus format to a .prom file next to it",
+        default=None
+    )
+    parser.add_argument(
+        "--trace-requests",
+        help="Trace every Flywheel request and report containers fetched repeatedly "
+             "and call sites making more than this many requests",
+        type=int,
+        metavar='N',
+        default=None
+    )
+    parser.add_argument(
+        "--max-in-flight",
+        help="Most Flywheel writes and transfers to have in flight; the actual number "
+             "adapts to how the server responds",
+        type=int,
+        default=DEFAULT_MAX_IN_FLIGHT
+    )
     parser.add_argument(
         "--api-key",
         help="API Key",
@@ -310,29 +730,72 @@ def main():
 
     parser = get_parser()
     args = parser.parse_args()
+    if not args.project and not args.apply:
+        parser.error("--project is required unless --apply is given")
+    if not args.heuristic and not args.apply:
+        parser.error("--heuristic is required unless --apply is given")
 
     with warnings.catch_warnings():
         warnings.simplefilter("ignore")
+        import flywheel
         if args.api_key:
             fw = flywheel.Client(args.api_key)
         else:
             fw = flywheel.Client()
     assert fw, "Your Flywheel CLI credentials aren't set!"
+    fw = CachedClient(fw)
+    if args.metrics_out:
+        instrument(fw)
+        write_at_exit(args.metrics_out, 'curate')
+    if args.trace_requests is not None:
+        request_trace = trace(fw, args.trace_requests)
+        if request_trace is not None:
+            report_at_exit(request_trace, logger)
+    limit_requests(fw, args.max_in_flight)
 
     # Print a lot if requested
     if args.verbose:
         logger.setLevel(logging.DEBUG)
 
-    convert_to_bids(client=fw,
-                    project_label=args.project,
-                    heuristic_path=args.heuristic,
-                    session_labels=args.session,
-                    subject_labels=args.subject,
-                    dry_run=args.dry_run)
-
+    if args.apply:
+        logger.info("Applying the changes planned in %s...", args.apply)
+        failures = apply_plan(fw, read_plan(args.apply), jobs=args.jobs)
+        logger.info("Done!")
+        logger.info("{:=^70}".format(": Exiting fw-heudiconv curator :"))
+        sys.exit(1 if failures else 0)
+
+    cache = SeqInfoCache(args.cache_dir) if args.cache else None
+
+    results = convert_to_bids(client=fw,
+                              project_label=args.project,
+                              heuristic_path=args.heuristic,
+                              session_labels=args.session,
+                              subject_labels=args.subject,
+                              dry_run=args.dry_run,
+                              jobs=args.jobs,
+                              cache=cache,
+                              skip_example_dcm=args.skip_example_dcm,
+                              lazy=args.lazy,
+                              cache_dir=args.cache_dir,
+                              incremental=args.incremental,
+                              full=args.full,
+                              state_file=args.state_file,
+                              session_jobs=args.session_jobs,
+                              plan_out=args.plan_out,
+                              offline=args.offline,
+                              memoize=args.memoize,
+                              resume=args.resume,
+                              restart=args.restart,
+                              checkpoint=args.checkpoint,
+                              retries=args.retries)
+
+    if cache is not None:
+        cache.close()
+
+    log_cache_stats(fw, logger)
     logger.info("Done!")
     logger.info("{:=^70}".format(": Exiting fw-heudiconv curator :"))
-    sys.exit()
+    sys.exit(1 if any(r['status'] != 'ok' for r in results) else 0)
 
 
 if __name__ == '__main__':
@@ -1,4 +1,3 @@
-import flywheel
 import argparse
 import os
 import logging
@@ -7,14 +6,26 @@ import json
 import shutil
 import re
 import csv
-import pandas as pd
 from pathlib import Path
+from collections import Counter, namedtuple
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from fw_heudiconv.backend_funcs.query import print_directory_tree
+from fw_heudiconv.backend_funcs.utils import get_nested, retry, RETRIES
+from fw_heudiconv.backend_funcs.metrics import stage, instrument, write_at_exit
+from fw_heudiconv.backend_funcs.tracing import trace, report_at_exit
+from fw_heudiconv.backend_funcs.limiter import limit_requests, LIMITER, DEFAULT_MAX_IN_FLIGHT
+from fw_heudiconv.backend_funcs.export_state import ExportState, default_state_path, is_within
+from fw_heudiconv.backend_funcs.container_cache import CachedClient, find_project, log_cache_stats
 
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger('fw-heudiconv-exporter')
 
+# A file to fetch from a container, and the sidecar to write next to it;
+# folder is the BIDS folder of acquisition files, None for attachments
+Download = namedtuple('Download', ['container_id', 'name', 'path', 'sidecar', 'sidecar_path',
+                                   'hash', 'size', 'folder'])
+
 
 def regex_attachments(regex, attachment_names):
 
@@ -29,15 +40,6 @@ def regex_attachments(regex, attachment_names):
         return False
 
 
-def get_nested(dct, *keys):
-    for key in keys:
-        try:
-            dct = dct[key]
-        except (KeyError, TypeError):
-            return None
-    return dct
-
-
 def download_sidecar(d, fpath, remove_bids=True):
 
     if remove_bids and 'BIDS' in d:
@@ -46,8 +48,46 @@ def download_sidecar(d, fpath, remove_bids=True):
                 d['TaskName'] = d['BIDS']['Task']
         del d['BIDS']
 
-    with open(fpath, 'w') as sidecar:
-        json.dump(d, fp=sidecar, sort_keys=True, indent=4)
+    write_file(fpath, json.dumps(d, sort_keys=True, indent=4))
+
+
+def write_file(path, text):
+    """Write a small file through a temporary one, unless it already holds ``text``
+
+    Returns:
+        bool: Whether the file was written
+    """
+    try:
+        with open(path, 'r') as f:
+            if f.read() == text:
+                return False
+    except (OSError, UnicodeDecodeError):
+        pass
+    tmp_path = '{}.{}.tmp'.format(path, os.getpid())
+    with open(tmp_path, 'w') as f:
+        f.write(text)
+    os.replace(tmp_path, path)
+    return True
+
+
+def remove_file(path, root_path):
+    """Remove an exported file, and any directories under the root it leaves empty
+
+    Nothing outside the root is removed.
+    """
+    if not is_within(path, root_path):
+        logger.warning("Not removing %s: it is outside %s", path, root_path)
+        return
+    if os.path.exists(path):
+        os.remove(path)
+    root_path = os.path.abspath(root_path)
+    parent = os.path.dirname(os.path.abspath(path))
+    while parent.startswith(root_path + os.sep):
+        try:
+            os.rmdir(parent)
+        except OSError:
+            break
+        parent = os.path.dirname(parent)
 
 
 def check_tasks(root_path):
@@ -106,7 +146,7 @@ def gather_bids(client, project_label, subject_labels=None, session_labels=None)
     }
 
     # dataset description
-    project_obj = client.projects.find_first('label="{}"'.format(project_label))
+    project_obj = find_project(client, project_label)
     assert project_obj, "Project not found! Maybe check spelling...?"
 
     # get dataset description file
@@ -125,7 +165,9 @@ def gather_bids(client, project_label, subject_labels=None, session_labels=None)
             'name': pf.name,
             'type': 'attachment',
             'data': project_obj.id,
-            'BIDS': get_nested(pf, 'info', 'BIDS')
+            'BIDS': get_nested(pf, 'info', 'BIDS'),
+            'hash': pf.get('hash'),
+            'size': pf.get('size')
         }
         to_download['project'].append(d)
 
@@ -157,7 +199,9 @@ def gather_bids(client, project_label, subject_labels=None, session_labels=None)
                     'name': sf.name,
                     'type': sf.type,
                     'data': sub.id,
-                    'BIDS': get_nested(sf, 'info', 'BIDS')
+                    'BIDS': get_nested(sf, 'info', 'BIDS'),
+                    'hash': sf.get('hash'),
+                    'size': sf.get('size')
                 }
                 to_download['subject'].append(d)
 
@@ -168,7 +212,9 @@ def gather_bids(client, project_label, subject_labels=None, session_labels=None)
                     'name': sf.name,
                     'type': sf.type,
                     'data': ses.id,
-                    'BIDS': get_nested(sf, 'info', 'BIDS')
+                    'BIDS': get_nested(sf, 'info', 'BIDS'),
+                    'hash': sf.get('hash'),
+                    'size': sf.get('size')
                 }
                 to_download['session'].append(d)
 
@@ -183,7 +229,9 @@ def gather_bids(client, project_label, subject_labels=None, session_labels=None)
             'type': af.type,
             'data': af.parent.id,
             'BIDS': get_nested(af, 'info', 'BIDS'),
-            'sidecar': get_nested(af, 'info')
+            'sidecar': get_nested(af, 'info'),
+            'hash': af.get('hash'),
+            'size': af.get('size')
         }
         if any(x in d['name'] for x in ['bval', 'bvec']):
             del d['sidecar']
@@ -192,18 +240,183 @@ def gather_bids(client, project_label, subject_labels=None, session_labels=None)
     return to_download
 
 
+def plan_downloads(to_download, root_path,
+                   folders_to_download=['anat', 'dwi', 'func', 'fmap', 'perf'],
+                   attachments=None):
+    """List every file download_bids will fetch, and where it goes
+
+    Args:
+        to_download (dict): Files gathered by gather_bids
+        root_path (str): The BIDS directory being exported to
+        folders_to_download (list): BIDS folders to export
+        attachments (list): If given, only these subject and session files
+
+    Returns:
+        list: A Download for each file
+    """
+    downloads = []
+
+    # project and subject files go to their BIDS path as given
+    for level in ('project', 'subject'):
+        for fi in to_download[level]:
+            if level == 'subject' and attachments and fi['name'] not in attachments:
+                continue
+            output_path = get_nested(fi, 'BIDS', 'Path')
+            if fi['BIDS'] is not None and output_path is not None:
+                downloads.append(Download(fi['data'], fi['name'],
+                                          str(Path(output_path, fi['name'])), None, None,
+                                          fi.get('hash'), fi.get('size'), None))
+
+    for fi in to_download['session']:
+        if attachments and not any([re.search(att, fi['name']) for att in attachments]):
+            continue
+        output_path = get_nested(fi, 'BIDS', 'Path')
+        if fi['BIDS'] is not None and output_path is not None:
+            downloads.append(Download(fi['data'], fi['name'],
+                                      str(Path(root_path, output_path, fi['name'])),
+                                      None, None, fi.get('hash'), fi.get('size'), None))
+
+    for fi in to_download['acquisition']:
+        project_path = get_nested(fi, 'BIDS', 'Path')
+        folder = get_nested(fi, 'BIDS', 'Folder')
+        ignore = get_nested(fi, 'BIDS', 'ignore')
+        if not project_path or folder not in folders_to_download or ignore:
+            continue
+
+        fname = get_nested(fi, 'BIDS', 'Filename')
+        download_path = '/'.join([root_path, project_path])
+        file_path = '/'.join([download_path, fname])
+
+        # only download files with sidecars
+        if 'sidecar' in fi:
+            sidecar_name = fname
+            for x in ['nii.gz', 'bval', 'bvec']:
+                sidecar_name = sidecar_name.replace(x, 'json')
+            # files like events tsvs have no JSON name of their own; the
+            # sidecar would be written over the file itself
+            if sidecar_name == fname:
+                downloads.append(Download(fi['data'], fi['name'], file_path, None, None,
+                                          fi.get('hash'), fi.get('size'), folder))
+                continue
+            downloads.append(Download(fi['data'], fi['name'], file_path, fi['sidecar'],
+                                      '/'.join([download_path, sidecar_name]),
+                                      fi.get('hash'), fi.get('size'), folder))
+
+        # exception: it may be an events tsv
+        elif any(x in fi['name'] for x in ['bval', 'bvec', 'tsv']):
+            downloads.append(Download(fi['data'], fi['name'], file_path, None, None,
+                                      fi.get('hash'), fi.get('size'), folder))
+
+    return downloads
+
+
+def find_conflicts(downloads):
+    """Paths more than one download (file or sidecar) would write to"""
+    paths = Counter(os.path.abspath(p) for d in downloads
+                    for p in (d.path, d.sidecar_path) if p is not None)
+    return sorted(p for p, count in paths.items() if count > 1)
+
+
+def fetch_file(client, download, retries=RETRIES, state=None):
+    """Download one file, retrying transient errors
+
+    The file is downloaded next to its target and renamed into place, so an
+    interrupted export never leaves a partial file under a BIDS name. The
+    whole transfer holds a slot of the shared request limiter, so the number
+    of downloads in flight adapts to the server as writes do.
+    """
+    tmp_path = '{}.{}.tmp'.format(download.path, os.getpid())
+
+    def attempt():
+        with LIMITER.slot(track_latency=False):
+            client.get(download.container_id).download_file(download.name, tmp_path)
+    try:
+        retry(attempt, attempts=retries)
+        os.replace(tmp_path, download.path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+    if state is not None:
+        state.mark_done(download)
+
+
 def download_bids(
     client, to_download, root_path,
     folders_to_download=['anat', 'dwi', 'func', 'fmap', 'perf'],
-    attachments=None, dry_run=True, name='bids_dataset'
+    attachments=None, dry_run=True, name='bids_dataset', jobs=1, retries=RETRIES,
+    sync=False, project=None, filtered=False
         ):
-
+    """Export the gathered files to a BIDS directory
+
+    Every target path is worked out first, so conflicting paths stop the
+    export before anything is downloaded. Files are then downloaded ``jobs``
+    at a time, each retried on transient errors, while the sidecars are
+    written alongside.
+
+    What was written is recorded in a state file in the BIDS directory. With
+    ``sync``, an existing directory is updated from it: only files that are
+    new or changed on Flywheel are downloaded, and files no longer curated
+    are removed. Only files the selection could have written are removed:
+    those from the folders exported, and attachments only when they aren't
+    filtered. Nothing is removed when only some subjects or sessions were
+    gathered.
+
+    Args:
+        client (Client): The flywheel sdk client
+        to_download (dict): Files gathered by gather_bids
+        root_path (str): Directory to create the BIDS directory in
+        folders_to_download (list): BIDS folders to export
+        attachments (list): If given, only these subject and session files
+        dry_run (bool): Only create empty files, or with ``sync`` only log
+            what would change
+        name (str): Name of the BIDS directory
+        jobs (int): Number of files to download in parallel
+        retries (int): How many times to try each file
+        sync (bool): Update an existing BIDS directory
+        project (str): The project being exported, recorded in the state
+        filtered (bool): Only some subjects or sessions were gathered
+    """
     if dry_run:
         logger.info("Preparing output directory tree...")
     else:
         logger.info("Downloading files...")
     root_path = "/".join([root_path, name])
-    Path(root_path).mkdir()
+
+    downloads = plan_downloads(to_download, root_path, folders_to_download, attachments)
+    conflicts = find_conflicts(downloads)
+    if conflicts:
+        logger.error("Found conflicting file paths:")
+        for path in conflicts:
+            logger.error(path)
+        raise FileExistsError(conflicts[0])
+
+    state = ExportState(default_state_path(root_path), root_path, project)
+    sidecars = [d for d in downloads if d.sidecar_path]
+    if sync:
+        to_fetch = [d for d in downloads if not state.is_current(d)]
+        if filtered:
+            logger.info("Only some subjects or sessions were gathered; "
+                        "not removing files no longer curated")
+            stale = []
+        else:
+            stale = state.stale([d.path for d in downloads] +
+                                [d.sidecar_path for d in sidecars],
+                                folders=folders_to_download, attachments=not attachments)
+        logger.info("%d of %d files are new or changed; %d files are no longer curated",
+                    len(to_fetch), len(downloads), len(stale))
+        if dry_run:
+            for d in to_fetch:
+                logger.info("Would download %s", d.path)
+            for path in stale:
+                logger.info("Would remove %s", path)
+            return
+        Path(root_path).mkdir(parents=True, exist_ok=True)
+        for path in stale:
+            remove_file(path, root_path)
+            state.forget(path)
+    else:
+        to_fetch = downloads
+        Path(root_path).mkdir()
 
     # handle dataset description
     if to_download['dataset_description']:
@@ -224,119 +437,49 @@ def download_bids(
         if dry_run:
             Path(path).touch()
         else:
-            with open(path, 'w') as bidsignore:
-                bidsignore.writelines('\n'.join(ignored_modalities))
-
-    # deal with project level files
-    # Project's subject data
-    for fi in to_download['project']:
-
-        if fi['BIDS'] is not None and get_nested(fi, 'BIDS', 'Path') is not None:
-            output_path = get_nested(fi, 'BIDS', 'Path')
-            path = str(Path(output_path, fi['name']))
-
-            if not Path(output_path).exists():
-                os.makedirs(Path(output_path).resolve(), exist_ok=True)
-
-            if dry_run:
-                Path(path).touch()
-            else:
-                container = client.get(fi['data'])
-                container.download_file(fi['name'], path)
+            write_file(path, '\n'.join(ignored_modalities))
 
-    # deal with subject level files
-    for fi in to_download['subject']:
+    for d in to_fetch + sidecars:
+        os.makedirs(os.path.dirname(os.path.abspath(d.path)), exist_ok=True)
 
-        if attachments:
-
-            if fi['name'] not in attachments:
-                continue
-
-        if fi['BIDS'] is not None and get_nested(fi, 'BIDS', 'Path') is not None:
-
-            output_path = get_nested(fi, 'BIDS', 'Path')
-            path = str(Path(output_path, fi['name']))
-
-            if not Path(output_path).exists():
-                os.makedirs(Path(output_path).resolve(), exist_ok=True)
-
-            if dry_run:
-                Path(path).touch()
-            else:
-                container = client.get(fi['data'])
-                container.download_file(fi['name'], path)
-
-    for fi in to_download['session']:
-        if attachments:
-
-            if not any([re.search(att, fi['name']) for att in attachments]):
-                continue
-
-        if fi['BIDS'] is not None and get_nested(fi, 'BIDS', 'Path') is not None:
-            output_path = Path(root_path, get_nested(fi, 'BIDS', 'Path'))
-            path = str(Path(output_path, fi['name']))
-
-            if not Path(output_path).exists():
-                os.makedirs(Path(output_path).resolve(), exist_ok=True)
-
-            if dry_run:
-                Path(path).touch()
-            else:
-                container = client.get(fi['data'])
-                container.download_file(fi['name'], path)
+    if dry_run:
+        for d in downloads:
+            Path(d.path).touch()
+            if d.sidecar_path:
+                Path(d.sidecar_path).touch()
+        logger.info("Done!")
+        print_directory_tree(root_path)
+        return
 
-    # deal with acquisition level files
-    for fi in to_download['acquisition']:
-        project_path = get_nested(fi, 'BIDS', 'Path')
-        folder = get_nested(fi, 'BIDS', 'Folder')
-        ignore = get_nested(fi, 'BIDS', 'ignore')
-        if project_path and folder in folders_to_download and not ignore:
-
-            # only download files with sidecars
-            if 'sidecar' in fi:
-                fname = get_nested(fi, 'BIDS', 'Filename')
-                extensions = ['nii.gz', 'bval', 'bvec']
-                sidecar_name = fname
-                for x in extensions:
-                    sidecar_name = sidecar_name.replace(x, 'json')
-
-                download_path = '/'.join([root_path, project_path])
-                file_path = '/'.join([download_path, fname])
-                if Path(file_path).exists():
-                    logger.error("Found conflicting file paths:")
-                    logger.error(file_path)
-                    logger.error("Cleaning up...")
-                    shutil.rmtree(root_path)
-                    raise FileExistsError
-
-                sidecar_path = '/'.join([download_path, sidecar_name])
-                acq = client.get(fi['data'])
-
-                if not os.path.exists(download_path):
-                    os.makedirs(download_path)
-
-                if dry_run:
-                    Path(file_path).touch()
-                    Path(sidecar_path).touch()
-                else:
-                    acq.download_file(fi['name'], file_path)
-                    download_sidecar(fi['sidecar'], sidecar_path, remove_bids=True)
-
-            #exception: it may be an events tsv
-            elif any(x in fi['name'] for x in ['bval', 'bvec', 'tsv']):
-                fname = get_nested(fi, 'BIDS', 'Filename')
-                download_path = '/'.join([root_path, project_path])
-                file_path = '/'.join([download_path, fname])
-                acq = client.get(fi['data'])
-
-                if not os.path.exists(download_path):
-                    os.makedirs(download_path)
-
-                if dry_run:
-                    Path(file_path).touch()
-                    Path(sidecar_path).touch()
-                else:
-                    acq.download_file(fi['name'], file_path)
+    logger.info("Downloading %d files, %d at a time...", len(to_fetch), max(jobs, 1))
+    failed = []
+    try:
+        with ThreadPoolExecutor(max_workers=max(jobs, 1)) as executor:
+            futures = {executor.submit(fetch_file, client, d, retries, state): d
+                       for d in to_fetch}
+
+            # sidecars come from the info already gathered, so write them
+            # while the files transfer
+            for d in sidecars:
+                download_sidecar(d.sidecar, d.sidecar_path, remove_bids=True)
+                state.mark_sidecar(d.sidecar_path, d.folder)
+
+            for done, future in enumerate(as_completed(futures), 1):
+                try:
+                    future.result()
+                except Exception as e:
+                    failed.append((futures[future], e))
+                if done % 100 == 0:
+                    state.save()
+    finally:
+        # files already downloaded won't be fetched again by a sync
+        state.save()
+
+    if failed:
+        logger.error("%d files failed to download:", len(failed))
+        for d, e in failed:
+            logger.error("%s: %s", d.path, e)
+        raise failed[0][1]
     #check_tasks(root_path)
 
     logger.info("Done!")
@@ -401,6 +544,46 @@ def get_parser():
         default="bids_directory",
         type=str
     )
+    parser.add_argument(
+        "--sync",
+        help="Update an existing export: download only files that are new or changed "
+             "since it was last exported, and remove files no longer curated",
+        action='store_true',
+        default=False
+    )
+    parser.add_argument(
+        "--jobs",
+        help="Number of files to download in parallel",
+        type=int,
+        default=4
+    )
+    parser.add_argument(
+        "--retries",
+        help="How many times to try downloading each file",
+        type=int,
+        default=RETRIES
+    )
+    parser.add_argument(
+        "--metrics-out",
+        help="On exit, write stage and Flywheel API call counts and timings to this "
+             "JSON file, and in Prometheus format to a .prom file next to it",
+        default=None
+    )
+    parser.add_argument(
+        "--trace-requests",
+        help="Trace every Flywheel request and report containers fetched repeatedly "
+             "and call sites making more than this many requests",
+        type=int,
+        metavar='N',
+        default=None
+    )
+    parser.add_argument(
+        "--max-in-flight",
+        help="Most Flywheel writes and transfers to have in flight; the actual number "
+             "adapts to how the server responds",
+        type=int,
+        default=DEFAULT_MAX_IN_FLIGHT
+    )
     parser.add_argument(
         "--api-key",
         help="API Key",
@@ -425,11 +608,21 @@ def main():
 
     with warnings.catch_warnings():
         warnings.simplefilter("ignore")
+        import flywheel
         if args.api_key:
             fw = flywheel.Client(args.api_key)
         else:
             fw = flywheel.Client()
     assert fw, "Your Flywheel CLI credentials aren't set!"
+    fw = CachedClient(fw)
+    if args.metrics_out:
+        instrument(fw)
+        write_at_exit(args.metrics_out, 'export')
+    if args.trace_requests is not None:
+        request_trace = trace(fw, args.trace_requests)
+        if request_trace is not None:
+            report_at_exit(request_trace, logger)
+    limit_requests(fw, args.max_in_flight)
 
     if args.path:
         destination = args.path
@@ -440,24 +633,29 @@ def main():
         logger.info("Creating destination directory...")
         os.makedirs(args.destination)
 
-    downloads = gather_bids(
-        client=fw, project_label=args.project, session_labels=args.session,
-        subject_labels=args.subject
-        )
+    with stage('gather_bids'):
+        downloads = gather_bids(
+            client=fw, project_label=args.project, session_labels=args.session,
+            subject_labels=args.subject
+            )
 
     if args.attachments is not None and args.verbose:
         logger.info("Filtering attachments...")
         logger.info(args.attachments)
 
-    download_bids(
-        client=fw, to_download=downloads, root_path=destination,
-        folders_to_download=args.folders, dry_run=args.dry_run,
-        attachments=args.attachments, name=args.directory_name
-        )
+    with stage('download_bids'):
+        download_bids(
+            client=fw, to_download=downloads, root_path=destination,
+            folders_to_download=args.folders, dry_run=args.dry_run,
+            attachments=args.attachments, name=args.directory_name,
+            jobs=args.jobs, retries=args.retries, sync=args.sync, project=args.project,
+            filtered=bool(args.subject or args.session)
+            )
 
-    if args.dry_run:
+    if args.dry_run and not args.sync:
         shutil.rmtree(Path(args.destination, args.directory_name))
 
+    log_cache_stats(fw, logger)
     logger.info("Done!")
     logger.info("{:=^70}".format(": Exiting fw-heudiconv exporter :"))
 
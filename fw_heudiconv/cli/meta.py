@@ -2,13 +2,15 @@ import os
 import sys
 import argparse
 import warnings
-import flywheel
 import logging
 import re
-import pandas as pd
 import shutil
 from pathlib import Path
-from fw_heudiconv.backend_funcs.convert import get_nested
+from fw_heudiconv.backend_funcs.utils import get_nested
+from fw_heudiconv.backend_funcs.metrics import stage, instrument, write_at_exit
+from fw_heudiconv.backend_funcs.tracing import trace, report_at_exit
+from fw_heudiconv.backend_funcs.limiter import limit_requests, DEFAULT_MAX_IN_FLIGHT
+from fw_heudiconv.backend_funcs.container_cache import CachedClient, find_project, log_cache_stats
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger('fw-heudiconv-curator')
@@ -46,7 +48,7 @@ def initialise_dataset(client, project_label, subject_labels=None, session_label
     if dry_run:
         logger.setLevel(logging.DEBUG)
     logger.info("Querying Flywheel server...")
-    project_obj = client.projects.find_first('label="{}"'.format(project_label))
+    project_obj = find_project(client, project_label)
     assert project_obj, "Project not found! Maybe check spelling...?"
     logger.debug('Found project: %s (%s)', project_obj['label'], project_obj.id)
     sessions = client.get_project_sessions(project_obj.id)
@@ -75,6 +77,8 @@ def attach_to_object(object, file, dry_run):
 
 def autogen_participants_meta(project_obj, sessions, dry_run):
 
+    import pandas as pd
+
     participants = []
     for sess in sessions:
 
@@ -99,6 +103,8 @@ def autogen_participants_meta(project_obj, sessions, dry_run):
 
 def autogen_sessions_meta(client, sessions, dry_run):
 
+    import pandas as pd
+
     results = []
     subjects = {}
     for sess in sessions:
@@ -260,6 +266,27 @@ def get_parser():
         help="Path to CHANGES file to upload",
         action='store'
     )
+    parser.add_argument(
+        "--metrics-out",
+        help="On exit, write stage and Flywheel API call counts and timings to this "
+             "JSON file, and in Prometheus format to a .prom file next to it",
+        default=None
+    )
+    parser.add_argument(
+        "--trace-requests",
+        help="Trace every Flywheel request and report containers fetched repeatedly "
+             "and call sites making more than this many requests",
+        type=int,
+        metavar='N',
+        default=None
+    )
+    parser.add_argument(
+        "--max-in-flight",
+        help="Most Flywheel writes and transfers to have in flight; the actual number "
+             "adapts to how the server responds",
+        type=int,
+        default=DEFAULT_MAX_IN_FLIGHT
+    )
     parser.add_argument(
         "--api-key",
         help="API Key",
@@ -280,11 +307,21 @@ def main():
 
     with warnings.catch_warnings():
         warnings.simplefilter("ignore")
+        import flywheel
         if args.api_key:
             fw = flywheel.Client(args.api_key)
         else:
             fw = flywheel.Client()
     assert fw, "Your Flywheel CLI credentials aren't set!"
+    fw = CachedClient(fw)
+    if args.metrics_out:
+        instrument(fw)
+        write_at_exit(args.metrics_out, 'meta')
+    if args.trace_requests is not None:
+        request_trace = trace(fw, args.trace_requests)
+        if request_trace is not None:
+            report_at_exit(request_trace, logger)
+    limit_requests(fw, args.max_in_flight)
 
     # Print a lot if requested
     if args.verbose:
@@ -318,7 +355,8 @@ def main():
     if args.autogen_participants_meta:
 
         logger.info("Auto-generating participants.tsv...")
-        status.append(autogen_participants_meta(project_obj, sessions, args.dry_run))
+        with stage('autogen_participants_meta'):
+            status.append(autogen_participants_meta(project_obj, sessions, args.dry_run))
 
     elif args.upload_participants_meta:
 
@@ -328,13 +366,15 @@ def main():
     if args.autogen_sessions_meta:
 
         logger.info("Auto-generating *_sessions.tsv...")
-        status.append(autogen_sessions_meta(fw, sessions, args.dry_run))
+        with stage('autogen_sessions_meta'):
+            status.append(autogen_sessions_meta(fw, sessions, args.dry_run))
 
     elif args.upload_sessions_meta:
         for tup in args.upload_sessions_meta:
             logger.info("Attempting to attach {} to {}...".format(tup[1], tup[0]))
             status.append(upload_to_session(fw, sessions, tup[0], tup[1], args.dry_run))
 
+    log_cache_stats(fw, logger)
     logger.info("Done!")
     logger.info("{:=^70}".format(": Exiting fw-heudiconv metadata manager :"))
     if any([x == 1 for x in status]):
@@ -1,7 +1,6 @@
 import argparse
 import warnings
 import logging
-import flywheel
 import os
 import pprint
 import re
@@ -1,9 +1,12 @@
 import argparse
 import warnings
 import logging
-import flywheel
-import pandas as pd
-from fw_heudiconv.backend_funcs.query import get_seq_info
+from fw_heudiconv.backend_funcs.seqinfo_cache import SeqInfoCache, DEFAULT_CACHE_DIR
+from fw_heudiconv.backend_funcs.query import iter_seq_info
+from fw_heudiconv.backend_funcs.seqinfo_table import SeqInfoTable
+from fw_heudiconv.backend_funcs.metrics import stage, instrument, write_at_exit
+from fw_heudiconv.backend_funcs.tracing import trace, report_at_exit
+from fw_heudiconv.backend_funcs.container_cache import CachedClient, find_project, log_cache_stats
 
 
 logging.basicConfig(level=logging.INFO)
@@ -11,7 +14,8 @@ logger = logging.getLogger('fw-heudiconv-tabulator')
 
 
 def tabulate_bids(client, project_label, path=".", subject_labels=None,
-                  session_labels=None, dry_run=False, unique=True):
+                  session_labels=None, dry_run=False, unique=True, jobs=1,
+                  cache=None, skip_example_dcm=False):
     """Writes out a tabular form of the Seq Info objects
 
     Args:
@@ -22,10 +26,13 @@ def tabulate_bids(client, project_label, path=".", subject_labels=None,
         subject_code (str): The subject code
         session_label (str): The session label
         dry_run (bool): Print the changes, don't apply them on flywheel
+        jobs (int): Number of acquisitions to query concurrently
+        cache (SeqInfoCache): On-disk cache of previously built SeqInfos
+        skip_example_dcm (bool): Don't look up example_dcm_file
     """
 
     logger.info("Querying Flywheel server...")
-    project_obj = client.projects.find_first('label="{}"'.format(project_label))
+    project_obj = find_project(client, project_label)
     assert project_obj, "Project not found! Maybe check spelling...?"
 
     logger.debug('Found project: %s (%s)', project_obj['label'], project_obj.id)
@@ -40,14 +47,17 @@ def tabulate_bids(client, project_label, path=".", subject_labels=None,
     logger.debug('Found sessions:\n\t%s',
                  "\n\t".join(['%s (%s)' % (ses['label'], ses.id) for ses in sessions]))
 
-    # Find SeqInfos to apply the heuristic to
-    seq_infos = get_seq_info(client, project_label, sessions)
-    seq_info_dicts = [seq._asdict() for seq in seq_infos]
-    df = pd.DataFrame.from_dict(seq_info_dicts)
+    # Find SeqInfos to apply the heuristic to, collecting them into columns
+    # as each session arrives
+    table = SeqInfoTable()
+    for session, seq_infos in iter_seq_info(client, project_label, sessions, jobs=jobs,
+                                            cache=cache, skip_example_dcm=skip_example_dcm):
+        table.extend(seq_infos)
+    df = table.to_dataframe()
 
     if unique:
         df = df.drop_duplicates(subset=['TR', 'TE', 'protocol_name', 'is_motion_corrected', 'is_derived', 'series_description'])
-        df = df.drop(['total_files_till_now', 'dcm_dir_name'], 1)
+        df = df.drop(['total_files_till_now', 'dcm_dir_name'], axis=1)
 
     return df
 
@@ -112,6 +122,43 @@ def get_parser():
         dest='unique',
         action='store_false'
     )
+    parser.add_argument(
+        "--jobs",
+        help="Number of acquisitions to query from Flywheel in parallel",
+        type=int,
+        default=1
+    )
+    parser.add_argument(
+        "--cache",
+        help="Reuse SeqInfos of unchanged acquisitions from a local cache",
+        action='store_true',
+        default=False
+    )
+    parser.add_argument(
+        "--cache-dir",
+        help="Directory of the local SeqInfo cache",
+        default=DEFAULT_CACHE_DIR
+    )
+    parser.add_argument(
+        "--skip-example-dcm",
+        help="Leave example_dcm_file empty to avoid listing every dicom zip",
+        action='store_true',
+        default=False
+    )
+    parser.add_argument(
+        "--metrics-out",
+        help="On exit, write stage and Flywheel API call counts and timings to this "
+             "JSON file, and in Prometheus format to a .prom file next to it",
+        default=None
+    )
+    parser.add_argument(
+        "--trace-requests",
+        help="Trace every Flywheel request and report containers fetched repeatedly "
+             "and call sites making more than this many requests",
+        type=int,
+        metavar='N',
+        default=None
+    )
     parser.add_argument(
         "--api-key",
         help="API Key",
@@ -131,26 +178,45 @@ def main():
 
     with warnings.catch_warnings():
         warnings.simplefilter("ignore")
+        import flywheel
         if args.api_key:
             fw = flywheel.Client(args.api_key)
         else:
             fw = flywheel.Client()
     assert fw, "Your Flywheel CLI credentials aren't set!"
+    fw = CachedClient(fw)
+    if args.metrics_out:
+        instrument(fw)
+        write_at_exit(args.metrics_out, 'tabulate')
+    if args.trace_requests is not None:
+        request_trace = trace(fw, args.trace_requests)
+        if request_trace is not None:
+            report_at_exit(request_trace, logger)
 
     # Print a lot if requested
     if args.verbose or args.dry_run:
         logger.setLevel(logging.DEBUG)
 
+    cache = SeqInfoCache(args.cache_dir) if args.cache else None
+
     result = tabulate_bids(client=fw,
                   project_label=args.project,
                   path=args.path,
                   session_labels=args.session,
                   subject_labels=args.subject,
                   dry_run=args.dry_run,
-                  unique=args.unique)
+                  unique=args.unique,
+                  jobs=args.jobs,
+                  cache=cache,
+                  skip_example_dcm=args.skip_example_dcm)
+
+    if cache is not None:
+        cache.close()
 
-    output_result(result, path=args.path, project_label=args.project, dry_run=args.dry_run)
+    with stage('output_result'):
+        output_result(result, path=args.path, project_label=args.project, dry_run=args.dry_run)
 
+    log_cache_stats(fw, logger)
     logger.info("Done!")
     logger.info("{:=^70}".format(": Exiting fw-heudiconv tabulator :"))
 
@@ -6,9 +6,7 @@ import argparse
 import warnings
 import re
 from pathlib import Path
-from ..backend_funcs.convert import parse_validator
 import subprocess as sub
-import pandas as pd
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger('fw-heudiconv-validator')
@@ -53,6 +51,7 @@ def validate_local(path, verbose, tabulate='.'):
             p2 = sub.run(command, stdout=outfile)
 
         if p2.returncode == 0:
+            from fw_heudiconv.backend_funcs.convert import parse_validator
             issues_df_full = parse_validator(tabulate + '/issues.json')
             issues_df_full.to_csv(tabulate + '/issues.csv', index=False)
 
@@ -58,6 +58,10 @@ b0_mag = create_key(
 b0_phase = create_key(
    'sub-{subject}/{session}/fmap/sub-{subject}_{session}_phasediff')
 
+# repeated tasks are numbered by their order in the session, so a series
+# can't be decided from its own fields alone
+CACHEABLE = False
+
 
 def infotodict(seqinfo):
 
@@ -39,7 +39,8 @@ setuptools.setup(
             'fw-heudiconv-clear=fw_heudiconv.cli.clear:main',
             'fw-heudiconv-validate=fw_heudiconv.cli.validate:main',
             'fw-heudiconv-meta=fw_heudiconv.cli.meta:main',
-            'fw-heudiconv-reproin=fw_heudiconv.cli.reproin_check:main'
+            'fw-heudiconv-reproin=fw_heudiconv.cli.reproin_check:main',
+            'fw-heudiconv-cache=fw_heudiconv.cli.cache:main'
         ],
     }
 )
@@ -0,0 +1,63 @@
+'''
+Microbenchmark: image shape from a Flywheel dicom header.
+
+Compares the header adapter used by query.acquisition_to_heudiconv with the
+nibabel wrapper path it replaced. Run with:
+
+    python testing/benchmark_image_shape.py
+'''
+
+import sys
+import timeit
+import warnings
+from fw_heudiconv.backend_funcs.query import dicom_image_shape
+
+HEADER = {
+    'Rows': 96,
+    'Columns': 96,
+    'SeriesDescription': 'func-bold_task-rest',
+    'ProtocolName': 'func-bold_task-rest',
+    'ImageType': ['ORIGINAL', 'PRIMARY', 'M', 'MB', 'ND', 'MOSAIC'],
+    'RepetitionTime': 0.8,
+    'EchoTime': 0.037,
+    'SOPClassUID': '1.2.840.10008.5.1.4.1.1.4',
+    'AcquisitionDateTime': '20190315093255.450000',
+    'SeriesInstanceUID': '1.3.12.2.1107.5.2.43.66044.2019031509325545088',
+}
+NUM_DICOMS = 420
+NUMBER = 20000
+
+
+def nibabel_image_shape(dcm_info, num_dicoms):
+
+    with warnings.catch_warnings():
+        warnings.filterwarnings("ignore", category=UserWarning)
+        from nibabel.nicom.dicomwrappers import wrapper_from_data
+    mw = wrapper_from_data(dcm_info)
+    image_shape = mw.image_shape
+    if image_shape is None:
+        return (-1, -1, -1, -1)
+    image_shape = mw.image_shape + (num_dicoms,)
+    while len(image_shape) < 4:
+        image_shape = image_shape + (-1,)
+    return image_shape
+
+
+def main():
+
+    fast = dicom_image_shape(HEADER, NUM_DICOMS)
+    slow = nibabel_image_shape(HEADER, NUM_DICOMS)
+    assert fast == slow, (fast, slow)
+
+    fast_time = timeit.timeit(lambda: dicom_image_shape(HEADER, NUM_DICOMS), number=NUMBER)
+    slow_time = timeit.timeit(lambda: nibabel_image_shape(HEADER, NUM_DICOMS), number=NUMBER)
+
+    print("shape: {}".format(fast))
+    print("header adapter: {:8.2f} us/call".format(fast_time / NUMBER * 1e6))
+    print("nibabel wrapper: {:7.2f} us/call".format(slow_time / NUMBER * 1e6))
+    print("speedup: {:.1f}x".format(slow_time / fast_time))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
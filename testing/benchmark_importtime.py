@@ -0,0 +1,60 @@
+'''
+Startup benchmark: how long each console script takes to import.
+
+Runs ``python -X importtime`` on every fw-heudiconv command module in a fresh
+interpreter and reports the cumulative import time, slowest first, along
+with the heaviest third-party packages it pulled in. Run with:
+
+    python testing/benchmark_importtime.py
+'''
+
+import re
+import sys
+import subprocess
+
+MODULES = [
+    'fw_heudiconv.cli.curate',
+    'fw_heudiconv.cli.export',
+    'fw_heudiconv.cli.tabulate',
+    'fw_heudiconv.cli.clear',
+    'fw_heudiconv.cli.meta',
+    'fw_heudiconv.cli.validate',
+    'fw_heudiconv.cli.reproin_check',
+    'fw_heudiconv.cli.cache',
+]
+HEAVY = ('flywheel', 'pandas', 'numpy', 'nibabel', 'heudiconv', 'requests', 'validators')
+LINE = re.compile(r'import time:\s+(\d+) \|\s+(\d+) \|(\s*)(\S+)')
+
+
+def import_times(module):
+    """Cumulative import time in microseconds of ``module`` and its top-level imports"""
+    proc = subprocess.run([sys.executable, '-X', 'importtime', '-c', 'import ' + module],
+                          stderr=subprocess.PIPE, universal_newlines=True)
+    total = 0
+    packages = {}
+    for line in proc.stderr.splitlines():
+        match = LINE.match(line)
+        if not match:
+            continue
+        cumulative, indent, name = int(match.group(2)), len(match.group(3)), match.group(4)
+        if name == module:
+            total = cumulative
+        top = name.split('.')[0]
+        if top in HEAVY and indent <= 3 and name == top:
+            packages[top] = max(packages.get(top, 0), cumulative)
+    return total, packages
+
+
+def main():
+
+    results = [(module,) + import_times(module) for module in MODULES]
+    results.sort(key=lambda r: r[1], reverse=True)
+    for module, total, packages in results:
+        heavy = ", ".join("{} {:.0f}ms".format(k, v / 1000)
+                          for k, v in sorted(packages.items(), key=lambda kv: -kv[1]))
+        print("{:<36} {:8.1f} ms  {}".format(module, total / 1000, heavy or "-"))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -16,3 +16,983 @@ def test_client():
     client = flywheel.Client()
     assert client
     return 1
+
+def test_header_image_shape():
+
+    from nibabel.nicom.dicomwrappers import wrapper_from_data
+    from fw_heudiconv.backend_funcs.query import dicom_image_shape
+
+    header = {'Rows': 96, 'Columns': 80, 'SOPClassUID': '1.2.840.10008.5.1.4.1.1.4'}
+    assert dicom_image_shape(header, 60) == wrapper_from_data(header).image_shape + (60, -1)
+    assert dicom_image_shape({}, -1) == (-1, -1, -1, -1)
+
+def test_seqinfo_table():
+
+    from fw_heudiconv.backend_funcs.query import SeqInfo, SEQINFO_FIELDS
+    from fw_heudiconv.backend_funcs.seqinfo_table import SeqInfoTable
+
+    values = dict.fromkeys(SEQINFO_FIELDS, 'x')
+    values.update(total_files_till_now=3, dim1=96, dim2=80, dim3=60, dim4=-1,
+                  TR=None, TE=0.03, is_motion_corrected=False, is_derived=True,
+                  image_type=('ORIGINAL', 'PRIMARY'))
+    seqinfos = [SeqInfo(**values), SeqInfo(**dict(values, dim1=2.5, TR=0.8))]
+    table = SeqInfoTable(seqinfos)
+    assert [tuple(row) for row in table] == [tuple(s) for s in seqinfos]
+    assert table[0] == seqinfos[0] and table[0].TR is None
+    assert list(table.to_dataframe()['dim1']) == [96, 2.5]
+
+def test_rule_table():
+
+    import pandas as pd
+    from fw_heudiconv.backend_funcs.heuristics import evaluate_rules
+
+    df = pd.DataFrame({'series_description': ['T1w_MPRAGE', 'rest_bold', 'rest_sbref', None],
+                       'dim4': [1, 420, 1, 1]})
+    rules = [({'series_description': '(?i)mprage'}, 't1w'),
+             ({'series_description': 'rest', 'dim4': ('>', 100)}, 'rest'),
+             ({'series_description': None}, 'unknown')]
+    assert evaluate_rules(rules, df).tolist() == [0, 1, -1, 2]
+
+    # contains looks for elements of a tuple field, not substrings of it
+    df = pd.DataFrame({'series_description': ['fmap', 'fmap', 'fmap_ORIG'],
+                       'image_type': [('ORIGINAL', 'PRIMARY', 'M', 'ND'),
+                                      ('ORIGINAL', 'PRIMARY', 'P', 'ND'), None]})
+    rules = [({'image_type': ('contains', 'P')}, 'b0_phase'),
+             ({'image_type': ('contains', 'M')}, 'b0_magnitude'),
+             ({'series_description': ('contains', 'ORIG')}, 'other')]
+    assert evaluate_rules(rules, df).tolist() == [1, 0, 2]
+
+class FakeObj(dict):
+    """A flywheel-like container: attribute and ``.get`` access to its fields"""
+
+    def __getattr__(self, name):
+        try:
+            return self[name]
+        except KeyError:
+            raise AttributeError(name)
+
+
+class FakeClient(object):
+    """Gets containers from a dict, counting the requests"""
+
+    def __init__(self, containers=None):
+        self.containers = containers or {}
+        self.requests = 0
+
+    def get(self, container_id):
+        self.requests += 1
+        return self.containers.get(container_id, FakeObj(id=container_id, label=container_id))
+
+    def set_acquisition_file_info(self, acquisition_id, filename, info):
+        self.containers[acquisition_id].update_file_info(filename, info)
+
+
+class FakeAcquisition(FakeObj):
+    """An acquisition that applies and records file info updates"""
+
+    def update_file_info(self, name, update):
+        import copy
+        self['writes'].append((name, update))
+        for f in self['files']:
+            if f.name == name:
+                f.info.update(copy.deepcopy(update))
+
+
+def fake_client(sessions=('1',), acquisitions=('t1w', 'bold')):
+    """A client for a project of one subject with the given sessions, each
+    holding a NIfTI and dicom file per acquisition"""
+    containers = {'sub': FakeObj(id='sub', label='01')}
+    for ses in sessions:
+        containers['ses' + ses] = FakeObj(id='ses' + ses, label=ses, subject=containers['sub'])
+        for name in acquisitions:
+            acq_id = '{}-{}'.format(name, ses)
+            files = [FakeObj(name=name + '.nii.gz', type='nifti', info={}),
+                     FakeObj(name=name + '.dicom.zip', type='dicom', info={})]
+            containers[acq_id] = FakeAcquisition(
+                id=acq_id, label=name, files=files, writes=[],
+                parents=FakeObj(subject='sub', session='ses' + ses, project='project'))
+    return FakeClient(containers)
+
+
+def test_apply_heuristic_diff():
+
+    from fw_heudiconv.backend_funcs.convert import apply_heuristic
+
+    client = fake_client()
+    acq = client.containers['t1w-1']
+    key = ('sub-{subject}/{session}/anat/sub-{subject}_{session}_T1w', ('nii.gz',), None)
+
+    updates = apply_heuristic(client, key, 't1w-1')
+    assert [(u.filename, u.status, sorted(u.update)) for u in updates] == \
+        [('t1w.nii.gz', 'new', ['BIDS'])]
+    assert acq.writes[0][1]['BIDS']['Filename'] == 'sub-01_ses-1_T1w.nii.gz'
+
+    # a second run finds nothing to write
+    del acq.writes[:]
+    updates = apply_heuristic(client, key, 't1w-1', metadata_extras={'Note': 'x'})
+    assert [(u.status, u.update) for u in updates] == [('updated', {'Note': 'x'})]
+    assert acq.writes == [('t1w.nii.gz', {'Note': 'x'})]
+    del acq.writes[:]
+    updates = apply_heuristic(client, key, 't1w-1', metadata_extras={'Note': 'x'})
+    assert [(u.status, u.update) for u in updates] == [('unchanged', {})]
+    assert acq.writes == []
+
+    # dry runs report the differences without writing them
+    key = ('sub-{subject}/{session}/anat/sub-{subject}_{session}_run-1_T1w', ('nii.gz',), None)
+    updates = apply_heuristic(client, key, 't1w-1', dry_run=True)
+    assert updates[0].status == 'updated' and updates[0].old['BIDS']['Filename'] == \
+        'sub-01_ses-1_T1w.nii.gz'
+    assert acq.writes == []
+
+
+def test_plan_round_trip(tmp_path):
+
+    import os
+    from fw_heudiconv.backend_funcs.convert import apply_heuristic
+    from fw_heudiconv.backend_funcs.plan import PlanWriter, read_plan, apply_plan
+
+    client = fake_client()
+    session = client.containers['ses1']
+    key = ('sub-{subject}/{session}/func/sub-{subject}_{session}_task-rest_bold', ('nii.gz',), None)
+    path = str(tmp_path / 'plan.jsonl')
+
+    plan = PlanWriter(path)
+    plan.add(session, apply_heuristic(client, key, 'bold-1', dry_run=True))
+    assert not os.path.exists(path)
+    plan.close()
+    entries = read_plan(path)
+    assert [(e['acquisition_id'], e['filename'], e['status']) for e in entries] == \
+        [('bold-1', 'bold.nii.gz', 'new')]
+    assert client.containers['bold-1'].writes == []
+
+    # applying the plan makes the same writes a run would have
+    assert apply_plan(client, entries) == []
+    assert client.containers['bold-1'].writes == [('bold.nii.gz', entries[0]['new'])]
+    assert all(u.status == 'unchanged' for u in apply_heuristic(client, key, 'bold-1'))
+
+    # the plan is all --apply needs
+    from fw_heudiconv.cli.curate import get_parser
+    args = get_parser().parse_args(['--apply', path])
+    assert args.apply == path and args.project is None
+
+    # a failed run leaves neither a plan nor its temporary file
+    plan = PlanWriter(str(tmp_path / 'failed.jsonl'))
+    plan.discard()
+    plan.close()
+    assert os.listdir(str(tmp_path)) == ['plan.jsonl']
+
+
+def test_seqinfo_cache(tmp_path):
+
+    from fw_heudiconv.backend_funcs.query import session_to_seq_info
+    from fw_heudiconv.backend_funcs.seqinfo_cache import SeqInfoCache, acquisition_fingerprint
+
+    def zip_info(name):
+        raise OSError("zip listing failed")
+
+    dicom = FakeObj(name='a.dicom.zip', type='dicom', hash='h', size=10, modified='1',
+                    info={'Rows': 64, 'Columns': 64})
+    nifti = FakeObj(name='a.nii.gz', type='nifti', hash='n', size=5, modified='1',
+                    info={'SeriesDescription': 'T1w'})
+    acq = FakeObj(id='acq', files=[dicom, nifti], get_file_zip_info=zip_info,
+                  parents=FakeObj(subject='sub', session='ses'))
+    client = FakeClient()
+
+    # curation writes change ``modified`` but not what a SeqInfo is built from
+    fingerprint = acquisition_fingerprint(acq)
+    nifti['modified'] = '2'
+    nifti.info['BIDS'] = {'Filename': 'sub-01_T1w.nii.gz'}
+    assert acquisition_fingerprint(acq) == fingerprint
+    # but header fields filled in or edited after upload do
+    nifti.info['SeriesDescription'] = 'MPRAGE'
+    assert acquisition_fingerprint(acq) != fingerprint
+    nifti.info['SeriesDescription'] = 'T1w'
+
+    cache = SeqInfoCache(str(tmp_path))
+    context = {'subject': FakeObj(label='sub')}
+    seq_info = session_to_seq_info(client, FakeObj(label='ses'), context, acquisitions=[acq],
+                                   cache=cache)
+    assert list(seq_info)[0].dim3 == -1
+    # SeqInfos built without the unreadable zip info aren't cached
+    assert cache.get(acq) is None
+    cache.close()
+
+def test_lazy_seqinfo(tmp_path):
+
+    from fw_heudiconv.backend_funcs.lazy_seqinfo import (
+        FieldUsage, LazySeqInfo, load_field_usage, save_field_usage)
+    from fw_heudiconv.backend_funcs.query import session_to_seq_info
+
+    listings = []
+
+    def acquisition(i, **dicom_info):
+        def zip_info(name):
+            listings.append(name)
+            return FakeObj(members=[FakeObj(path='{}/{}.dcm'.format(i, n)) for n in range(3)])
+        files = [FakeObj(name='{}.dicom.zip'.format(i), type='dicom',
+                         info=dict(Rows=64, Columns=64, **dicom_info)),
+                 FakeObj(name='{}.nii.gz'.format(i), type='nifti',
+                         info={'SeriesDescription': 'run{}'.format(i)})]
+        return FakeObj(id='acq{}'.format(i), files=files, get_file_zip_info=zip_info,
+                       parents=FakeObj(subject='sub', session='ses'))
+
+    # the first acquisition's file count is in its metadata, the second's isn't
+    acquisitions = [acquisition(0, ImagesInAcquisition=3), acquisition(1)]
+    client, session = FakeClient(), FakeObj(label='ses')
+
+    def seq_infos(field_usage=None):
+        context = {'subject': FakeObj(label='sub')}
+        return list(session_to_seq_info(client, session, context, acquisitions=acquisitions,
+                                        field_usage=field_usage))
+
+    eager = seq_infos()
+    del listings[:]
+    usage = FieldUsage()
+    lazy = seq_infos(usage)
+    assert all(isinstance(info, LazySeqInfo) for info in lazy)
+
+    # metadata fields need no request, and only reads while recording count
+    with usage.recording():
+        assert [info.series_description for info in lazy] == ['run0', 'run1']
+    assert lazy[0].dim3 == 3
+    assert listings == [] and usage.fields == {'series_description'}
+
+    # the count and example of a zip without a count come from one listing
+    with usage.recording():
+        assert lazy[1].total_files_till_now == 6
+        assert lazy[1].example_dcm_file == '1/0.dcm'
+    assert listings == ['1.dicom.zip']
+    assert usage.fields == {'series_description', 'total_files_till_now', 'example_dcm_file'}
+
+    # resolved, they are the eager SeqInfos
+    assert [info.resolve() for info in lazy] == eager
+
+    # the fields read are saved per heuristic and fetched up front next time
+    save_field_usage(str(tmp_path), 'h', usage.fields)
+    save_field_usage(str(tmp_path), 'h', ['dim1'])
+    known = load_field_usage(str(tmp_path), 'h')
+    assert known == usage.fields | {'dim1'}
+    assert load_field_usage(str(tmp_path), 'other') == set()
+    del listings[:]
+    seq_infos(FieldUsage(known))
+    assert sorted(listings) == ['0.dicom.zip', '1.dicom.zip']
+
+def test_session_jobs_order():
+
+    import time
+    import datetime
+    from fw_heudiconv.backend_funcs.query import session_to_seq_info
+
+    def acquisition(i):
+        def zip_info(name):
+            # the first acquisitions take longest, so they finish last
+            time.sleep((8 - i) * 0.01)
+            return FakeObj(members=[FakeObj(path='{}/{}.dcm'.format(i, n)) for n in range(i + 1)])
+        files = [FakeObj(name='{}.dicom.zip'.format(i), type='dicom', info={'Rows': 64, 'Columns': 64}),
+                 FakeObj(name='{}.nii.gz'.format(i), type='nifti', info={'SeriesDescription': str(i)})]
+        return FakeObj(id='acq{}'.format(i), files=files, get_file_zip_info=zip_info,
+                       timestamp=datetime.datetime(2020, 1, 1, 12, i),
+                       parents=FakeObj(subject='sub', session='ses'))
+
+    acquisitions = [acquisition(i) for i in range(8)]
+    client = FakeClient({acq.id: acq for acq in acquisitions})
+    session = FakeObj(label='ses', acquisitions=lambda: list(reversed(acquisitions)))
+    context = {'subject': FakeObj(label='sub')}
+
+    serial = list(session_to_seq_info(client, session, context, acquisitions=acquisitions))
+    assert [info.series_id for info in serial] == [acq.id for acq in acquisitions]
+    assert [info.total_files_till_now for info in serial] == [1, 3, 6, 10, 15, 21, 28, 36]
+    for acquisitions_arg in (acquisitions, None):
+        assert list(session_to_seq_info(client, session, context, acquisitions=acquisitions_arg,
+                                        jobs=4)) == serial
+
+def test_dicom_member_count():
+
+    from fw_heudiconv.backend_funcs.query import dicom_member_count
+
+    def dicom(**info):
+        return FakeObj(name='a.dicom.zip', type='dicom', info=info)
+
+    assert dicom_member_count(FakeObj(dicom(), zip_member_count=200)) == 200
+    assert dicom_member_count(dicom(ImagesInAcquisition=176, ImageType=['ORIGINAL', 'PRIMARY'])) == 176
+    # the count of a mosaic or multi-frame series is of slices, not files
+    assert dicom_member_count(dicom(ImagesInAcquisition=36,
+                                    ImageType=['ORIGINAL', 'PRIMARY', 'M', 'MOSAIC'])) is None
+    assert dicom_member_count(dicom(ImagesInAcquisition=36, NumberOfFrames=36)) is None
+    assert dicom_member_count(dicom()) is None
+
+def test_incremental_state(tmp_path):
+
+    from fw_heudiconv.backend_funcs.incremental import CurationState, session_fingerprint
+
+    def acquisition(acq_id, modified, file_hash='h', **info):
+        return FakeObj(id=acq_id, modified=modified, parents=FakeObj(session='ses-' + acq_id),
+                       files=[FakeObj(name='a.nii.gz', hash=file_hash, size=1, modified=modified,
+                                      info=info)])
+
+    a, b = acquisition('a', '2020-01-01'), acquisition('b', '2020-02-01')
+    # the fingerprint ignores modified, which curation bumps
+    assert session_fingerprint([a]) == session_fingerprint([acquisition('a', '2021-01-01')])
+    assert session_fingerprint([a]) != session_fingerprint([acquisition('a', '2020-01-01', 'x')])
+
+    path = str(tmp_path / 'state.json')
+    state = CurationState(path, 'project', 'heuristic')
+    assert not state.is_incremental
+    sessions = [FakeObj(id='ses-a'), FakeObj(id='ses-b')]
+    for session, acq in zip(sessions, [a, b]):
+        state.observe([acq])
+        state.mark_done(session, [acq])
+    state.mark_failed(sessions[1])
+    state.save()
+
+    queries = []
+
+    class Acquisitions(object):
+        def iter_find(self, query):
+            queries.append(query)
+            return []
+
+    state = CurationState(path, 'project', 'heuristic')
+    assert state.is_incremental and state.mark == '2020-02-01'
+    assert state.is_current(sessions[0], [a]) and not state.is_current(sessions[1], [b])
+    # nothing modified since the mark, but the failed session is still a candidate
+    client = FakeObj(acquisitions=Acquisitions())
+    assert state.candidate_sessions(client, sessions) == [sessions[1]]
+    assert queries == ['parents.project=project,modified>2020-02-01']
+
+    # edited headers make a session changed; BIDS info written by curation doesn't
+    assert state.is_current(sessions[0], [acquisition('a', '2020-01-01', BIDS={'Path': 'anat'})])
+    assert not state.is_current(sessions[0], [acquisition('a', '2020-01-01',
+                                                          SeriesDescription='T1w')])
+
+    # another heuristic starts over
+    assert not CurationState(path, 'project', 'other').is_incremental
+
+def test_iter_seq_info_errors(monkeypatch):
+
+    from fw_heudiconv.backend_funcs import query
+
+    def session_to_seq_info(client, session, *args):
+        if session.label == 'bad':
+            raise RuntimeError('query failed')
+        return {session.label: {}}
+
+    monkeypatch.setattr(query, 'find_project', lambda client, project: FakeObj(id=project))
+    monkeypatch.setattr(query, 'session_to_seq_info', session_to_seq_info)
+    sessions = [FakeObj(label=label, id=label, subject=None) for label in ('a', 'bad', 'c')]
+    for buffer in (0, 2):
+        results = list(query.iter_seq_info(None, 'p', sessions, index={}, buffer=buffer,
+                                           return_errors=True))
+        assert [s.label for s, _ in results] == ['a', 'bad', 'c']
+        assert isinstance(results[1][1], RuntimeError) and results[2][1] == {'c': {}}
+    with pytest.raises(RuntimeError):
+        list(query.iter_seq_info(None, 'p', sessions, index={}))
+
+def test_buffered_log(caplog):
+
+    import logging
+    import threading
+    from fw_heudiconv.backend_funcs.utils import BufferedLog
+
+    caplog.set_level(logging.INFO)
+    loggers = [logging.getLogger('fw-heudiconv-curator'),
+               logging.getLogger('fw_heudiconv.backend_funcs.query')]
+    both_logging = threading.Barrier(2)
+
+    def query(name):
+        with session_log.stash(name):
+            loggers[1].info('q' + name)
+
+    def curate(name):
+        with session_log.buffer(name):
+            for i in range(2):
+                for logger in loggers:
+                    logger.info(name)
+                both_logging.wait()
+
+    with BufferedLog() as session_log:
+        # what the query thread logged goes out with the session's block
+        query_thread = threading.Thread(target=lambda: [query(name) for name in 'abc'])
+        query_thread.start()
+        query_thread.join()
+        assert not caplog.records
+        threads = [threading.Thread(target=curate, args=(name,)) for name in 'ab']
+        [t.start() for t in threads]
+        [t.join() for t in threads]
+    # and a session that was never curated still has its log written
+    messages = ''.join(r.getMessage() for r in caplog.records)
+    assert messages in ('qaaaaaqbbbbbqc', 'qbbbbbqaaaaaqc')
+
+def test_load_local_heuristic(tmp_path):
+
+    import json
+    import threading
+    from fw_heudiconv.backend_funcs.heuristics import load_heuristic, HeuristicCache
+
+    # a local heuristic can import a helper module sitting next to it
+    (tmp_path / 'naming_helpers.py').write_text("T1W = 'sub-{subject}/anat/sub-{subject}_T1w'\n")
+    (tmp_path / 'my_heuristic.py').write_text(
+        "from naming_helpers import T1W\n\ndef infotodict(seqinfo):\n    return {}\n")
+    heuristic, source = load_heuristic(str(tmp_path / 'my_heuristic.py'),
+                                       cache_dir=str(tmp_path / 'cache'))
+    assert heuristic.T1W.endswith('_T1w') and 'naming_helpers' in source
+    assert str(tmp_path) not in sys.path
+
+    # concurrent jobs caching different URLs keep each other's entries
+    cache = HeuristicCache(str(tmp_path / 'cache'))
+    urls = ['https://github.com/h/{}.py'.format(i) for i in range(8)]
+    threads = [threading.Thread(target=cache.remember, args=(url, str(i)))
+               for i, url in enumerate(urls)]
+    [t.start() for t in threads]
+    [t.join() for t in threads]
+    with open(str(tmp_path / 'cache' / 'heuristics' / 'refs.json')) as f:
+        assert sorted(json.load(f)) == sorted(urls)
+
+def test_load_url_heuristic(tmp_path, monkeypatch, caplog):
+
+    import logging
+    import requests
+    from fw_heudiconv.backend_funcs.heuristics import load_heuristic
+
+    caplog.set_level(logging.INFO)
+    url = 'https://raw.githubusercontent.com/org/repo/master/heuristic.py'
+    remote = {'source': b"VERSION = 1\n", 'etag': '"v1"'}
+    sent = []
+
+    def get(request_url, headers=None):
+        sent.append(dict(headers or {}))
+        if headers and headers.get('If-None-Match') == remote['etag']:
+            return FakeObj(status_code=304, ok=False, headers={})
+        return FakeObj(status_code=200, ok=True, content=remote['source'],
+                       headers={'ETag': remote['etag']})
+
+    monkeypatch.setattr(requests, 'get', get)
+    cache_dir = str(tmp_path)
+    assert load_heuristic(url, cache_dir=cache_dir)[0].VERSION == 1
+    assert sent == [{}]
+
+    # a branch is checked on every load, and a fix pushed to it is picked up
+    assert load_heuristic(url, cache_dir=cache_dir)[0].VERSION == 1
+    assert sent[-1] == {'If-None-Match': '"v1"'}
+    assert any('is unchanged; using the cached copy fetched' in r.getMessage()
+               for r in caplog.records if r.levelno == logging.INFO)
+    remote.update(source=b"VERSION = 2\n", etag='"v2"')
+    assert load_heuristic(url, cache_dir=cache_dir)[0].VERSION == 2
+
+    # offline, or if the check fails, the cached copy is used
+    def unreachable(request_url, headers=None):
+        raise requests.ConnectionError('no network')
+
+    monkeypatch.setattr(requests, 'get', unreachable)
+    assert load_heuristic(url, cache_dir=cache_dir)[0].VERSION == 2
+    assert load_heuristic(url, cache_dir=cache_dir, offline=True)[0].VERSION == 2
+
+def test_intention_index():
+
+    from fw_heudiconv.backend_funcs.intentions import IntentionIndex
+
+    def bids(path):
+        folder, filename = path.rsplit('/', 1)
+        return {'BIDS': {'Path': folder, 'Filename': filename}}
+
+    client = fake_client(sessions=('1', '2'))
+    fmap = 'sub-01/ses-1/fmap/sub-01_ses-1_epi.nii.gz'
+    client.containers['t1w-1']['files'][0]['info'] = bids('sub-01/ses-1/anat/sub-01_ses-1_T1w.nii.gz')
+    client.containers['bold-2']['files'][0]['info'] = bids('sub-01/ses-2/func/old_bold.nii.gz')
+    index = IntentionIndex('project', [client.containers['t1w-1'], client.containers['bold-2']])
+    assert 'sub-01/ses-1/anat/sub-01_ses-1_T1w.nii.gz' in index
+
+    # planned paths replace the indexed ones
+    index.plan('bold-2', 'bold.nii.gz', 'sub-01/ses-2/func/sub-01_ses-2_bold.nii.gz')
+    assert 'sub-01/ses-2/func/old_bold.nii.gz' not in index
+
+    # same-session targets are checked at once; other sessions' are held back
+    kept = index.resolve(client.containers['ses1'], 't1w-1', 'fmap.nii.gz', fmap,
+                         ['ses-1/anat/sub-01_ses-1_T1w.nii.gz', 'ses-1/anat/missing.nii.gz',
+                          'bids::sub-01/ses-2/func/sub-01_ses-2_bold.nii.gz',
+                          'ses-2/func/sub-01_ses-2_run-2_bold.nii.gz'])
+    assert kept == ['ses-1/anat/sub-01_ses-1_T1w.nii.gz',
+                    'bids::sub-01/ses-2/func/sub-01_ses-2_bold.nii.gz']
+    index.plan('bold-2', 'bold_run-2.nii.gz', 'sub-01/ses-2/func/sub-01_ses-2_run-2_bold.nii.gz')
+
+    # finish adds the held back targets that resolve; with every target
+    # found or already reported, nothing is queried
+    queries = []
+
+    def iter_find(query, include_all_info=False):
+        queries.append(query)
+        return []
+    client.acquisitions = FakeObj(iter_find=iter_find)
+    updates = index.finish(client, dry_run=True)
+    assert queries == []
+    assert [(u.filename, u.update) for u in updates] == [('fmap.nii.gz', {'IntendedFor': [
+        'ses-1/anat/sub-01_ses-1_T1w.nii.gz', 'bids::sub-01/ses-2/func/sub-01_ses-2_bold.nii.gz',
+        'ses-2/func/sub-01_ses-2_run-2_bold.nii.gz']})]
+    assert client.containers['t1w-1'].writes == []
+    assert index.finish(client) == []
+
+    # in a session-less layout another folder's file may be in any session of
+    # the subject, so only the subject is indexed to look for it
+    index = IntentionIndex('project')
+    index.plan('bold-1', 'bold.nii.gz', 'sub-01/func/sub-01_task-rest_bold.nii.gz')
+    assert index.resolve(client.containers['ses1'], 't1w-1', 'fmap.nii.gz',
+                         'sub-01/fmap/sub-01_epi.nii.gz',
+                         ['func/sub-01_task-rest_bold.nii.gz',
+                          'func/sub-01_task-nback_bold.nii.gz']) == \
+        ['func/sub-01_task-rest_bold.nii.gz']
+    assert index.finish(client, dry_run=True) == []
+    assert queries == ['parents.subject=sub']
+
+    # a missing target of another subject needs the whole project
+    index.resolve(client.containers['ses1'], 't1w-1', 'fmap.nii.gz',
+                  'sub-01/fmap/sub-01_epi.nii.gz', ['bids::sub-02/func/sub-02_bold.nii.gz'])
+    index.finish(client, dry_run=True)
+    assert queries[-1] == 'parents.project=project' and index.complete
+
+def test_checkpoint_resume(tmp_path, monkeypatch):
+
+    import os
+    from fw_heudiconv.backend_funcs import checkpoint
+    from fw_heudiconv.backend_funcs.checkpoint import (
+        CheckpointJournal, CheckpointError, default_checkpoint_path)
+    from fw_heudiconv.backend_funcs.convert import FileUpdate
+
+    # runs over different selections of a project don't share a journal
+    paths = set(default_checkpoint_path(str(tmp_path), 'project', subjects, sessions)
+                for subjects, sessions in ((None, None), (['01'], None), (['02'], None),
+                                           (None, ['01'])))
+    assert len(paths) == 4
+    path = default_checkpoint_path(str(tmp_path), 'project')
+
+    syncs = []
+    monkeypatch.setattr(checkpoint.os, 'fsync', lambda fd: syncs.append(fd))
+    sessions = [FakeObj(id='ses' + i, label=i) for i in '123']
+    write = FileUpdate('acq1', 'a.nii.gz', {'BIDS': {}, 'IntendedFor': []}, 'new', {})
+    held = {'acquisition_id': 'acq1', 'filename': 'a.nii.gz', 'subject_dir': 'sub-01',
+            'intendeds': ['ses-2/func/bold.nii.gz'], 'kept': [], 'reported': []}
+
+    journal = CheckpointJournal(path, 'project', 'heuristic')
+    syncs.clear()
+    journal.add(sessions[0], [write, write._replace(filename='b.nii.gz', update={})], [held])
+    journal.session_done(sessions[0])
+    journal.add(sessions[1], [write._replace(acquisition_id='acq2')])
+    # the second session never finished; the first was synced once
+    assert len(syncs) == 1
+    journal.close()
+
+    with pytest.raises(CheckpointError):
+        CheckpointJournal(path, 'project', 'heuristic')
+    with pytest.raises(CheckpointError):
+        CheckpointJournal(path, 'project', 'other heuristic', resume=True)
+
+    journal = CheckpointJournal(path, 'project', 'heuristic', resume=True)
+    assert journal.done == {'ses1'} and journal.writes == 2
+    assert [(h['held'], h['filename'], h['intendeds']) for h in journal.held] == \
+        [('acq1', 'a.nii.gz', ['ses-2/func/bold.nii.gz'])]
+    # adding the held back targets clears them
+    journal.add(sessions[0], [write._replace(update={'IntendedFor': ['x']})])
+    journal.session_done(sessions[1])
+    journal.close()
+    journal = CheckpointJournal(path, 'project', 'heuristic', resume=True)
+    assert journal.done == {'ses1', 'ses2'} and journal.held == []
+    journal.close(finished=True)
+    assert not os.path.exists(path)
+    assert not CheckpointJournal(path, 'project', 'heuristic', restart=True).done
+
+def test_metrics(tmp_path):
+
+    import json
+    from fw_heudiconv.backend_funcs.metrics import Metrics, call_type, instrument
+
+    assert call_type('GET', '/acquisitions/{AcquisitionId}') == 'get'
+    assert call_type('GET', '/acquisitions') == 'find'
+    assert call_type('POST', '/acquisitions/{AcquisitionId}/files/{FileName}/info') == \
+        'update_file_info'
+    assert call_type('GET', '/acquisitions/{AcquisitionId}/files/{FileName}') == 'download_file'
+    assert call_type('GET', '/acquisitions/{AcquisitionId}/files/{FileName}',
+                     [('info', 'true')]) == 'file_zip_info'
+
+    # every request through an instrumented client is counted and timed
+    class ApiClient(object):
+        def call_api(self, resource_path, method, path_params=None, query_params=None):
+            if method == 'PUT':
+                raise IOError('failed')
+            return resource_path
+
+    metrics = Metrics()
+    client = FakeObj(api_client=ApiClient())
+    assert instrument(client, metrics)
+    client.api_client.call_api('/acquisitions/{AcquisitionId}', 'GET')
+    with pytest.raises(IOError):
+        client.api_client.call_api('/sessions/{SessionId}', 'PUT')
+    with metrics.stage('prefetch'):
+        pass
+    metrics.set_gauge('concurrency_limit', 4.5)
+
+    data = metrics.as_dict('curate')
+    assert data['api_calls']['get']['count'] == 1
+    assert data['api_calls']['other'] == dict(data['api_calls']['other'], count=1, errors=1)
+    assert data['stages']['prefetch']['count'] == 1
+
+    # every family is a HELP and a TYPE line followed by its samples
+    lines = metrics.to_prometheus('curate').splitlines()
+    family = None
+    for line in lines:
+        if line.startswith('# HELP '):
+            family = line.split()[2]
+            assert family.startswith('fw_heudiconv_')
+        elif line.startswith('# TYPE '):
+            assert line.split()[2:] in ([family, 'gauge'], [family, 'counter'])
+        else:
+            assert line.split('{')[0] == family
+            assert 'command="curate"' in line
+            float(line.rsplit(' ', 1)[1])
+    families = [line.split()[2] for line in lines if line.startswith('# HELP ')]
+    assert len(families) == len(set(families))
+    assert 'fw_heudiconv_api_call_errors_total{command="curate",call="other"} 1' in lines
+    assert 'fw_heudiconv_concurrency_limit{command="curate"} 4.5' in lines
+
+    # the JSON, and the Prometheus file next to it
+    path = str(tmp_path / 'metrics.json')
+    metrics.write(path, 'curate')
+    with open(path) as f:
+        assert json.load(f)['api_calls']['get']['count'] == 1
+    with open(str(tmp_path / 'metrics.prom')) as f:
+        prom = f.read().splitlines()
+    assert [l for l in prom if l.startswith('#')] == [l for l in lines if l.startswith('#')]
+    assert sorted(tmp_path.iterdir()) == [tmp_path / 'metrics.json', tmp_path / 'metrics.prom']
+
+
+def test_trace_and_limiter():
+
+    from fw_heudiconv.backend_funcs.limiter import AdaptiveLimiter, limit_requests
+    from fw_heudiconv.backend_funcs.metrics import Metrics, instrument
+    from fw_heudiconv.backend_funcs.tracing import trace
+
+    class Throttled(Exception):
+        status = 429
+        headers = {'Retry-After': '0'}
+
+    class ApiClient(object):
+        throttle = 0
+
+        def call_api(self, resource_path, method, path_params=None, query_params=None):
+            if self.throttle:
+                self.throttle -= 1
+                raise Throttled()
+            return resource_path
+
+    # wrapped the way the commands wrap it, the site is the caller's
+    limiter = AdaptiveLimiter(initial=4, max_limit=8, metrics=Metrics())
+    client = FakeObj(api_client=ApiClient())
+    instrument(client, Metrics())
+    request_trace = trace(client, 0)
+    assert limit_requests(client, 8, limiter)
+    client.api_client.call_api('/acquisitions/{AcquisitionId}/files/{FileName}/info', 'POST',
+                               {'AcquisitionId': 'a', 'FileName': 'f'})
+    site = request_trace.requests[0].site
+    assert site.startswith(__file__) and site.endswith('(test_trace_and_limiter)')
+
+    # throttled writes are retried, cutting the limit
+    limit = limiter.limit
+    client.api_client.throttle = 2
+    client.api_client.call_api('/acquisitions/{AcquisitionId}/files/{FileName}/info', 'POST',
+                               {'AcquisitionId': 'a', 'FileName': 'f'})
+    assert client.api_client.throttle == 0
+    assert limiter.limit < limit
+    assert limiter.throttled == 2 and limiter.in_flight == 0
+
+    # a 429 halves it, and so does a request much slower than usual
+    limit = limiter.limit = 6.0
+    limiter._last_decrease = 0.0
+    limiter.acquire()
+    limiter.release(0.0, throttled=True)
+    assert limiter.limit == limit / 2
+    limiter.latency, limiter._last_decrease = 1.0, 0.0
+    limiter.acquire()
+    limiter.release(10.0)
+    assert limiter.limit == limit / 4
+
+    # downloads aren't retried
+    client.api_client.throttle = 1
+    with pytest.raises(Throttled):
+        client.api_client.call_api('/acquisitions/{AcquisitionId}/files/{FileName}', 'GET')
+
+    # quick requests raise it again, up to the maximum
+    limit = limiter.limit
+    for _ in range(5):
+        limiter.acquire()
+        limiter.release(0.0)
+    assert limit < limiter.limit <= 8
+    for _ in range(500):
+        limiter.acquire()
+        limiter.release(0.0)
+    assert limiter.limit == 8
+
+
+def test_limiter_transfers(monkeypatch):
+
+    from fw_heudiconv.backend_funcs import limiter as limiter_module
+    from fw_heudiconv.backend_funcs.metrics import Metrics
+
+    class Throttled(Exception):
+        status = 503
+        headers = {}
+
+    clock = [1000.0]
+    monkeypatch.setattr(limiter_module.time, 'time', lambda: clock[0])
+    limiter = limiter_module.AdaptiveLimiter(initial=4, metrics=Metrics())
+    limiter.latency = 0.1
+
+    # a slow transfer that succeeds leaves the limit and latency alone
+    with limiter.slot(track_latency=False):
+        clock[0] += 60
+    assert (limiter.limit, limiter.latency) == (4.0, 0.1)
+
+    # the same time on a tracked request is congestion
+    with limiter.slot():
+        clock[0] += 60
+    assert limiter.limit == 2.0
+
+    # a throttled transfer still cuts it
+    clock[0] += 60
+    with pytest.raises(Throttled):
+        with limiter.slot(track_latency=False):
+            raise Throttled()
+    assert limiter.limit == 1.0 and limiter.in_flight == 0
+
+
+def test_export_sync(tmp_path, monkeypatch):
+
+    from fw_heudiconv.backend_funcs import utils
+    from fw_heudiconv.backend_funcs.export_state import ExportState, default_state_path
+    from fw_heudiconv.cli.export import download_bids, plan_downloads, remove_file
+
+    monkeypatch.setattr(utils.time, 'sleep', lambda seconds: None)
+    contents = {'t1w.nii.gz': b'T1', 'bold.nii.gz': b'BOLD', 'bold.tsv': b'onset'}
+    hashes = {name: 'v1' for name in contents}
+    fetched, failures = [], {'bold.nii.gz': 1}
+
+    def download_file(name, path):
+        fetched.append(name)
+        if failures.get(name):
+            failures[name] -= 1
+            raise ConnectionError('reset')
+        with open(path, 'wb') as f:
+            f.write(contents[name])
+
+    client = FakeClient({'acq': FakeObj(id='acq', download_file=download_file)})
+
+    def gathered(*names):
+        bids = {'t1w.nii.gz': ('anat', 'sub-01_T1w.nii.gz'),
+                'bold.nii.gz': ('func', 'sub-01_task-rest_bold.nii.gz'),
+                'bold.tsv': ('func', 'sub-01_task-rest_events.tsv')}
+        files = []
+        for name in names:
+            folder, filename = bids[name]
+            info = {'Path': 'sub-01/' + folder, 'Folder': folder, 'ignore': False,
+                    'Filename': filename}
+            # as gather_bids gives them: every file but bvals and bvecs
+            # keeps its info as a sidecar
+            files.append({'data': 'acq', 'name': name, 'hash': hashes[name],
+                          'size': len(contents[name]), 'BIDS': info,
+                          'sidecar': {'RepetitionTime': 2.0, 'BIDS': info}})
+        return {'project': [], 'subject': [], 'session': [], 'acquisition': files,
+                'dataset_description': []}
+
+    def export(*names, sync=False, project='p1', **kwargs):
+        del fetched[:]
+        download_bids(client, gathered(*names), str(tmp_path), dry_run=False, name='bids',
+                      jobs=2, retries=3, sync=sync, project=project, **kwargs)
+        return sorted(fetched)
+
+    root = tmp_path / 'bids'
+    everything = ('t1w.nii.gz', 'bold.nii.gz', 'bold.tsv')
+
+    # conflicting paths stop the export before anything is written
+    with pytest.raises(FileExistsError):
+        export('t1w.nii.gz', 't1w.nii.gz')
+    assert not root.exists()
+
+    # an events tsv has no JSON sidecar of its own
+    tsv, = plan_downloads(gathered('bold.tsv'), str(root))
+    assert tsv.path == str(root / 'sub-01/func/sub-01_task-rest_events.tsv')
+    assert tsv.sidecar is None and tsv.sidecar_path is None
+
+    # the dropped connection is retried for that file alone
+    assert export(*everything) == ['bold.nii.gz', 'bold.nii.gz', 'bold.tsv', 't1w.nii.gz']
+    assert (root / 'sub-01/func/sub-01_task-rest_bold.nii.gz').read_bytes() == b'BOLD'
+    assert (root / 'sub-01/func/sub-01_task-rest_bold.json').exists()
+    assert not list(root.glob('**/*.tmp'))
+
+    # nothing changed, nothing to fetch
+    assert export(*everything, sync=True) == []
+
+    # a changed file, one missing on disk, and a file no longer curated
+    hashes['t1w.nii.gz'] = 'v2'
+    (root / 'sub-01/func/sub-01_task-rest_events.tsv').unlink()
+    state = ExportState(default_state_path(str(root)), str(root), 'p1')
+    curated = [str(root / 'sub-01/anat' / name) for name in
+               ('sub-01_T1w.nii.gz', 'sub-01_T1w.json')] + \
+        [str(root / 'sub-01/func/sub-01_task-rest_events.tsv')]
+    assert state.stale(curated) == [str(root / 'sub-01/func' / name) for name in
+                                    ('sub-01_task-rest_bold.json',
+                                     'sub-01_task-rest_bold.nii.gz')]
+    assert export('t1w.nii.gz', 'bold.tsv', sync=True) == ['bold.tsv', 't1w.nii.gz']
+    assert sorted(p.name for p in (root / 'sub-01/func').iterdir()) == \
+        ['sub-01_task-rest_events.tsv']
+
+    # the state of another project's export isn't trusted
+    assert ExportState(default_state_path(str(root)), str(root), 'p2').files == {}
+    assert export('t1w.nii.gz', 'bold.tsv', sync=True, project='p2') == \
+        ['bold.tsv', 't1w.nii.gz']
+
+    # a filtered sync removes nothing outside what it selected, and no sync
+    # removes anything outside the BIDS directory
+    events = root / 'sub-01/func/sub-01_task-rest_events.tsv'
+    outside = tmp_path / 'notes.txt'
+    outside.write_text('mine')
+    state = ExportState(default_state_path(str(root)), str(root), 'p2')
+    state.files['../notes.txt'] = {'container': 'acq', 'name': 'notes.txt', 'hash': 'v1',
+                                   'size': 4, 'folder': None}
+    state.save()
+    export('t1w.nii.gz', sync=True, project='p2', folders_to_download=['anat'])
+    assert events.exists() and outside.exists()
+    export(sync=True, project='p2', filtered=True)
+    assert events.exists() and (root / 'sub-01/anat/sub-01_T1w.nii.gz').exists()
+    export('t1w.nii.gz', sync=True, project='p2')
+    assert not events.exists() and outside.exists()
+    remove_file(str(outside), str(root))
+    assert outside.exists()
+
+
+def test_prefetch_acquisitions():
+
+    import datetime
+    from fw_heudiconv.backend_funcs.query import prefetch_acquisitions
+
+    def at(minute):
+        return datetime.datetime(2020, 1, 1, 12, minute, tzinfo=datetime.timezone.utc)
+
+    sessions = [FakeObj(id='ses{}'.format(i)) for i in range(12)]
+    # returned out of acquisition order, one without a timestamp
+    acquisitions = [FakeObj(id='b', timestamp=at(5), parents=FakeObj(session='ses0')),
+                    FakeObj(id='c', timestamp=None, created=at(1), parents=FakeObj(session='ses0')),
+                    FakeObj(id='a', timestamp=at(5), parents=FakeObj(session='ses0')),
+                    FakeObj(id='x', timestamp=at(0), parents=FakeObj(session='other'))]
+    queries = []
+
+    def iter_find(query, include_all_info=False):
+        queries.append(query)
+        return iter(acquisitions)
+
+    client = FakeObj(acquisitions=FakeObj(iter_find=iter_find))
+    index = prefetch_acquisitions(client, FakeObj(id='project'), sessions)
+    assert list(index) == [s.id for s in sessions]
+    assert [acq.id for acq in index['ses0']] == ['c', 'a', 'b']
+
+    # a selection is queried by its sessions, never the whole project
+    assert queries == ['parents.session=|[{}]'.format(','.join(s.id for s in sessions))]
+    del queries[:]
+    prefetch_acquisitions(client, FakeObj(id='project'), sessions, whole_project=True)
+    assert queries == ['parents.project=project']
+    del queries[:]
+    prefetch_acquisitions(client, FakeObj(id='project'), sessions[:2])
+    assert queries == ['parents.session=ses0', 'parents.session=ses1']
+
+
+def test_container_cache():
+
+    from fw_heudiconv.backend_funcs.container_cache import CachedClient, find_project, remember
+
+    finds = []
+
+    def find_first(query):
+        finds.append(query)
+        return FakeObj(id='project', label='P')
+
+    base = FakeClient({name: FakeObj(id=name) for name in 'abcd'})
+    base.projects = FakeObj(find_first=find_first)
+    client = CachedClient(base, max_size=2)
+
+    # least recently used containers are evicted first
+    client.get('a'), client.get('b'), client.get('a'), client.get('c')
+    assert base.requests == 3
+    client.get('a')
+    assert base.requests == 3
+    client.get('b')
+    assert base.requests == 4
+    assert client.stats()['evictions'] == 2 and client.stats()['size'] == 2
+
+    # written containers are fetched again
+    client.invalidate('a')
+    client.get('a')
+    assert base.requests == 5
+
+    # projects are looked up once per label, until they're written to
+    assert find_project(client, 'P').id == 'project'
+    find_project(client, 'P')
+    assert finds == ['label="P"']
+    client.invalidate('project')
+    find_project(client, 'P')
+    assert len(finds) == 2
+
+    # a bulk seed larger than the cache is held whole
+    remember(client, *[FakeObj(id=str(i)) for i in range(10)], grow=True)
+    requests = base.requests
+    for i in range(10):
+        client.get(str(i))
+    assert base.requests == requests
+
+
+def test_memoized_heuristic():
+
+    import types
+    from collections import OrderedDict
+    from fw_heudiconv.backend_funcs.heuristics import (
+        load_heuristic, memoize_heuristic, MemoizedHeuristic)
+    from fw_heudiconv.backend_funcs.query import SeqInfo, SEQINFO_FIELDS
+
+    t1w = ('sub-{subject}/anat/sub-{subject}_T1w', ('nii.gz',), None)
+    bold = ('sub-{subject}/func/sub-{subject}_task-rest_bold', ('nii.gz',), None)
+    calls = []
+
+    def infotodict(seqinfo):
+        calls.append([s.series_id for s in seqinfo])
+        info = {t1w: [], bold: []}
+        for s in seqinfo:
+            info[t1w if 'MPRAGE' in s.series_description else bold].append(s.series_id)
+        return info
+
+    def seqinfo(series_id, description, TR=2.0):
+        values = dict.fromkeys(SEQINFO_FIELDS)
+        values.update(series_id=series_id, series_description=description, TR=TR)
+        return SeqInfo(**values)
+
+    module = types.ModuleType('h')
+    module.infotodict = infotodict
+    heuristic = memoize_heuristic(module)
+    assert isinstance(heuristic, MemoizedHeuristic)
+
+    # series with the same signature reuse the decision, in any session
+    first = heuristic.infotodict(OrderedDict.fromkeys([seqinfo('a', 'MPRAGE'),
+                                                       seqinfo('b', 'rest')]))
+    second = heuristic.infotodict(OrderedDict.fromkeys([seqinfo('c', 'MPRAGE'),
+                                                        seqinfo('d', 'rest')]))
+    assert first == {t1w: ['a'], bold: ['b']} and second == {t1w: ['c'], bold: ['d']}
+    assert calls == [['a'], ['b']] and (heuristic.hits, heuristic.misses) == (2, 2)
+
+    # a difference in a signature field is decided again
+    heuristic.infotodict(OrderedDict.fromkeys([seqinfo('e', 'rest', TR=0.8)]))
+    assert calls[-1] == ['e'] and heuristic.misses == 3
+
+    # a heuristic can narrow the signature
+    module.SIGNATURE_FIELDS = ('series_description',)
+    narrow = memoize_heuristic(module)
+    narrow.infotodict(OrderedDict.fromkeys([seqinfo('f', 'rest'), seqinfo('g', 'rest', TR=0.8)]))
+    assert (narrow.hits, narrow.misses) == (1, 1)
+
+    # heuristics that number runs by position opt out
+    multi_task, _ = load_heuristic('multi-task_fmri')
+    assert memoize_heuristic(multi_task) is multi_task
+    assert memoize_heuristic(module, lazy=True) is module